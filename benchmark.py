@@ -0,0 +1,653 @@
+"""
+headless load generator and benchmark suite of the chatting application.
+
+thousands of simulated clients are run by a single asyncio event loop. they speak the same
+protocol as client.py (version 1 or 2) and drive one of the following scenarios against a
+running server, or against a server started by the benchmark itself with --spawn-server:
+
+    register   registration storm: every client connects and registers at once
+    search     SEARCH-heavy: every client searches random users in a closed loop
+    private    1:1 chat: pairs of clients request, accept and leave private chat sessions
+    group      large-group broadcast: groups of clients exchange MESSAGEs
+    heartbeat  heartbeat-only: registered clients only send HELLO messages
+
+the results (throughput, latency percentiles, server CPU time, RSS, write syscalls, send calls
+read from the metrics of the server when --stats-port is given, tcp segments and bytes received
+by the clients) are printed as a JSON document, so that runs of different versions can
+be compared.
+
+    python benchmark.py search --clients 2000 --duration 10 --spawn-server
+    python benchmark.py group --message-size 2000 --compression zlib-dict,zlib --spawn-server
+"""
+import asyncio # event loop running the simulated clients
+import argparse # command line argument parsing
+import json # output format of the results
+import os # clock ticks of the cpu time counters
+import random # random search targets
+import re # room number of the group chat invitations
+import resource # limit of open files
+import shlex # arguments of a spawned server
+import signal # stop the process group of a spawned server
+import socket # udp socket sending the HELLO messages
+import subprocess # spawned server and git revision
+import sys # interpreter running a spawned server
+import time # timestamps of the latencies
+import urllib.request # metrics of the server
+from protocol import (MARKERS, OP_SEARCH, OP_CHATREQUEST, OP_OK, OP_EXIT, OP_GROUPCHAT, OP_OKGROUP,
+                      OP_MESSAGE, OP_HELLO, OP_TEXT, OP_FOUND, OP_NOTFOUND, OP_INVALIDSEARCH, OP_CLIENTOK,
+                      OP_CLIENTEXIT, RECV_SIZE, FrameBuffer, encode_frame, encode_legacy, legacy_text,
+                      parse_command) # wire protocol shared with the server
+from client import STATUS_PERIOD # period of the HELLO messages of the real client
+
+# constants
+IP = '127.0.0.1'
+TCP_PORT = 6234
+UDP_PORT = 6235
+HELLO_PERIOD = STATUS_PERIOD # seconds between two HELLO messages of a client, as sent by client.py
+SCENARIOS = ['register', 'search', 'private', 'group', 'heartbeat']
+SERVER_STOP_TIMEOUT = 10 # seconds a spawned server has to exit before it is killed
+INVITATION = re.compile(r'group chat room (\S+)\?')
+FILLER_WORDS = ['hello', 'everyone', 'about', 'the', 'meeting', 'tomorrow', 'morning', 'i', 'think', 'we', 'should',
+                'have', 'a', 'look', 'at', 'this', 'before', 'lunch', 'thanks', 'sounds', 'good', 'to', 'me', 'and',
+                'you', 'it', 'is', 'not', 'ready', 'yet', 'maybe', 'later', 'today'] # words of the padding of group messages
+
+
+class BenchmarkError(Exception):
+    """
+    raised when a simulated client does not get an expected response in time.
+    """
+
+
+def parse_response(text):
+    """
+    this function gets the text of a version 1 message sent by the server and returns its opcode
+    and its fields in the same shape as a version 2 message without the username of the sender.
+    """
+    for opcode, marker in MARKERS.items():
+        if text == marker:
+            return opcode, []
+        if text.startswith(marker + '|'):
+            body = text[len(marker) + 1:]
+            return opcode, [body] if opcode == OP_MESSAGE else body.split('|')
+    return OP_TEXT, [text]
+
+
+class SimulatedClient:
+    """
+    this class is a headless client speaking the protocol version given to it. the messages of
+    the server are read by a dedicated task and put in an inbox along with their arrival time.
+    """
+
+    def __init__(self, username, version, compression=''):
+        self.username = username
+        self.version = version
+        self.compression = compression # compression methods offered to the server
+        self.received_bytes = 0
+        self.buffer = FrameBuffer(1)
+        self.inbox = asyncio.Queue()
+        self.reader = self.writer = self.reader_task = None
+        self.registered = False
+
+    async def connect(self, host, port, timeout):
+        """
+        this coroutine connects the client and registers it. version 2 clients wait for the
+        REGISTERED acknowledgement, version 1 clients search themselves since the server does not
+        acknowledge their registration.
+        """
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        register = f'&&REGISTER&&|{self.username}|0' + (f'|{self.version}' if self.version >= 2 else '')
+        if self.version >= 2 and self.compression:
+            register += f'|{self.compression}'
+        self.writer.write(encode_legacy(register))
+
+        if self.version >= 2:
+            frames = []
+            while len(frames) < 2:
+                frames += await asyncio.wait_for(self.read_frames(), timeout)
+            self.buffer.version = self.version
+        self.reader_task = asyncio.get_running_loop().create_task(self.read_loop())
+
+        if self.version < 2:
+            self.send(OP_SEARCH, self.username, self.username)
+            await self.expect({OP_INVALIDSEARCH}, timeout)
+        self.registered = True
+
+    async def read_frames(self):
+        data = await self.reader.read(RECV_SIZE)
+        if not data:
+            raise ConnectionError(f'{self.username} has been disconnected')
+        self.received_bytes += len(data)
+        self.buffer.feed(data)
+
+        frames = []
+        while (frame := self.buffer.next_frame()) is not None:
+            frames.append(frame)
+        return frames
+
+    async def read_loop(self):
+        """
+        this coroutine puts every message of the server in the inbox. version 1 messages are made
+        of a frame holding the username of the sender followed by a frame holding the text.
+        """
+        sender = None
+        try:
+            while True:
+                for opcode, payload in await self.read_frames():
+                    now = time.perf_counter()
+                    if self.version >= 2:
+                        opcode, fields = parse_command(opcode, payload)
+                        self.inbox.put_nowait((opcode, fields[1:], now))
+                    elif sender is None:
+                        sender = payload
+                    else:
+                        self.inbox.put_nowait(parse_response(payload.decode('utf-8')) + (now,))
+                        sender = None
+        except (ConnectionError, OSError):
+            self.inbox.put_nowait((None, [], time.perf_counter()))
+
+    def send(self, opcode, *fields):
+        if self.version >= 2:
+            self.writer.write(encode_frame(opcode, *fields))
+        else:
+            self.writer.write(encode_legacy(legacy_text(opcode, fields)))
+
+    async def expect(self, opcodes, timeout):
+        """
+        this coroutine waits for a message with one of the given opcodes, discarding the other
+        messages, and returns its fields and its arrival time.
+        """
+        deadline = time.perf_counter() + timeout
+        while True:
+            try:
+                opcode, fields, arrival = await asyncio.wait_for(self.inbox.get(), deadline - time.perf_counter())
+            except asyncio.TimeoutError:
+                raise BenchmarkError(f'{self.username} did not receive any of {sorted(opcodes)} in time')
+            if opcode is None:
+                raise BenchmarkError(f'{self.username} has been disconnected')
+            if opcode in opcodes:
+                return fields, arrival
+
+    def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ServerMonitor:
+    """
+    this class samples the resource usage of a server process and of its child processes (the
+    workers of the multi-process mode) from /proc. cpu time and write syscalls are reported as
+    the difference between the start and the end of a scenario, RSS as its peak. the send calls
+    of the server, which /proc does not count as write syscalls, are read from its metrics when
+    it serves them on stats_port.
+    """
+
+    def __init__(self, pid, stats_port=None):
+        self.pid = pid
+        self.stats_port = stats_port
+        self.peak_rss_kb = 0
+        self.start = None
+
+    def pids(self):
+        pids, pending = [], [self.pid]
+        while pending:
+            pid = pending.pop()
+            pids.append(pid)
+            try:
+                with open(f'/proc/{pid}/task/{pid}/children') as children:
+                    pending += [int(child) for child in children.read().split()]
+            except OSError:
+                pass
+        return pids
+
+    def sample(self):
+        cpu_ticks, rss_kb, write_syscalls = 0, 0, 0
+        for pid in self.pids():
+            try:
+                with open(f'/proc/{pid}/stat') as stat:
+                    fields = stat.read().rsplit(')', 1)[1].split()
+                cpu_ticks += int(fields[11]) + int(fields[12]) # utime and stime
+                with open(f'/proc/{pid}/status') as status:
+                    rss_kb += sum(int(line.split()[1]) for line in status if line.startswith('VmRSS:'))
+                with open(f'/proc/{pid}/io') as io:
+                    write_syscalls += sum(int(line.split()[1]) for line in io if line.startswith('syscw:'))
+            except OSError: # the process has exited or /proc/<pid>/io is not readable
+                pass
+
+        self.peak_rss_kb = max(self.peak_rss_kb, rss_kb)
+        return {'cpu_seconds': cpu_ticks / os.sysconf('SC_CLK_TCK'), 'rss_kb': rss_kb, 'write_syscalls': write_syscalls,
+                'tcp_out_segments': tcp_out_segments(), 'time': time.perf_counter()}
+
+    def send_calls(self):
+        """
+        this function returns the number of send calls made by the server so far, or None if its
+        metrics are not known.
+        """
+        if self.stats_port is None:
+            return None
+        try:
+            with urllib.request.urlopen(f'http://{IP}:{self.stats_port}/metrics', timeout=5) as response:
+                for line in response.read().decode('utf-8').splitlines():
+                    if line.startswith('chat_outbound_send_calls_total '):
+                        return int(float(line.split()[1]))
+        except OSError:
+            pass
+        return None
+
+    def begin(self):
+        self.peak_rss_kb = 0
+        self.start = self.sample()
+        self.start['send_calls'] = self.send_calls()
+
+    def end(self):
+        end = self.sample()
+        end['send_calls'] = self.send_calls()
+        elapsed = end['time'] - self.start['time']
+        cpu_seconds = end['cpu_seconds'] - self.start['cpu_seconds']
+        return {'pid': self.pid, 'cpu_seconds': round(cpu_seconds, 3),
+                'cpu_percent': round(100 * cpu_seconds / elapsed, 1) if elapsed else None,
+                'rss_kb': end['rss_kb'], 'peak_rss_kb': self.peak_rss_kb,
+                'write_syscalls': end['write_syscalls'] - self.start['write_syscalls'],
+                'send_calls': end['send_calls'] - self.start['send_calls'] if None not in (end['send_calls'], self.start['send_calls']) else None,
+                'tcp_out_segments': end['tcp_out_segments'] - self.start['tcp_out_segments']}
+
+    async def watch(self, period=0.5):
+        while True:
+            self.sample()
+            await asyncio.sleep(period)
+
+
+def tcp_out_segments():
+    """
+    this function returns the number of TCP segments sent by the host so far, or 0 if it is not
+    known. on loopback, this counts the segments sent by both the server and the clients.
+    """
+    try:
+        with open('/proc/net/snmp') as snmp:
+            header, values = [line.split() for line in snmp if line.startswith('Tcp:')][:2]
+        return int(values[header.index('OutSegs')])
+    except (OSError, ValueError):
+        return 0
+
+
+def percentile(latencies, fraction):
+    """
+    this function gets sorted latencies and returns the given percentile of them in milliseconds.
+    """
+    if not latencies:
+        return None
+    return round(1000 * latencies[min(len(latencies) - 1, int(fraction * len(latencies)))], 3)
+
+
+class Scenario:
+    """
+    this class runs a scenario against the server. the latencies of the operations are collected
+    by the coroutines of the scenario, along with the number of operations and of errors.
+    """
+
+    def __init__(self, name, args, monitor):
+        self.name = name
+        self.args = args
+        self.monitor = monitor
+        self.clients = []
+        self.latencies = []
+        self.operations = 0
+        self.errors = 0
+        self.run_id = f'{os.getpid()}{int(time.time()) % 100000}'
+
+    def username(self, index):
+        return f'{self.name[:3]}{self.run_id}_{index}'
+
+    async def register_clients(self, count):
+        """
+        this coroutine connects and registers count clients, at most args.concurrency at a time,
+        and returns the latency of each registration.
+        """
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        latencies = []
+
+        async def register(index):
+            client = SimulatedClient(self.username(index), self.args.protocol, self.args.compression)
+            self.clients.append(client)
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await asyncio.wait_for(client.connect(self.args.host, self.args.tcp_port, self.args.timeout), self.args.timeout)
+                except (BenchmarkError, OSError, asyncio.TimeoutError):
+                    self.errors += 1
+                    return
+                latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*(register(index) for index in range(count)))
+        return latencies
+
+    async def send_hellos(self, clients, period):
+        """
+        this coroutine sends a HELLO message for every given client each period, spread over the
+        period, from a single udp socket, and counts them as operations.
+        """
+        udp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        udp_socket.setblocking(False)
+        address = (self.args.host, self.args.udp_port)
+        hellos = [encode_frame(OP_HELLO, client.username) if client.version >= 2 else
+                  encode_legacy(f'&&HELLO&&|{client.username}') for client in clients]
+        try:
+            while True:
+                start = time.perf_counter()
+                for index, hello in enumerate(hellos):
+                    try:
+                        udp_socket.sendto(hello, address)
+                        self.operations += self.name == 'heartbeat'
+                    except BlockingIOError:
+                        self.errors += 1
+                    if index % 100 == 99:
+                        await asyncio.sleep(max(0, start + period * index / len(hellos) - time.perf_counter()))
+                await asyncio.sleep(max(0, start + period - time.perf_counter()))
+        finally:
+            udp_socket.close()
+
+    async def run(self):
+        """
+        this coroutine registers the clients of the scenario, runs its workload while measuring the
+        server and returns the results.
+        """
+        watcher = None
+        if self.monitor and self.name == 'register':
+            self.monitor.begin()
+            watcher = asyncio.get_running_loop().create_task(self.monitor.watch())
+
+        start = time.perf_counter()
+        registrations = await self.register_clients(self.args.clients)
+        registered = [client for client in self.clients if client.registered]
+
+        if self.name == 'register':
+            self.latencies, self.operations = registrations, len(registrations)
+        else:
+            period = self.args.hello_period if self.name == 'heartbeat' else HELLO_PERIOD
+            heartbeat = asyncio.get_running_loop().create_task(self.send_hellos(registered, period))
+            if self.monitor:
+                self.monitor.begin()
+                watcher = asyncio.get_running_loop().create_task(self.monitor.watch())
+
+            start = time.perf_counter()
+            workload = getattr(self, f'run_{self.name}')
+            try:
+                await asyncio.wait_for(workload(registered), self.args.duration)
+            except asyncio.TimeoutError: # the workloads run until the end of the scenario
+                pass
+            heartbeat.cancel()
+
+        elapsed = time.perf_counter() - start
+        server = None
+        if watcher is not None:
+            watcher.cancel()
+            server = self.monitor.end()
+
+        for client in self.clients:
+            client.close()
+
+        self.latencies.sort()
+        return {'scenario': self.name, 'protocol': self.args.protocol, 'clients': self.args.clients,
+                'registered': len(registered), 'duration_seconds': round(elapsed, 3), 'operations': self.operations,
+                'throughput': round(self.operations / elapsed, 1) if elapsed else None, 'errors': self.errors,
+                'received_bytes': sum(client.received_bytes for client in self.clients),
+                'latency_ms': {'p50': percentile(self.latencies, 0.5), 'p99': percentile(self.latencies, 0.99),
+                               'p999': percentile(self.latencies, 0.999),
+                               'max': percentile(self.latencies, 1)}, 'server': server}
+
+    async def run_search(self, clients):
+        """
+        every client searches random registered users in a closed loop. an operation is a SEARCH
+        answered by the server.
+        """
+        async def search(client):
+            while True:
+                peer = random.choice(clients).username
+                start = time.perf_counter()
+                client.send(OP_SEARCH, peer, client.username)
+                try:
+                    fields, arrival = await client.expect({OP_FOUND, OP_NOTFOUND, OP_INVALIDSEARCH}, self.args.timeout)
+                except BenchmarkError:
+                    self.errors += 1
+                    return
+                self.latencies.append(arrival - start)
+                self.operations += 1
+
+        await asyncio.gather(*(search(client) for client in clients))
+
+    async def run_private(self, clients):
+        """
+        pairs of clients request, accept and leave private chat sessions in a closed loop, which
+        are the steps of a 1:1 chat handled by the server (the messages themselves are sent from
+        client to client). an operation is a whole session.
+        """
+        async def chat(requester, peer):
+            while True:
+                start = time.perf_counter()
+                try:
+                    requester.send(OP_CHATREQUEST, peer.username, requester.username)
+                    await peer.expect({OP_TEXT}, self.args.timeout)
+                    peer.send(OP_OK, peer.username, requester.username, '0')
+                    await requester.expect({OP_CLIENTOK}, self.args.timeout)
+                    await peer.expect({OP_CLIENTOK}, self.args.timeout)
+                    requester.send(OP_EXIT, requester.username)
+                    await requester.expect({OP_CLIENTEXIT}, self.args.timeout)
+                    fields, arrival = await peer.expect({OP_CLIENTEXIT}, self.args.timeout)
+                except BenchmarkError:
+                    self.errors += 1
+                    return
+                self.latencies.append(arrival - start)
+                self.operations += 1
+
+        await asyncio.gather(*(chat(clients[index], clients[index + 1]) for index in range(0, len(clients) - 1, 2)))
+
+    async def run_group(self, clients):
+        """
+        the clients are split into groups of args.group_size members, which join a group chat
+        room of their first member. every member then sends MESSAGEs in a closed loop, waiting for
+        its own message to come back before sending the next one. the messages are padded with
+        random words up to args.message_size characters. an operation is the delivery of a message
+        to a member, and its latency is measured from the time the message was sent.
+        """
+        groups = [clients[index:index + self.args.group_size] for index in range(0, len(clients), self.args.group_size)]
+
+        async def join(group):
+            admin, members = group[0], group[1:]
+            admin.send(OP_GROUPCHAT, admin.username, *(member.username for member in members))
+            await admin.expect({OP_TEXT}, self.args.timeout)
+            for member in members:
+                fields, arrival = await member.expect({OP_TEXT}, self.args.timeout)
+                member.send(OP_OKGROUP, member.username, INVITATION.search(fields[-1]).group(1))
+            await asyncio.sleep(self.args.timeout / 10) # let the join announcements be delivered
+
+        own_messages = {client: asyncio.Queue() for client in clients} # messages a member has sent itself
+
+        async def listen(client):
+            while True:
+                opcode, fields, arrival = await client.inbox.get()
+                if opcode == OP_MESSAGE:
+                    self.latencies.append(arrival - float(fields[0].rsplit(' ', 1)[1]))
+                    self.operations += 1
+                    if fields[0].startswith(client.username + ' '):
+                        own_messages[client].put_nowait(fields)
+
+        async def talk(client):
+            sequence = 0
+            while True:
+                sequence += 1
+                padding = ' '.join(random.choices(FILLER_WORDS, k=self.args.message_size // 4))[:self.args.message_size]
+                client.send(OP_MESSAGE, f'{client.username} {sequence} {padding} {time.perf_counter()}')
+                try:
+                    await asyncio.wait_for(own_messages[client].get(), self.args.timeout)
+                except asyncio.TimeoutError:
+                    self.errors += 1
+                    return
+
+        try:
+            await asyncio.gather(*(join(group) for group in groups if len(group) > 1))
+        except (BenchmarkError, AttributeError):
+            self.errors += 1
+            return
+
+        listeners = [asyncio.get_running_loop().create_task(listen(client)) for client in clients]
+
+        try:
+            await asyncio.gather(*(talk(client) for client in clients))
+        finally:
+            for listener in listeners:
+                listener.cancel()
+
+    async def run_heartbeat(self, clients):
+        """
+        the registered clients only send HELLO messages, every args.hello_period seconds. the
+        server does not answer them, so only the HELLO messages sent and the resources used by the
+        server are measured.
+        """
+        await asyncio.Event().wait()
+
+
+def raise_open_file_limit():
+    """
+    this function raises the limit of open files to the hard limit, since every simulated client
+    holds a socket. a spawned server inherits the raised limit.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def port_accepts(args):
+    """
+    this function returns whether the tcp port of the server accepts connections.
+    """
+    try:
+        socket.create_connection((args.host, args.tcp_port), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+
+def spawn_server(args):
+    """
+    this function starts a server for the benchmark and waits until it accepts connections. the
+    server runs in a process group of its own, so that its worker processes are stopped along
+    with it by stop_server.
+    """
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    command = [sys.executable, server_path, '--tcp-port', str(args.tcp_port), '--udp-port', str(args.udp_port)]
+    if args.stats_port:
+        command += ['--stats-port', str(args.stats_port)]
+    process = subprocess.Popen(command + shlex.split(args.server_args), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               start_new_session=True)
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        if port_accepts(args):
+            return process
+        time.sleep(0.1)
+
+    stop_server(process, args)
+    raise SystemExit('the spawned server does not accept connections')
+
+
+def stop_server(process, args):
+    """
+    this function stops a spawned server and every process of its group, and waits until they
+    have all exited and the tcp port refuses connections, so that the next spawned server is
+    not mistaken for ready while the workers of the previous one still accept connections. the
+    processes still running after SERVER_STOP_TIMEOUT seconds are killed.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+    deadline = time.monotonic() + SERVER_STOP_TIMEOUT
+    killed = False
+    while True:
+        process.poll()
+        try:
+            os.killpg(process.pid, 0)
+            running = True
+        except ProcessLookupError:
+            running = False
+
+        if not running and not port_accepts(args):
+            break
+
+        if time.monotonic() >= deadline:
+            if killed:
+                break
+            if running:
+                os.killpg(process.pid, signal.SIGKILL)
+            killed = True
+            deadline = time.monotonic() + SERVER_STOP_TIMEOUT
+        time.sleep(0.1)
+
+    process.wait()
+
+
+def git_revision():
+    """
+    this function returns the git revision of the benchmarked code, or None outside of a checkout.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='load generator and benchmark suite of the chatting application')
+    parser.add_argument('scenarios', nargs='+', choices=SCENARIOS + ['all'], help='scenarios to run one after another')
+    parser.add_argument('--clients', type=int, default=1000, help='number of simulated clients')
+    parser.add_argument('--duration', type=float, default=10, metavar='SECONDS', help='duration of each scenario')
+    parser.add_argument('--protocol', type=int, choices=[1, 2], default=2, help='protocol version of the clients')
+    parser.add_argument('--concurrency', type=int, default=256, help='number of clients connecting at the same time')
+    parser.add_argument('--group-size', type=int, default=100, help='number of members of each group chat room')
+    parser.add_argument('--message-size', type=int, default=0, metavar='CHARACTERS', help='padding of the group messages')
+    parser.add_argument('--compression', default='', metavar='METHODS',
+                        help='compression methods offered by version 2 clients, separated by commas (none by default)')
+    parser.add_argument('--hello-period', type=float, default=HELLO_PERIOD, metavar='SECONDS',
+                        help='seconds between two HELLO messages of a client in the heartbeat scenario')
+    parser.add_argument('--timeout', type=float, default=10, metavar='SECONDS', help='time to wait for each response')
+    parser.add_argument('--host', default=IP)
+    parser.add_argument('--tcp-port', type=int, default=TCP_PORT)
+    parser.add_argument('--udp-port', type=int, default=UDP_PORT)
+    parser.add_argument('--server-pid', type=int, default=None, help='pid of the server whose resources are measured')
+    parser.add_argument('--stats-port', type=int, default=None, metavar='PORT',
+                        help='stats port of the server, whose send calls are then measured (passed to a spawned server)')
+    parser.add_argument('--spawn-server', action='store_true', help='start a fresh server for each scenario')
+    parser.add_argument('--server-args', default='', help='arguments of the spawned server')
+    parser.add_argument('--output', default=None, metavar='FILE', help='write the results to a file instead of stdout')
+    args = parser.parse_args()
+
+    raise_open_file_limit()
+    scenarios = SCENARIOS if 'all' in args.scenarios else args.scenarios
+    results = []
+
+    for name in scenarios:
+        process = spawn_server(args) if args.spawn_server else None
+        pid = process.pid if process else args.server_pid
+        try:
+            results.append(asyncio.run(Scenario(name, args, ServerMonitor(pid, args.stats_port) if pid else None).run()))
+        finally:
+            if process:
+                stop_server(process, args)
+        print(f'{name}: {results[-1]["operations"]} operations, {results[-1]["throughput"]}/s, p99 {results[-1]["latency_ms"]["p99"]} ms', file=sys.stderr)
+
+    report = {'revision': git_revision(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'configuration': {key: value for key, value in vars(args).items() if key != 'scenarios'},
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,279 +1,704 @@
-import socket
-import os
-import errno
-import time
-import threading
-import random
-import string
-import select
-import logging
+"""
+client of the chatting application.
+
+a ChatClient runs on a single selectors event loop which handles the connection to the server,
+the tcp server accepting the connections of the peers of a private chat, the connections to
+those peers and the timer of the HELLO messages. every socket is non-blocking: the bytes which
+a socket does not accept right away are queued and sent once the socket is writable, so a slow
+peer never stalls the others, and every ready socket is serviced once per iteration of the loop.
+the loop sleeps in the selector until a socket is ready or the next HELLO message is due.
+
+the connections to peers are kept in a pool keyed by the address of the peer once a private chat
+ends, so that a new chat with the same peer reuses the connection instead of opening a new one.
+a pooled connection is closed when its peer closes it, when it has not been used for
+POOL_IDLE_TIMEOUT seconds, or when it is the least recently used idle connection of a pool
+holding more than POOL_MAX_CONNECTIONS connections.
+
+the client can be embedded and driven by a program: commands are sent with the methods of
+ChatClient (or with handle_input, which understands the commands typed by users), the loop is
+run with run or an iteration at a time with poll, and every line shown to the user is handed
+over to the output callback. when run as a script, the lines typed on stdin are read by the
+same event loop.
+"""
+import socket # tcp and udp sockets
+import collections # pool of the connections to the peers
+import selectors # high-level I/O multiplexing built upon the select module (epoll on linux)
+import os # non-blocking reads of stdin
+import errno # errors of non-blocking connects
+import sys # stdin
+import time # timer of the HELLO messages
+import random # server port of the client and jitter of the HELLO messages
+import string # server port of the client
+import logging # logging library to perform logging
+import argparse # command line argument parsing
+from logqueue import configure_logging, stop_logging
+from protocol import (PROTOCOL_VERSION, RECV_SIZE, COMPRESSION_METHODS, OP_LOGOUT, OP_SEARCH, OP_CHATREQUEST, OP_REJECT, OP_OK, OP_EXIT,
+                      OP_GROUPCHAT, OP_REJECTGROUP, OP_OKGROUP, OP_EXITGROUP, OP_MESSAGE, OP_HELLO, OP_REGISTERED,
+                      OP_LOGOUTSUCCESS, OP_CLIENTOK, OP_CLIENTEXIT, OP_HISTORY, OP_HISTORYEND, OP_PREFIXSEARCH, OP_SUBSCRIBE,
+                      OP_PREFIXRESULT, OP_PRESENCE, FrameBuffer, ProtocolError,
+                      encode_frame, encode_legacy, legacy_text, parse_command)
 
 # constants
 IP = '127.0.0.1'
 TCP_PORT = 6234
 UDP_PORT = 6235
-HEADER_LENGTH = 5
 STATUS_PERIOD = 6
+STATUS_JITTER = 0.1
 MAX_CONNECTIONS = 5
+POOL_IDLE_TIMEOUT = 60 # seconds after which a connection to a peer which is not used is closed
+POOL_MAX_CONNECTIONS = 16 # maximum number of connections to peers kept open
 
-# this infinite loop makes sure that an appropriate server port is assigned to a client
-while True:
-    try:
-        TCP_SERVER_PORT = int(''.join(random.choices(string.digits, k = 4)))
-        tcp_server_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
-        tcp_server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        tcp_server_socket.bind((IP, TCP_SERVER_PORT))
-        break
-    except PermissionError:
-        continue
-
-client_username = input("enter your username: ")
-client_password = input("enter your password: ")
-
-log_file = f'client_{client_username}.log' # log filename
-handlers = [logging.FileHandler(log_file, 'w'), logging.StreamHandler()]   # write to log file and stdout
-logging.basicConfig(level=logging.NOTSET,  # set root logger to NOSET 
-					handlers = handlers, # set handlers for the logger
-					format="%(asctime)s;%(levelname)s;%(message)s",  # log format
-					datefmt='%Y-%m-%d %H:%M:%S')  # date format
 logger = logging.getLogger()
 
-# AF_INET corresponds to address family IPv4
-# SOCK_STREAM corresponds to TCP
-tcp_client_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
-tcp_client_socket.connect(((IP, TCP_PORT)))
-tcp_client_socket.setblocking(False)
-
-# start listening from the tcp server of client
-tcp_server_socket.listen(MAX_CONNECTIONS)
-
-logger.info(f'TCP server of client {client_username} is running at {IP}:{TCP_SERVER_PORT} and it is listening for connections!')
-
-# a lock and data structures for handling client data
-lock = threading.Lock()
-peers = []
-sockets = [tcp_server_socket]
 
-# SOCK_DGRAM corresponds to UDP
-udp_client_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-udp_client_socket.connect(((IP, UDP_PORT)))
-udp_client_socket.setblocking(False)
-
-encoded_client_data = ('&&REGISTER&&|' + client_username + '|' + str(TCP_SERVER_PORT)).encode('utf-8')
-header = f"{len(encoded_client_data):<{HEADER_LENGTH}}".encode('utf-8')
-tcp_client_socket.send(header + encoded_client_data)
-
-logger.info(f'{client_username} has been successfully added in the server\'s database')
-
-def send_status():
+class ChatClient:
     """
-    this function is executed by a specific thread. the purpose of this function is to send
-    a HELLO message every 6 seconds to the UDP socket of the main server.
+    this class is a client of the chatting application running on its own event loop. connect
+    registers the client with the server, and the loop is then run by run or by calls to poll.
+    output is called with every line to be shown to the user (print by default).
     """
-    start_time = time.time()
-
-    while True:
 
-        end_time = time.time()
-
-        if end_time - start_time >= STATUS_PERIOD: # check if 6 secs have passed
-            # send a HELLO message and reset the timer
-            client_message = f'&&HELLO&&|{client_username}'.encode('utf-8')
-            message_header = f"{len(client_message) :< {HEADER_LENGTH}}".encode('utf-8')
-            udp_client_socket.sendto(message_header + client_message, (IP, UDP_PORT))
-            start_time = time.time()
-            logger.info(f'sending HELLO message to UDP socket of server for user with id - {client_username}')
+    def __init__(self, username, server_tcp_port=TCP_PORT, server_udp_port=UDP_PORT,
+                 status_period=STATUS_PERIOD, status_jitter=STATUS_JITTER, output=print):
+        self.username = username
+        self.server_tcp_port = server_tcp_port
+        self.server_udp_port = server_udp_port
+        self.status_period = status_period
+        self.status_jitter = status_jitter
+        self.output = output
+
+        self.selector = selectors.DefaultSelector()
+        self.running = False
+        self.server_port = None # port of the tcp server accepting the connections of the peers
+        self.server_socket = None # connection to the server
+        self.server_buffer = FrameBuffer() # holds the bytes received from the server
+        self.compression = '' # compression method negotiated with the server, empty if none
+        self.listening_socket = None # tcp server accepting the connections of the peers
+        self.udp_socket = None # sends the HELLO messages
+        self.peers = [] # connections to the peers of the private chat, messages are sent to them
+        self.peer_compression = {} # connection to a peer -> compression method of the peer, empty if none
+        self.pool = collections.OrderedDict() # peer address -> connection to the peer, least recently used first
+        self.idle = {} # peer address -> monotonic time since which its pooled connection is not used
+        self.pool_stats = {'opened': 0, 'reused': 0, 'expired': 0, 'evicted': 0}
+        self.peer_buffers = {} # accepted peer socket -> FrameBuffer holding the bytes received from the peer
+        self.pending = {} # socket -> bytes not accepted by the socket yet
+        self.next_hello = 0 # monotonic time of the next HELLO message
+        self.history_cursor = '' # cursor of the previous page of the room history, empty if there is none
+
+    def connect(self):
+        """
+        this function opens the tcp server of the client on a random port, connects to the
+        server and registers with a version 1 message holding the highest protocol version and the
+        compression methods known by the client. a ConnectionError is raised if the server does not
+        support version 2.
+        """
+        # this infinite loop makes sure that an appropriate server port is assigned to a client
+        while True:
+            try:
+                self.server_port = int(''.join(random.choices(string.digits, k = 4)))
+                self.listening_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+                self.listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.listening_socket.bind((IP, self.server_port))
+                break
+            except OSError: # the port is not available
+                self.listening_socket.close()
+                continue
+
+        # AF_INET corresponds to address family IPv4
+        # SOCK_STREAM corresponds to TCP
+        self.server_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+        self.server_socket.connect(((IP, self.server_tcp_port)))
+
+        # start listening from the tcp server of client
+        self.listening_socket.listen(MAX_CONNECTIONS)
+        logger.info(f'TCP server of client {self.username} is running at {IP}:{self.server_port} and it is listening for connections!')
+
+        # SOCK_DGRAM corresponds to UDP
+        self.udp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self.udp_socket.connect(((IP, self.server_udp_port)))
+        self.udp_socket.setblocking(False)
+
+        self.server_socket.send(encode_legacy(f'&&REGISTER&&|{self.username}|{self.server_port}|{PROTOCOL_VERSION}|'
+                                              f'{",".join(COMPRESSION_METHODS)}'))
+
+        # the server answers with its username frame followed by the negotiated protocol version
+        # and compression method, which is missing if no compression has been negotiated
+        registration = []
+        while len(registration) < 2:
+            frame = self.server_buffer.next_frame()
+            if frame is None:
+                data = self.server_socket.recv(RECV_SIZE)
+                if not len(data):
+                    raise ConnectionError('the server has closed the connection')
+                self.server_buffer.feed(data)
+                continue
+            registration.append(parse_command(*frame))
+
+        opcode, fields = registration[1]
+        if opcode != OP_REGISTERED or int(fields[0]) < 2:
+            raise ConnectionError('the server does not support protocol version 2')
+
+        self.server_buffer.version = int(fields[0])
+        self.compression = fields[1] if len(fields) > 1 else ''
+        logger.info(f'{self.username} has been successfully added in the server\'s database')
+
+        self.server_socket.setblocking(False)
+        self.listening_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ, self.receive_server_message)
+        self.selector.register(self.listening_socket, selectors.EVENT_READ, self.accept_peer)
+
+        self.next_hello = time.monotonic()
+        self.schedule_hello()
+        self.running = True
+
+        # frames received along with the registration answer
+        self.dispatch_server_frames()
+
+    def close(self):
+        """
+        this function stops the event loop and closes every socket of the client.
+        """
+        self.running = False
+        for key in list(self.selector.get_map().values()):
+            self.selector.unregister(key.fileobj)
+            if isinstance(key.fileobj, socket.socket):
+                key.fileobj.close()
+        for peer_socket in self.pool.values():
+            peer_socket.close()
+        self.peers.clear()
+        self.peer_compression.clear()
+        self.pool.clear()
+        self.idle.clear()
+        self.pending.clear()
+        if self.udp_socket is not None:
+            self.udp_socket.close()
+
+    def run(self):
+        """
+        this function runs the event loop until the client logs out, is closed or loses its
+        connection to the server.
+        """
+        while self.running:
+            deadline = min([self.next_hello] + [since + POOL_IDLE_TIMEOUT for since in self.idle.values()])
+            self.poll(max(0, deadline - time.monotonic()))
+
+    def poll(self, timeout=0):
+        """
+        this function runs a single iteration of the event loop. it waits up to timeout seconds
+        for a socket to be ready, handles every ready socket once, sends the HELLO message if it
+        is due and closes the pooled connections which have been idle for too long.
+        """
+        for key, mask in self.selector.select(timeout):
+            if mask & selectors.EVENT_WRITE:
+                self.flush(key.fileobj)
+            if mask & selectors.EVENT_READ and self.selector.get_map().get(key.fd) is key: # not dropped meanwhile
+                key.data(key.fileobj)
+
+        if self.running and time.monotonic() >= self.next_hello:
+            self.send_status()
+
+        if self.idle:
+            self.expire_peers()
+
+    def schedule_hello(self):
+        # each period is shortened by a random jitter so that clients started together do not
+        # send their HELLO messages in bursts, and the deadlines are computed on the monotonic
+        # clock so that they never drift
+        self.next_hello += self.status_period * (1 - random.uniform(0, self.status_jitter))
+
+    def send_status(self):
+        """
+        this function sends a HELLO message to the UDP socket of the main server and schedules
+        the next one.
+        """
+        try:
+            self.udp_socket.send(encode_frame(OP_HELLO, self.username))
+            logger.info(f'sending HELLO message to UDP socket of server for user with id - {self.username}')
+        except OSError: # the message is lost, as any datagram could be
+            logger.warning(f'sending HELLO message failed for user with id - {self.username}')
+
+        self.schedule_hello()
+
+    def send(self, sock, data):
+        """
+        this function sends bytes to a socket without ever blocking. whatever the socket does not
+        accept is queued and sent once the socket is writable.
+        """
+        if sock in self.pending:
+            self.pending[sock] += data
+            return
 
-def send_message():
-    """
-    this function is executed by a specific thread. the purpose of this function is to take
-    users input at each iteration and take some necessary actions. by default, the user's 
-    message is considered a normal text message. however, if the function finds out some
-    specific words in a user message (i.e., SEARCH, CHAT REQUEST, etc.), then it will change
-    the receiver of the message.
-    """
-    while True:
-        server_message = False
-        ok_group = False
-        reject_group = False
+        try:
+            sent = sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as error:
+            self.drop_socket(sock, error)
+            return
+
+        if sent < len(data):
+            self.pending[sock] = bytearray(data[sent:])
+            self.watch(sock)
+
+    def flush(self, sock):
+        """
+        this function is called by the event loop whenever a socket with queued bytes is writable.
+        """
+        data = self.pending.get(sock)
+        if data is None:
+            return
 
-        client_message = f"{client_username}: {input()}"
-        client_message = '&&MESSAGE&&|' + client_message
+        try:
+            sent = sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as error:
+            self.drop_socket(sock, error)
+            return
+
+        del data[:sent]
+        if not data:
+            del self.pending[sock]
+            self.watch(sock)
+
+    def watch(self, sock):
+        """
+        this function registers a socket for write events while bytes are queued for it, in
+        addition to the read events of the sockets the client reads from.
+        """
+        events = selectors.EVENT_WRITE if sock in self.pending else 0
+        key = self.selector.get_map().get(sock)
+        if key is not None and key.data is not None:
+            events |= selectors.EVENT_READ
+
+        if key is None:
+            if events:
+                self.selector.register(sock, events)
+        elif not events:
+            self.selector.unregister(sock)
+        elif key.events != events:
+            self.selector.modify(sock, events, key.data)
+
+    def drop_socket(self, sock, error=None):
+        """
+        this function closes the connection to a peer (or to the server) which has failed.
+        """
+        if sock is self.server_socket:
+            logger.error(f'the connection to the server has been lost: {error}')
+            self.close()
+            return
+
+        logger.info(f'the connection to a peer has been closed: {error}')
+        self.pending.pop(sock, None)
+        self.peer_buffers.pop(sock, None)
+        self.peer_compression.pop(sock, None)
+        if sock in self.selector.get_map():
+            self.selector.unregister(sock)
+        if sock in self.peers:
+            self.peers.remove(sock)
+        for address, peer_socket in list(self.pool.items()):
+            if peer_socket is sock:
+                del self.pool[address]
+                self.idle.pop(address, None)
+        sock.close()
+
+    def send_command(self, opcode, *fields):
+        """
+        this function sends a command to the server, compressed if it is worth it.
+        """
+        self.send(self.server_socket, encode_frame(opcode, *fields, compression=self.compression))
+
+    def search(self, peer_username):
+        self.send_command(OP_SEARCH, peer_username, self.username)
+
+    def prefix_search(self, prefix, limit=''):
+        self.send_command(OP_PREFIXSEARCH, prefix, str(limit))
+
+    def subscribe(self, *peer_usernames):
+        self.send_command(OP_SUBSCRIBE, *peer_usernames)
+
+    def chat_request(self, peer_username):
+        self.send_command(OP_CHATREQUEST, peer_username, self.username)
+
+    def accept_chat(self, peer_username):
+        self.send_command(OP_OK, self.username, peer_username, str(self.server_port))
+
+    def reject_chat(self, peer_username):
+        self.send_command(OP_REJECT, self.username, peer_username)
+
+    def exit_chat(self):
+        self.send_command(OP_EXIT, self.username)
+
+    def group_chat(self, *peer_usernames):
+        self.send_command(OP_GROUPCHAT, self.username, *peer_usernames)
+
+    def accept_group(self, group_number):
+        self.send_command(OP_OKGROUP, self.username, group_number)
+
+    def reject_group(self, group_number):
+        self.send_command(OP_REJECTGROUP, self.username, group_number)
+
+    def exit_group(self):
+        self.send_command(OP_EXITGROUP, self.username)
+
+    def history(self, count='', more=False):
+        self.send_command(OP_HISTORY, str(count), self.history_cursor if more else '')
+
+    def logout(self):
+        self.send_command(OP_LOGOUT)
+
+    def send_message(self, text):
+        """
+        this function sends a text message, to the peers of the private chat the client is in,
+        or else to the server, which forwards it to the group chat room the client is in.
+        """
+        client_message = f'{self.username}: {text}'
+
+        if self.peers:
+            # peers talk to each other with version 1 frames, compressed with the method of each
+            # peer, and the message is encoded once per method
+            self.output(client_message)
+            peer_messages = {}
+            for peer_socket in list(self.peers):
+                compression = self.peer_compression.get(peer_socket, '')
+                if compression not in peer_messages:
+                    peer_messages[compression] = encode_legacy(legacy_text(OP_MESSAGE, [client_message]), compression)
+                self.send(peer_socket, peer_messages[compression])
+        else:
+            self.send_command(OP_MESSAGE, client_message)
+
+    def handle_input(self, line):
+        """
+        this function takes a line typed by the user and takes some necessary actions. by default,
+        the user's message is considered a normal text message. however, if the function finds out
+        some specific words in a user message (i.e., SEARCH, CHAT REQUEST, etc.), then it will
+        change the receiver of the message.
+        """
+        client_message = f'{self.username}: {line}'
         message_content = ' '.join(client_message.split(':')[1:]).strip()
+        last_token = client_message.split(' ')[-1].strip()
+        tokens = message_content.split()
+
+        # when several words are found, the command tested first wins
+        if message_content.startswith('HISTORY'): # HISTORY [count] shows the last messages, HISTORY MORE [count] older ones
+            self.history(tokens[-1] if tokens[-1].isdigit() else '', 'MORE' in tokens)
+        elif message_content.startswith('PREFIX SEARCH'): # PREFIX SEARCH <prefix> [count] lists the matching usernames
+            self.prefix_search(tokens[2] if len(tokens) > 2 else '', tokens[3] if len(tokens) > 3 else '')
+        elif message_content.startswith('SUBSCRIBE'): # SUBSCRIBE [usernames...] replaces the users whose presence is followed
+            self.subscribe(*tokens[1:])
+        elif message_content == 'EXIT GROUP':
+            self.exit_group()
+        elif message_content == 'EXIT':
+            self.exit_chat()
+        elif 'OK' in message_content and 'OK GROUP' not in message_content:
+            self.accept_chat(last_token)
+        elif 'REJECT' in message_content and 'REJECT GROUP' not in message_content:
+            self.reject_chat(last_token)
+        elif 'CHAT REQUEST' in message_content:
+            self.chat_request(last_token)
+        elif 'OK GROUP' in message_content:
+            self.accept_group(last_token)
+        elif 'REJECT GROUP' in message_content:
+            self.reject_group(last_token)
+        elif 'GROUP CHAT' in message_content:
+            self.group_chat(*tokens[2:])
+        elif 'SEARCH' in message_content:
+            self.search(last_token)
+        elif message_content == 'LOGOUT':
+            self.logout()
+        else:
+            self.send_message(line)
+
+    def receive_server_message(self, server_socket):
+        """
+        this function is called by the event loop whenever the connection to the server has
+        something to be read. the received bytes are kept in a frame buffer until complete
+        messages can be taken from it.
+        """
+        try:
+            data = server_socket.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as error:
+            self.drop_socket(server_socket, error)
+            return
+
+        if not len(data):
+            self.drop_socket(server_socket, 'the server has closed the connection')
+            return
+
+        self.server_buffer.feed(data)
+        self.dispatch_server_frames()
+
+    def dispatch_server_frames(self):
+        frame = self.server_buffer.next_frame()
+        while frame is not None and self.running:
+            self.show_server_message(*parse_command(*frame))
+            frame = self.server_buffer.next_frame()
+
+    def show_server_message(self, opcode, fields):
+        """
+        this function gets the opcode and the fields of a message received from the server, takes
+        the necessary actions and shows the message to the client. the first field of each message
+        is the username of the client which has caused the message.
+        """
+        username = fields[0]
+        message = fields[1] if len(fields) > 1 else ''
+
+        if opcode == OP_LOGOUTSUCCESS: # if logout is successful, stop the event loop
+            logger.info(f'loggin out from session. goodbye {self.username}')
+            self.close()
+            return
+
+        elif opcode == OP_CLIENTOK: # if a chat session is starting, connect user's socket to each other's tcp server
+            self.connect_peer(int(fields[2]), fields[3] if len(fields) > 3 else '')
+
+        elif opcode == OP_CLIENTEXIT: # if a client is exiting, give the connections to the peers back to the pool
+            self.release_peers()
+
+        elif opcode == OP_HISTORY: # a chunk of the history of a room: room, then timestamp, sender and text of each message
+            for index in range(2, len(fields) - 2, 3):
+                self.output(f"[{time.strftime('%H:%M:%S', time.localtime(float(fields[index])))}] {fields[index + 2]}")
+            return
+
+        elif opcode == OP_PREFIXRESULT: # prefix, then the matching usernames
+            matches = ', '.join(fields[2:]) if len(fields) > 2 else 'none'
+            self.output(f'server: users starting with "{fields[1]}": {matches}')
+            return
+
+        elif opcode == OP_PRESENCE: # online or offline, then the usernames whose presence has changed
+            self.output(f"server: {', '.join(fields[2:])} {'is' if len(fields) == 3 else 'are'} {fields[1]}")
+            return
+
+        elif opcode == OP_HISTORYEND: # end of a history page: room, cursor of the previous page and number of messages
+            self.history_cursor = fields[2]
+            more = ' type HISTORY MORE to see older messages.' if self.history_cursor else ''
+            self.output(f'server: {fields[3]} messages of group chat {fields[1]}.{more}')
+            return
 
-        if message_content == 'LOGOUT':
-            client_message = '&&LOGOUT&&'
-            server_message = True
-
-        if 'SEARCH' in message_content:
-            searched_peer = client_message.split(' ')[-1].strip()
-            client_message = f'&&SEARCH&&|{searched_peer}|{client_username}'
-            server_message = True
-
-        if 'GROUP CHAT' in message_content:
-            tokens = message_content.split()
-            client_message = f'&&GROUPCHAT&&|{client_username}|'
-            server_message = True
-            for i in range(2, len(tokens)):
-                client_message += tokens[i] + '|'
-
-        if 'REJECT GROUP' in message_content:
-            group_number = client_message.split(' ')[-1]
-            client_message = f'&&REJECTGROUP&&|{client_username}|{group_number}'
-            reject_group = True
-            server_message = True
-
-        if 'OK GROUP' in message_content:
-            group_number = client_message.split(' ')[-1]
-            client_message = f'&&OKGROUP&&|{client_username}|{group_number}'
-            ok_group = True
-            server_message = True
-
-        if 'CHAT REQUEST' in message_content:
-            searched_peer = client_message.split(' ')[-1].strip()
-            client_message = f'&&CHATREQUEST&&|{searched_peer}|{client_username}'
-            server_message = True
-
-        if 'REJECT' in message_content and not reject_group:
-            sender_username = client_message.split(' ')[-1]
-            client_message = f'&&REJECT&&|{client_username}|{sender_username}'
-            server_message = True
-
-        if 'OK' in message_content and not ok_group:
-            sender_username = client_message.split(' ')[-1]
-            client_message = f'&&OK&&|{client_username}|{sender_username}|{TCP_SERVER_PORT}'
-            server_message = True
-        
-        if message_content == 'EXIT':
-            client_message = f'&&EXIT&&|{client_username}'
-            server_message = True
-
-        if message_content == 'EXIT GROUP':
-            client_message = f'&&EXITGROUP&&|{client_username}'
-            server_message = True
-
-        client_message = client_message.encode('utf-8')
-        message_header = f"{len(client_message) :< {HEADER_LENGTH}}".encode('utf-8')
-
-        if server_message:
-            tcp_client_socket.send(message_header + client_message)
-        
-        lock.acquire()
-        if peers == [] and '&&MESSAGE&&' in client_message.decode('utf-8'):
-            tcp_client_socket.send(message_header + client_message)
-        lock.release()
-
-        lock.acquire()
-        if not server_message and peers != []:
-            print(' '.join(client_message.decode('utf-8').split('|')[1:]).strip())
-            for socket_ in peers:
-                socket_.send(message_header + client_message)
-        lock.release()
-
-def receive_server_message():
-    """
-    this function is executed by a thread. the purpose of this function is to receive
-    server messages, extract message body and show them to client.
-    """
-    while True:
+        if ':' in message:
+            message = ' '.join(message.split(':')[1:]).strip()
+        else:
+            username = 'server'
+
+        self.output(f'{username}: {message}')
+
+    def connect_peer(self, peer_port, compression=''):
+        """
+        this function adds the connection to the tcp server of a peer to the peers of the private
+        chat. a pooled connection to the peer is reused, else a non-blocking connection is started
+        and added to the pool. the messages sent to the peer before the connection is established
+        are queued until it is writable. they are compressed with the compression method of the
+        peer, if any.
+        """
+        address = (IP, peer_port)
+        peer_socket = self.pool.get(address)
+
+        if peer_socket is not None:
+            self.pool.move_to_end(address)
+            self.idle.pop(address, None)
+            self.pool_stats['reused'] += 1
+            logger.info(f'reusing the connection to the peer at {IP}:{peer_port}')
+        else:
+            peer_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+            peer_socket.setblocking(False)
+            result = peer_socket.connect_ex(address)
+            if result not in (0, errno.EINPROGRESS):
+                logger.error(f'connecting to the peer at {IP}:{peer_port} failed: {os.strerror(result)}')
+                peer_socket.close()
+                return
+
+            # the connection is watched for reads to notice when the peer closes it
+            self.pending[peer_socket] = bytearray()
+            self.selector.register(peer_socket, selectors.EVENT_READ | selectors.EVENT_WRITE, self.check_peer)
+            self.pool[address] = peer_socket
+            self.pool_stats['opened'] += 1
+            self.evict_peers()
+
+        self.peers.append(peer_socket)
+        self.peer_compression[peer_socket] = compression
+
+    def release_peers(self):
+        """
+        this function is called when a private chat ends. the connections to its peers are kept
+        open in the pool, idle, until they are used by another chat or expire.
+        """
+        now = time.monotonic()
+        for peer_socket in self.peers:
+            for address, pooled_socket in self.pool.items():
+                if pooled_socket is peer_socket:
+                    self.idle[address] = now
+        self.peers.clear()
+
+    def evict_peers(self):
+        """
+        this function closes the least recently used idle connections of the pool while it holds
+        more than POOL_MAX_CONNECTIONS connections.
+        """
+        for address in list(self.pool):
+            if len(self.pool) <= POOL_MAX_CONNECTIONS:
+                break
+            if address in self.idle:
+                self.pool_stats['evicted'] += 1
+                self.drop_socket(self.pool[address], 'the connection pool is full')
+
+    def expire_peers(self):
+        """
+        this function closes the pooled connections which have been idle for POOL_IDLE_TIMEOUT
+        seconds.
+        """
+        now = time.monotonic()
+        for address, since in list(self.idle.items()):
+            if now - since >= POOL_IDLE_TIMEOUT:
+                self.pool_stats['expired'] += 1
+                self.drop_socket(self.pool[address], 'the connection has been idle for too long')
+
+    def check_peer(self, peer_socket):
+        """
+        this function is called by the event loop whenever a connection to a peer is readable,
+        which happens when the peer closes it since peers never send anything on the connections
+        they have accepted.
+        """
+        try:
+            data = peer_socket.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as error:
+            self.drop_socket(peer_socket, error)
+            return
+
+        if not len(data):
+            self.drop_socket(peer_socket, 'the peer has closed the connection')
+
+    def accept_peer(self, listening_socket):
+        """
+        this function is called by the event loop whenever a peer connects to the tcp server of
+        the client.
+        """
         try:
-            while True:
-                username_header = tcp_client_socket.recv(HEADER_LENGTH)
-                username_length = int(username_header.decode('utf-8'))
-                username = tcp_client_socket.recv(username_length).decode('utf-8')
-
-                message_header = tcp_client_socket.recv(HEADER_LENGTH)
-                message_length = int(message_header.decode('utf-8'))
-                message = tcp_client_socket.recv(message_length).decode('utf-8')
-
-                if '&&LOGOUTSUCCESS&&' in message: # if logout is successful, kill the process using SIGKILL
-                    logger.info(f'loggin out from session. goodbye {client_username}')
-                    os.kill(os.getpid(), 9)
-
-                elif '&&CLIENTOK&&' in message: # if a chat session is starting, connect user's socket to each other's tcp server
-                    receiver_port = int(message.split('|')[-1].strip())
-                    message = message.split('|')[1].strip()
-                    tcp_client_peer_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
-                    tcp_client_peer_socket.connect(((IP, receiver_port)))
-                    tcp_client_peer_socket.setblocking(False)
-
-                    # change the list 'peers' in a lock since it is changed in more than one thread
-                    lock.acquire()
-                    peers.append(tcp_client_peer_socket)
-                    lock.release()
-
-                elif '&&CLIENTEXIT' in message: # if a client is exiting, clear out the peers dict
-                    # change the list 'peers' in a lock since it is changed in more than one thread
-                    lock.acquire()
-                    peers.clear()
-                    lock.release()
-                    message = message.split('|')[1].strip()
-
-                elif '&&NOTFOUND&&' in message or '&&INVALIDSEARCH&&' in message or '&&FOUND&&' in message or '&&BUSY&&' in message:
-                    message = message.split('|')[1].strip()
-
-                if ':' in message:
-                    message = ' '.join(message.split(':')[1:]).strip()
-                else:
-                    username = 'server'
-
-                print(f'{username}: {message}')
-
-        except IOError as e:
-            if e.errno != errno.EAGAIN and e.errno != errno.EWOULDBLOCK:
-                logger.error('the process committed an unexpected exception. exiting!!!')
-                exit()
-            continue
-
-        except Exception:
-            logger.error('the process committed an unexpected exception. exiting!!!')
-            exit()
-
-def receive_peer_message():
+            peer_socket, peer_address = listening_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+
+        peer_socket.setblocking(False)
+        self.peer_buffers[peer_socket] = FrameBuffer()
+        self.selector.register(peer_socket, selectors.EVENT_READ, self.receive_peer_message)
+
+    def receive_peer_message(self, peer_socket):
+        """
+        this function is called by the event loop whenever a connection accepted from a peer has
+        something to be read. the messages are kept in a frame buffer per peer until they are
+        complete, and they are decompressed if the peer has compressed them.
+        """
+        try:
+            data = peer_socket.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as error:
+            self.drop_socket(peer_socket, error)
+            return
+
+        if not len(data): # the peer has closed the connection
+            self.drop_socket(peer_socket, 'the peer has closed the connection')
+            return
+
+        buffer = self.peer_buffers[peer_socket]
+        buffer.feed(data)
+        frame = buffer.next_frame()
+
+        while frame is not None:
+            try:
+                opcode, fields = parse_command(*frame)
+            except (ProtocolError, UnicodeDecodeError) as error:
+                self.drop_socket(peer_socket, error)
+                return
+            logger.info(f'{self.username} received a new message from another peer with address {peer_socket.getpeername()}')
+
+            self.output(fields[0] if fields else '')
+            frame = buffer.next_frame()
+
+
+class InputReader:
     """
-    this function is executed by a thread. the purpose of this function is to receive messages
-    from other peers during P2P messaging. the messages are received by the receiver client's 
-    TCP server.
+    this class reads the lines typed by the user from stdin. stdin is read with os.read rather
+    than through sys.stdin, whose buffer would hide lines from the selector. once attached to a
+    client, stdin is read by the event loop of the client, every line is handed over to the
+    client and the client logs out and is closed at the end of the input.
     """
-    while True:
-        # select.select will make use of OS and it will wait until a file descriptor is ready for IO
-        read_sockets, useless, exceptional_sockets = select.select(sockets, [], sockets)
-
-        if tcp_server_socket in read_sockets: # if a new connection is made, add client's socket to a list
-            socket_, client_address = tcp_server_socket.accept()
-            sockets.append(socket_)
-        else: # else retrieve the client's socket
-            socket_ = read_sockets[0]
-
-        message_header = socket_.recv(HEADER_LENGTH) # receive the message header
-
-        if not len(message_header):
-            return False
 
-        # use the message header to retrieve the message data and print it
-        message_length = int(message_header.decode('utf-8'))
-        message = socket_.recv(message_length).decode('utf-8')
-
-        logger.info(f'{client_username} received a new message from another peer with address {socket_.getpeername()}')
-
-        if ':' in message:
-            message = ' '.join(message.split('|')[1:]).strip()
-
-        print(message)
-
-
-send_thread = threading.Thread(target=send_message)
-send_thread.start()
-logger.info('successfully started send message thread')
+    def __init__(self):
+        self.buffer = b''
+        self.client = None
+
+    def readline(self, prompt):
+        """
+        this function shows a prompt and blocks until a line is typed, before the event loop runs.
+        """
+        print(prompt, end='', flush=True)
+        while b'\n' not in self.buffer:
+            data = os.read(sys.stdin.fileno(), RECV_SIZE)
+            if not data:
+                break
+            self.buffer += data
+
+        line, separator, self.buffer = self.buffer.partition(b'\n')
+        return line.decode('utf-8')
+
+    def attach(self, client):
+        self.client = client
+        client.selector.register(sys.stdin, selectors.EVENT_READ, self.read)
+        self.handle_lines()
+
+    def read(self, stdin):
+        data = os.read(stdin.fileno(), RECV_SIZE)
+        if not data:
+            # the server ignores a LOGOUT from a client in a chat room, hence the client does
+            # not wait for LOGOUTSUCCESS: closing the connection ends its session and room anyway
+            self.client.selector.unregister(stdin)
+            self.client.logout()
+            self.client.close()
+            return
+
+        self.buffer += data
+        self.handle_lines()
+
+    def handle_lines(self):
+        *lines, self.buffer = self.buffer.split(b'\n')
+        for line in lines:
+            self.client.handle_input(line.decode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='client of the chatting application')
+    parser.add_argument('--status-period', type=float, default=STATUS_PERIOD, metavar='SECONDS',
+                        help='seconds between two HELLO messages sent to the server')
+    parser.add_argument('--status-jitter', type=float, default=STATUS_JITTER, metavar='FRACTION',
+                        help='each period is shortened by a random fraction of itself up to this value')
+    parser.add_argument('--server-tcp-port', type=int, default=TCP_PORT, help='TCP port of the server (or of a node of a federation)')
+    parser.add_argument('--server-udp-port', type=int, default=UDP_PORT, help='UDP port of the server receiving the HELLO messages')
+    parser.add_argument('--log-mode', choices=['queue', 'sync'], default='queue',
+                        help='write the logs from a background thread or from the thread logging them')
+    args = parser.parse_args()
+
+    input_reader = InputReader()
+    client_username = input_reader.readline("enter your username: ")
+    client_password = input_reader.readline("enter your password: ")
+
+    log_file = f'client_{client_username}.log' # log filename
+    configure_logging(log_file, args.log_mode) # write to log file and stderr
+
+    client = ChatClient(client_username, args.server_tcp_port, args.server_udp_port, args.status_period, args.status_jitter)
+    try:
+        client.connect()
+    except ConnectionError as error:
+        logger.error(f'{error}. exiting!!!')
+        stop_logging()
+        sys.exit(1)
 
-receive_server_thread = threading.Thread(target=receive_server_message)
-receive_server_thread.start()
-logger.info('successfully started receive server message thread')
+    input_reader.attach(client)
+    logger.info('successfully started the event loop')
+    client.run()
 
-recieve_peer_thread = threading.Thread(target=receive_peer_message)
-recieve_peer_thread.start()
-logger.info('successfully started receive peer message thread')
 
-status_thread = threading.Thread(target=send_status)
-status_thread.start()
-logger.info('successfully started send status thread')
+if __name__ == '__main__':
+    main()
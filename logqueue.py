@@ -0,0 +1,165 @@
+"""
+logging pipeline shared by the server and the clients.
+
+in the queue mode, the threads of the application only put their log records in a bounded queue,
+and a background writer thread takes them out in batches, formats them and writes each batch to
+the log file and to stderr with a single write and flush. when the queue is full, records are
+dropped instead of blocking the application, and the number of dropped records is logged as
+soon as the queue has room again. in the sync mode, records are written by the logging thread
+itself, as the standard logging handlers do.
+
+high-frequency events such as heartbeats are rate-limited by a LogSampler before their records
+are even created.
+"""
+import atexit # flush the queue when the program exits
+import logging # standard logging library
+import logging.handlers # queue handler
+import queue # bounded queue between the application and the writer
+import sys # stderr stream
+import threading # writer thread
+import time # windows of the log samplers
+
+LOG_FORMAT = '%(asctime)s;%(levelname)s;%(message)s'
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+LOG_QUEUE_SIZE = 10000 # records waiting to be written, above which new records are dropped
+LOG_BATCH_SIZE = 512 # maximum number of records written at once
+
+writer = None # LogWriter of the queue mode
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    this class puts log records in a bounded queue without ever blocking. records which do not
+    fit in the queue are counted, and a warning holding their number is queued before the next
+    record which fits.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0 # records dropped since the last warning
+
+    def prepare(self, record):
+        # the record is formatted by the writer thread, not by the thread logging it
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({'levelno': logging.WARNING, 'levelname': 'WARNING',
+                                                             'msg': f'{self.dropped} log records have been dropped'}))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogWriter:
+    """
+    this class is the background thread writing the queued log records to the given streams.
+    it blocks until a record arrives, then takes every queued record up to LOG_BATCH_SIZE and
+    writes them with a single write and flush per stream.
+    """
+
+    def __init__(self, log_queue, streams):
+        self.queue = log_queue
+        self.streams = streams
+        self.formatter = logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT)
+        self.thread = threading.Thread(target=self.run, name='log-writer', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        running = True
+
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch: # stop once the records queued before the sentinel are written
+                batch = batch[:batch.index(None)]
+                running = False
+
+            text = ''.join(self.formatter.format(record) + '\n' for record in batch)
+            for stream in self.streams:
+                try:
+                    stream.write(text)
+                    stream.flush()
+                except (OSError, ValueError): # the stream has been closed
+                    pass
+
+    def stop(self):
+        """
+        this function writes the records which are still queued and stops the thread.
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+
+
+class LogSampler:
+    """
+    this class rate-limits a kind of log records to rate records per second. allow returns
+    whether a record may be logged now, and suppressed returns a note about the records which
+    have been suppressed since the last allowed record, to be appended to its message.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.window = 0 # start of the current one second window
+        self.count = 0 # records allowed in the current window
+        self.skipped = 0 # records suppressed since the last allowed record
+
+    def allow(self):
+        now = time.monotonic()
+        if now - self.window >= 1:
+            self.window = now
+            self.count = 0
+
+        if self.count < self.rate:
+            self.count += 1
+            return True
+
+        self.skipped += 1
+        return False
+
+    def suppressed(self):
+        skipped, self.skipped = self.skipped, 0
+        return f' ({skipped} similar messages suppressed)' if skipped else ''
+
+
+def configure_logging(log_file, mode='queue', append=False):
+    """
+    this function configures the root logger so that every record is written both to the given
+    log file and to stderr, either through the queue and the writer thread (queue mode) or
+    directly by the logging thread (sync mode). the log file is truncated unless append is True.
+    """
+    global writer
+
+    file_mode = 'a' if append else 'w'
+    if mode == 'sync':
+        handlers = [logging.FileHandler(log_file, file_mode), logging.StreamHandler()] # write to log file and stderr
+    else:
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        writer = LogWriter(log_queue, [open(log_file, file_mode), sys.stderr])
+        writer.start()
+        atexit.register(stop_logging)
+        handlers = [DroppingQueueHandler(log_queue)]
+
+    logging.basicConfig(level=logging.NOTSET, # set root logger to NOSET
+                        handlers=handlers, # set handlers for the logging
+                        format=LOG_FORMAT, # log format
+                        datefmt=LOG_DATE_FORMAT) # date format
+
+
+def stop_logging():
+    """
+    this function writes the records which are still queued and stops the writer thread. it must
+    be called before a process exits without running its exit handlers (os._exit, SIGKILL).
+    """
+    if writer is not None:
+        writer.stop()
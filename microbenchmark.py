@@ -0,0 +1,182 @@
+"""
+in-process micro benchmarks of the server.
+
+unlike benchmark.py, which drives a running server over sockets, these benchmarks import the
+server module and measure its data structures directly, so that they can be run at sizes no
+load generator could reach on a single machine:
+
+    sessions   memory of the session table: bytes per registered user, measured with
+               tracemalloc while COUNT users are registered
+    dispatch   frames per second through the frame parser and the command dispatcher alone:
+               FRAMES frames of each workload are fed to the frame buffer of a simulated client
+               and dispatched, with responses sent to sockets discarding them
+    directory  username directory of COUNT random usernames: insertions per second, and prefix
+               searches per second compared to a scan of every username
+
+the results are printed as a JSON document, as benchmark.py does.
+
+    python microbenchmark.py sessions --count 100000
+    python microbenchmark.py dispatch --frames 200000
+    python microbenchmark.py directory --count 100000
+"""
+import argparse # command line argument parsing
+import itertools # frames of the workloads
+import json # output format of the results
+import logging # the server logs every registration
+import random # usernames and prefixes of the directory benchmark
+import string # usernames and prefixes of the directory benchmark
+import time # timestamp of the report
+import tracemalloc # memory allocated by the session table
+import server # module whose data structures are measured
+from benchmark import git_revision # revision of the benchmarked code
+from protocol import (OP_REGISTER, OP_SEARCH, OP_MESSAGE, OP_REJECT, FrameBuffer, encode_frame, encode_legacy,
+                      legacy_text) # frames of the simulated users
+
+BENCHMARKS = ['sessions', 'dispatch', 'directory']
+GROUP_SIZE = 10 # members of the group chat room of the message workloads
+DISPATCH_RUNS = 5 # runs of each dispatch workload
+DIRECTORY_SEARCHES = 10000 # prefix searches of the directory benchmark
+DIRECTORY_SCANS = 20 # scans of every username the prefix searches are compared to
+
+# workloads of the dispatch benchmark: protocol version, whether the client is in its chat room
+# and commands sent in turn
+DISPATCH_WORKLOADS = {
+    'search-v1': (1, False, [(OP_SEARCH, ['user1', 'user0']), (OP_SEARCH, ['nobody', 'user0'])]),
+    'search-v2': (2, False, [(OP_SEARCH, ['user1', 'user0']), (OP_SEARCH, ['nobody', 'user0'])]),
+    'message-v1': (1, True, [(OP_MESSAGE, ['user0: hello everyone'])]),
+    'message-v2': (2, True, [(OP_MESSAGE, ['user0: hello everyone'])]),
+    'unhandled-v1': (1, True, [(OP_REJECT, ['user0', 'user1'])]), # a command the client may not send in a room
+}
+
+
+class DiscardingSocket:
+    """
+    this class stands for the socket of a simulated client. it accepts and discards everything
+    sent to it, so that only the server side of a command is measured.
+    """
+
+    def sendmsg(self, buffers):
+        return sum(len(buffer) for buffer in buffers)
+
+    def close(self):
+        pass
+
+
+def bench_sessions(args):
+    """
+    this function registers count users in the session table of the server, as handle_registration
+    does, and returns the memory allocated per user by the session records alone and by the
+    whole table (records, username and address indexes and activity deadlines). the keys of the
+    table, which are sockets in the server, are allocated beforehand.
+    """
+    keys = [object() for _ in range(args.count)]
+    messages = [[f'user{index:06d}', str(1000 + index % 9000), '2'] for index in range(args.count)]
+
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    sessions = [server.build_client(OP_REGISTER, fields) for fields in messages]
+    records = tracemalloc.get_traced_memory()[0] - start
+
+    for index, (key, session) in enumerate(zip(keys, sessions)):
+        server.add_client(key, session, ('127.0.0.1', 10000 + index % 50000))
+    table = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+
+    return {'benchmark': 'sessions', 'count': args.count, 'record_type': type(sessions[0]).__name__,
+            'record_bytes_per_user': round(records / args.count, 1), 'table_bytes_per_user': round(table / args.count, 1)}
+
+
+def bench_dispatch(args):
+    """
+    this function registers GROUP_SIZE simulated clients in a group chat room and measures, for
+    each workload, the number of frames per second dispatch_frames takes from the frame buffer of
+    the first client, parses and dispatches. the best of DISPATCH_RUNS runs is kept.
+    """
+    members = [DiscardingSocket() for _ in range(GROUP_SIZE)]
+    for index, member in enumerate(members):
+        server.add_client(member, server.build_client(OP_REGISTER, [f'user{index}', str(1000 + index), '2']), ('127.0.0.1', 10000 + index))
+        server.join_room(server.group_chat_rooms, 'bench', member)
+        server.set_in_session(member, True)
+
+    client_socket = members[0]
+    session = server.clients[client_socket]
+    results = []
+
+    for name, (version, in_session, commands) in DISPATCH_WORKLOADS.items():
+        session.version = version
+        server.set_in_session(client_socket, in_session)
+        if version >= 2:
+            encoded = [encode_frame(opcode, *fields) for opcode, fields in commands]
+        else:
+            encoded = [encode_legacy(legacy_text(opcode, fields)) for opcode, fields in commands]
+        data = b''.join(itertools.islice(itertools.cycle(encoded), args.frames))
+
+        duration = float('inf')
+        for _ in range(DISPATCH_RUNS):
+            buffer = server.buffers[client_socket] = FrameBuffer(version)
+            buffer.feed(data)
+            start = time.perf_counter()
+            server.dispatch_frames(client_socket)
+            duration = min(duration, time.perf_counter() - start)
+
+        results.append({'workload': name, 'frames': args.frames, 'frames_per_second': round(args.frames / duration)})
+
+    return {'benchmark': 'dispatch', 'workloads': results}
+
+
+def bench_directory(args):
+    """
+    this function adds count random usernames to the username index and to the sorted usernames
+    of the server, as index_username does for every registration, then measures the prefix
+    searches per second of prefix_search and of a scan of every username returning the same
+    matches.
+    """
+    rng = random.Random(0)
+    names = list({''.join(rng.choices(string.ascii_lowercase, k=8)) for _ in range(args.count)})
+    prefixes = [''.join(rng.choices(string.ascii_lowercase, k=2)) for _ in range(DIRECTORY_SEARCHES)]
+    key = object()
+
+    start = time.perf_counter()
+    for name in names:
+        server.index_username(name, key)
+    inserts = len(names) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for prefix in prefixes:
+        server.prefix_search(prefix, server.PREFIX_SEARCH_LIMIT)
+    searches = len(prefixes) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for prefix in prefixes[:DIRECTORY_SCANS]:
+        sorted(name for name in server.usernames if name.startswith(prefix))[:server.PREFIX_SEARCH_LIMIT]
+    scans = DIRECTORY_SCANS / (time.perf_counter() - start)
+
+    return {'benchmark': 'directory', 'count': len(names), 'inserts_per_second': round(inserts),
+            'prefix_searches_per_second': round(searches), 'scans_per_second': round(scans, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='in-process micro benchmarks of the server')
+    parser.add_argument('benchmarks', nargs='+', choices=BENCHMARKS + ['all'], help='benchmarks to run one after another')
+    parser.add_argument('--count', type=int, default=100000, help='number of simulated sessions')
+    parser.add_argument('--frames', type=int, default=200000, help='number of frames of each dispatch workload')
+    parser.add_argument('--output', default=None, metavar='FILE', help='write the results to a file instead of stdout')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL) # the records of the server would be measured too
+    benchmarks = BENCHMARKS if 'all' in args.benchmarks else args.benchmarks
+    results = [globals()[f'bench_{name}'](args) for name in benchmarks]
+
+    report = {'revision': git_revision(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'configuration': {key: value for key, value in vars(args).items() if key != 'benchmarks'},
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,394 @@
+"""
+wire protocol of the chatting application, shared by the server and the clients.
+
+version 1 (legacy) frames are made of a HEADER_LENGTH characters long ASCII header holding the
+length of the data, followed by the data itself. commands start with a marker such as
+&&SEARCH&&, which is looked up as a whole in LEGACY_OPCODES, and their fields are separated by '|'.
+
+version 2 frames are made of a binary header packed with FRAME_HEADER (the length of the payload
+and an opcode byte), followed by the payload. the payload holds the fields of the frame encoded
+with utf-8 and separated by FIELD_SEPARATOR.
+
+every client registers with a version 1 frame. a client which can speak version 2 appends the
+version to its register message (&&REGISTER&&|username|port|2); the server then answers with a
+REGISTERED message holding the negotiated version, and both sides switch to that version.
+
+a version 2 client may also offer the compression methods it supports, in order of preference,
+after its version (&&REGISTER&&|username|port|2|zlib-dict,zlib). the server answers with the
+method it has chosen after the version in its REGISTERED message, if it has chosen one. the
+payloads of at least COMPRESSION_THRESHOLD bytes sent on the connection are then compressed
+when compression makes them smaller: the opcode of a compressed version 2 frame has the
+COMPRESSED bit set, and the data of a compressed version 1 frame (as sent between peers) starts
+with the COMPRESSED byte, which never starts utf-8 text. frames are decompressed by
+parse_command, so compression is transparent to the code handling the commands.
+"""
+import struct # packing and unpacking of the binary frame header
+import zlib # compression of the large payloads
+
+PROTOCOL_VERSION = 2 # highest protocol version known by this implementation
+HEADER_LENGTH = 5 # length of the ASCII header of version 1 frames
+FRAME_HEADER = struct.Struct('!IB') # payload length and opcode of version 2 frames
+FIELD_SEPARATOR = '\x1f' # ASCII unit separator, never typed by users
+MAX_FRAME_LENGTH = 1 << 24 # frames announcing a longer payload are rejected
+RECV_SIZE = 65536 # number of bytes read from a socket at once
+COMPRESSED = 0x80 # opcode bit of compressed version 2 frames, first byte of compressed version 1 data
+COMPRESSION_THRESHOLD = 512 # payloads shorter than this number of bytes are never compressed
+COMPRESSION_LEVEL = 6 # zlib compression level
+COMPRESSION_METHODS = ('zlib-dict', 'zlib') # compression methods known by this implementation, preferred first
+
+# preset dictionary of the zlib-dict method, made of the strings which are frequent in the chat
+# traffic: the texts of the server and common chat words. zlib finds the matches at the end of
+# the dictionary with the shortest distances, so the most frequent strings come last
+PRESET_DICTIONARY = ' '.join([
+    'would like to chat with you? (OK/REJECT)', 'would like to add you to group chat room',
+    '? (OK/REJECT GROUP <room_number>)', 'you have rejected the chat request!', 'rejected the group chat request!',
+    'a request has been sent to your added friends. type EXIT GROUP to leave.', 'is offline.',
+    'the chat request will be delivered when', 'is back.', 'accepted the chat request.',
+    'you have entered into a private chat with', 'you can send your message now!', 'joined the group chat',
+    'left the chat room.', 'messages of group chat', 'type HISTORY MORE to see older messages.',
+    'thanks', 'please', 'sorry', 'maybe', 'tomorrow', 'today', 'tonight', 'morning', 'meeting', 'people',
+    'really', 'think', 'about', 'there', 'would', 'could', 'should', 'because', 'something', 'anyone',
+    'everyone', 'good', 'great', 'what', 'when', 'where', 'which', 'with', 'have', 'this', 'that', 'will',
+    'just', 'know', 'like', 'time', 'from', 'your', 'you are', "i'm", "don't", "it's", 'ok', 'yes', 'no',
+    'and', 'the', 'for', 'not', 'but', 'you', 'is', 'to', 'of', 'in', 'it', 'a', 'i',
+]).encode('utf-8')
+
+# opcodes of the commands sent by the clients
+OP_REGISTER = 1
+OP_LOGOUT = 2
+OP_SEARCH = 3
+OP_CHATREQUEST = 4
+OP_REJECT = 5
+OP_OK = 6
+OP_EXIT = 7
+OP_GROUPCHAT = 8
+OP_REJECTGROUP = 9
+OP_OKGROUP = 10
+OP_EXITGROUP = 11
+OP_MESSAGE = 12
+OP_HELLO = 13
+OP_HISTORY = 14 # also sent by the server, with a chunk of the requested history
+OP_PREFIXSEARCH = 15
+OP_SUBSCRIBE = 16
+
+# opcodes of the responses sent by the server
+OP_TEXT = 32 # a plain text message without a marker
+OP_REGISTERED = 33
+OP_LOGOUTSUCCESS = 34
+OP_FOUND = 35
+OP_NOTFOUND = 36
+OP_INVALIDSEARCH = 37
+OP_BUSY = 38
+OP_CLIENTOK = 39
+OP_CLIENTEXIT = 40
+OP_HISTORYEND = 41
+OP_PREFIXRESULT = 42
+OP_PRESENCE = 43
+
+# opcodes of the link messages exchanged between the servers of a cluster. the first field of a
+# routed message is the node it is destined to
+LINK_HELLO = 96 # node
+LINK_PRESENCE = 97 # username, node, ip, port, server port, version, busy, compression
+LINK_ABSENCE = 98 # username, node
+LINK_DELIVER = 99 # node, username, encoded message (raw bytes)
+LINK_COMMAND = 100 # node, username, opcode, fields...
+LINK_SESSION = 101 # node, username, node of the room the user is in (empty if none)
+LINK_HEARTBEAT = 102 # node, usernames...
+ROUTED_LINK_OPCODES = {LINK_DELIVER, LINK_COMMAND, LINK_SESSION, LINK_HEARTBEAT}
+
+# markers of the version 1 protocol for each opcode
+MARKERS = {
+    OP_REGISTER: '&&REGISTER&&',
+    OP_LOGOUT: '&&LOGOUT&&',
+    OP_SEARCH: '&&SEARCH&&',
+    OP_CHATREQUEST: '&&CHATREQUEST&&',
+    OP_REJECT: '&&REJECT&&',
+    OP_OK: '&&OK&&',
+    OP_EXIT: '&&EXIT&&',
+    OP_GROUPCHAT: '&&GROUPCHAT&&',
+    OP_REJECTGROUP: '&&REJECTGROUP&&',
+    OP_OKGROUP: '&&OKGROUP&&',
+    OP_EXITGROUP: '&&EXITGROUP&&',
+    OP_MESSAGE: '&&MESSAGE&&',
+    OP_HELLO: '&&HELLO&&',
+    OP_HISTORY: '&&HISTORY&&',
+    OP_PREFIXSEARCH: '&&PREFIXSEARCH&&',
+    OP_SUBSCRIBE: '&&SUBSCRIBE&&',
+    OP_REGISTERED: '&&REGISTERED&&',
+    OP_LOGOUTSUCCESS: '&&LOGOUTSUCCESS&&',
+    OP_FOUND: '&&FOUND&&',
+    OP_NOTFOUND: '&&NOTFOUND&&',
+    OP_INVALIDSEARCH: '&&INVALIDSEARCH&&',
+    OP_BUSY: '&&BUSY&&',
+    OP_CLIENTOK: '&&CLIENTOK&&',
+    OP_CLIENTEXIT: '&&CLIENTEXIT&&',
+    OP_HISTORYEND: '&&HISTORYEND&&',
+    OP_PREFIXRESULT: '&&PREFIXRESULT&&',
+    OP_PRESENCE: '&&PRESENCE&&',
+}
+
+# opcode of each marker, version 1 messages are recognized by looking up their leading marker
+LEGACY_OPCODES = {marker: opcode for opcode, marker in MARKERS.items()}
+
+
+class ProtocolError(ValueError):
+    """
+    raised when a peer sends bytes which can not be parsed as a frame.
+    """
+
+
+def add_marker(opcode, marker):
+    """
+    this function makes a new opcode known to the version 1 protocol under the given marker.
+    """
+    MARKERS[opcode] = marker
+    LEGACY_OPCODES[marker] = opcode
+
+
+def negotiate_compression(offered):
+    """
+    this function gets the compression methods offered by a peer, separated by commas, and
+    returns the preferred one among those known by this implementation, or an empty string if
+    there is none.
+    """
+    offered = offered.split(',')
+    for method in COMPRESSION_METHODS:
+        if method in offered:
+            return method
+    return ''
+
+
+def compress_payload(payload, method):
+    """
+    this function compresses a payload with the given method and returns the compressed bytes,
+    or None if the payload is too short to be compressed or compression does not make it smaller.
+    """
+    if len(payload) < COMPRESSION_THRESHOLD:
+        return None
+
+    if method == 'zlib-dict':
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=PRESET_DICTIONARY)
+    else:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL)
+    data = compressor.compress(payload) + compressor.flush()
+    return data if len(data) < len(payload) else None
+
+
+def decompress_payload(data):
+    """
+    this function gets compressed bytes and returns the payload they hold, whatever the method
+    they have been compressed with. a ProtocolError is raised if the bytes can not be
+    decompressed or the payload is longer than MAX_FRAME_LENGTH.
+    """
+    # the preset dictionary is only used by the streams which have been compressed with it
+    decompressor = zlib.decompressobj(zdict=PRESET_DICTIONARY)
+    try:
+        payload = decompressor.decompress(data, MAX_FRAME_LENGTH)
+    except zlib.error as error:
+        raise ProtocolError(f'invalid compressed payload: {error}')
+
+    if not decompressor.eof or decompressor.unconsumed_tail:
+        raise ProtocolError('compressed payload is truncated or too long')
+    return payload
+
+
+def frame_buffers(opcode, *fields, compression=''):
+    """
+    this function gets an opcode and the fields of a frame as strings and returns the header and
+    the payload of the version 2 frame holding them as two separate buffers, so that they can be
+    sent with a single scatter-gather call without being concatenated. the payload is compressed
+    with the given compression method, if any, when it is worth it.
+    """
+    payload = FIELD_SEPARATOR.join(fields).encode('utf-8')
+    if compression:
+        data = compress_payload(payload, compression)
+        if data is not None:
+            return [FRAME_HEADER.pack(len(data), opcode | COMPRESSED), data]
+    return [FRAME_HEADER.pack(len(payload), opcode), payload]
+
+
+def link_frame_buffers(opcode, fields, data=None):
+    """
+    this function returns the buffers of a version 2 frame exchanged between servers. the frame
+    holds the given fields, optionally followed by raw bytes as its last field, which are read
+    back with split_link_payload.
+    """
+    buffers = [FIELD_SEPARATOR.join(fields).encode('utf-8')]
+    if data is not None:
+        buffers += [FIELD_SEPARATOR.encode('utf-8'), data]
+    return [FRAME_HEADER.pack(sum(len(buffer) for buffer in buffers), opcode)] + buffers
+
+
+def split_link_payload(payload, count):
+    """
+    this function gets the payload of a frame built by link_frame_buffers with raw bytes and
+    returns its count text fields followed by the raw bytes.
+    """
+    parts = payload.split(FIELD_SEPARATOR.encode('utf-8'), count)
+    return [part.decode('utf-8') for part in parts[:count]] + parts[count:]
+
+
+def encode_frame(opcode, *fields, compression=''):
+    """
+    this function gets an opcode and the fields of a frame as strings and returns the version 2
+    frame holding them as bytes.
+    """
+    return b''.join(frame_buffers(opcode, *fields, compression=compression))
+
+
+def legacy_header(data):
+    """
+    this function gets the data of a version 1 frame as bytes and returns the header of the frame.
+    a ProtocolError is raised if the length of the data does not fit in the header.
+    """
+    if len(data) >= 10 ** HEADER_LENGTH:
+        raise ProtocolError(f'{len(data)} bytes do not fit in a version 1 frame')
+    return f"{len(data):<{HEADER_LENGTH}}".encode('utf-8')
+
+
+def legacy_buffers(text, compression=''):
+    """
+    this function gets the text of a message and returns the header and the data of the version 1
+    frame holding it as two separate buffers. the data is compressed with the given compression
+    method, if any, when it is worth it.
+    """
+    data = text.encode('utf-8')
+    if compression:
+        compressed = compress_payload(data, compression)
+        if compressed is not None:
+            data = bytes([COMPRESSED]) + compressed
+    return [legacy_header(data), data]
+
+
+def encode_legacy(text, compression=''):
+    """
+    this function gets the text of a message and returns the version 1 frame holding it as bytes.
+    """
+    return b''.join(legacy_buffers(text, compression))
+
+
+def legacy_text(opcode, fields):
+    """
+    this function gets an opcode and the fields of a frame and returns the text of the equivalent
+    version 1 message, which is the marker of the opcode followed by the fields.
+    """
+    marker = MARKERS.get(opcode)
+    return '|'.join(([marker] if marker else []) + list(fields))
+
+
+def split_fields(payload):
+    """
+    this function gets the payload of a version 2 frame as bytes and returns its fields as a list
+    of strings.
+    """
+    if not payload:
+        return []
+    return payload.decode('utf-8').split(FIELD_SEPARATOR)
+
+
+def parse_legacy_command(text):
+    """
+    this function gets the text of a version 1 message and returns its opcode and its fields.
+    the opcode is None if the text does not start with a known marker, so a marker typed in the
+    text of a message is never mistaken for a command. the text of a MESSAGE is kept whole as
+    its only field since it may contain '|' characters.
+    """
+    end = text.find('&&', 2) + 2 if text.startswith('&&') else 0
+    opcode = LEGACY_OPCODES.get(text[:end])
+    if opcode is None:
+        return None, [text]
+
+    if opcode == OP_MESSAGE:
+        return opcode, [text[end + 1:]]
+    return opcode, [field.strip() for field in text[end + 1:].split('|')] if len(text) > end else []
+
+
+def parse_command(opcode, payload):
+    """
+    this function gets a frame returned by FrameBuffer.next_frame and returns its opcode and its
+    fields, whatever the protocol version of the frame. compressed frames are decompressed first.
+    """
+    if opcode is None:
+        if payload and payload[0] == COMPRESSED:
+            payload = decompress_payload(payload[1:])
+        return parse_legacy_command(payload.decode('utf-8'))
+
+    if opcode & COMPRESSED:
+        opcode ^= COMPRESSED
+        payload = decompress_payload(payload)
+    return opcode, split_fields(payload)
+
+
+def parse_datagram(datagram):
+    """
+    this function gets a datagram holding a single frame of any protocol version and returns its
+    opcode and its fields. a datagram holds less than 64 KiB, hence the big-endian payload length
+    of a version 2 frame it holds always starts with a zero byte, while version 1 headers start
+    with an ASCII digit.
+    """
+    buffer = FrameBuffer(2 if datagram[:1] == b'\x00' else 1)
+    buffer.feed(datagram)
+    frame = buffer.next_frame()
+    if frame is None:
+        raise ProtocolError('truncated datagram')
+    return parse_command(*frame)
+
+
+class FrameBuffer:
+    """
+    this class is an incremental parser of the byte stream of a connection. received bytes are
+    appended with feed, and next_frame returns the complete frames one by one while keeping a
+    partially received frame until the rest of it arrives. the protocol version of the buffer
+    may be changed between two frames. consumed bytes are only discarded when new bytes are fed,
+    so taking many small frames from a single read never moves the rest of the buffer.
+    """
+
+    def __init__(self, version=1):
+        self.version = version
+        self.buffer = bytearray()
+        self.offset = 0 # position of the first byte which has not been consumed yet
+
+    def feed(self, data):
+        if self.offset:
+            del self.buffer[:self.offset]
+            self.offset = 0
+        self.buffer += data
+
+    def pending(self):
+        """
+        this function returns the bytes which have been received but not consumed yet.
+        """
+        return bytes(self.buffer[self.offset:])
+
+    def next_frame(self):
+        """
+        this function returns the next complete frame of the buffer as an (opcode, payload) tuple,
+        or None if no complete frame has been received yet. the opcode of version 1 frames is None.
+        """
+        available = len(self.buffer) - self.offset
+
+        if self.version >= 2:
+            if available < FRAME_HEADER.size:
+                return None
+            length, opcode = FRAME_HEADER.unpack_from(self.buffer, self.offset)
+            start = self.offset + FRAME_HEADER.size
+        else:
+            if available < HEADER_LENGTH:
+                return None
+            header = bytes(self.buffer[self.offset:self.offset + HEADER_LENGTH])
+            try:
+                length = int(header.decode('utf-8'))
+            except (UnicodeDecodeError, ValueError):
+                raise ProtocolError(f'invalid header {header}')
+            opcode = None
+            start = self.offset + HEADER_LENGTH
+
+        if length > MAX_FRAME_LENGTH or length < 0:
+            raise ProtocolError(f'frame length {length} is out of bounds')
+
+        end = start + length
+        if len(self.buffer) < end:
+            return None
+
+        self.offset = end
+        return opcode, bytes(self.buffer[start:end])
@@ -1,15 +1,32 @@
 import socket # socket library for creating sockets
-import select # OS level IO capability
+import selectors # high-level I/O multiplexing built upon the select module (epoll on linux)
+import asyncio # asynchronous I/O library for the asyncio server mode
+import argparse # command line argument parsing
+import sys # platform detection
+import os # system configuration values
+import collections # deque holding the outbound buffers of the clients
 import time # time library for handling time related tasks
-import threading # threading library for multithreading
+import heapq # min-heap of the activity deadlines of the clients
+import bisect # buckets of the latency histograms
+import itertools # counter breaking ties between equal deadlines
 import logging # logging library to perform logging
+from logqueue import LogSampler, configure_logging # queue-based logging shared with the clients
+from store import MessageStore # durable message store
+import multiprocessing # worker processes of the multi-process mode
+import tempfile # directory of the unix socket of the coordinator
+import atexit # close the message store when the server exits
+import signal # cleanup of the coordinator when it is terminated
+import json # snapshot of the state handed over to a new server process
+import base64 # bytes of the snapshot
+from protocol import (PROTOCOL_VERSION, RECV_SIZE, OP_REGISTER, OP_LOGOUT, OP_SEARCH, OP_CHATREQUEST, OP_REJECT,
+                      OP_OK, OP_EXIT, OP_GROUPCHAT, OP_REJECTGROUP, OP_OKGROUP, OP_EXITGROUP, OP_MESSAGE, OP_HELLO,
+                      OP_TEXT, OP_REGISTERED, OP_LOGOUTSUCCESS, OP_FOUND, OP_NOTFOUND, OP_INVALIDSEARCH, OP_BUSY,
+                      OP_CLIENTOK, OP_CLIENTEXIT, OP_HISTORY, OP_HISTORYEND, OP_PREFIXSEARCH, OP_SUBSCRIBE, OP_PREFIXRESULT,
+                      OP_PRESENCE, MARKERS, LINK_HELLO, LINK_PRESENCE, LINK_ABSENCE, LINK_DELIVER, LINK_COMMAND,
+                      LINK_SESSION, LINK_HEARTBEAT, ROUTED_LINK_OPCODES, FIELD_SEPARATOR, FRAME_HEADER, FrameBuffer,
+                      ProtocolError, add_marker, frame_buffers, legacy_buffers, negotiate_compression, legacy_header, legacy_text, link_frame_buffers,
+                      parse_command, parse_datagram, split_fields, split_link_payload) # wire protocol shared with the clients
 
-log_file = 'server.log' # filename of server logs
-handlers = [logging.FileHandler(log_file, 'w'), logging.StreamHandler()] # write to log file and stdout
-logging.basicConfig(level=logging.NOTSET, # set root logger to NOSET 
-					handlers = handlers, # set handlers for the logging
-					format="%(asctime)s;%(levelname)s;%(message)s", # log format
-					datefmt='%Y-%m-%d %H:%M:%S') # date format
 logger = logging.getLogger()
 
 # constants
@@ -17,469 +34,2507 @@ IP = '127.0.0.1'
 TCP_PORT = 6234
 UDP_PORT = 6235
 MAX_CONNECTIONS = 5
-HEADER_LENGTH = 5
 ACTIVITY_LIMIT = 20
+LINK_RETRY_INTERVAL = 5 # seconds between two attempts to link to a peer node which can not be reached
+STATS_TIMEOUT = 1 # seconds a stats request may take to be answered
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 1) # upper bounds in seconds
+HELLO_BATCH_SIZE = 1024 # maximum number of HELLO datagrams read from the udp socket in a single wake up
+HELLO_SIZE = 256 # maximum size of a HELLO datagram
+HELLO_LOG_RATE = 10 # maximum number of log records per second about HELLO messages of each kind
+HISTORY_PAGE_SIZE = 50 # number of messages of a history page when the client does not ask for another number
+HISTORY_MAX_PAGE_SIZE = 500 # maximum number of messages of a history page
+HISTORY_CHUNK_SIZE = 16384 # approximate number of characters of the messages sent in a single HISTORY message
+PREFIX_SEARCH_LIMIT = 20 # number of usernames returned by a prefix search when the client does not ask for another number
+PREFIX_SEARCH_MAX_LIMIT = 200 # maximum number of usernames returned by a prefix search
+SUBSCRIPTION_LIMIT = 1000 # maximum number of users whose presence a client may subscribe to
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024 # maximum number of buffers of a sendmsg call
+HANDOVER_TIMEOUT = 10 # seconds a handover may take before the running server resumes serving
+HANDOVER_BATCH_SIZE = 250 # file descriptors passed in a single message, below the SCM_MAX_FD limit of linux
+HANDOVER_ACK = b'K' # sent by the new process once it has taken the sockets over
+
+# on linux, SO_RXQ_OVFL attaches to each received datagram the number of datagrams dropped by the
+# kernel so far because the receive buffer of the socket was full
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40 if sys.platform.startswith('linux') else None)
+HELLO_ANCILLARY_SIZE = socket.CMSG_SPACE(4) if SO_RXQ_OVFL else 0
+TCP_CORK = getattr(socket, 'TCP_CORK', None) # only known on linux
+
+# the selector owns every socket of the server (tcp listener, udp socket and client sockets)
+# and the data attached to each registration is the callback handling its read events
+selector = selectors.DefaultSelector()
+
+# settings which can be changed from the command line
+outbound_high_watermark = 1 << 20 # maximum number of bytes queued for a client
+slow_consumer_policy = 'disconnect' # what happens to a client exceeding the high watermark (disconnect/drop)
+log_mode = 'queue' # logs are written by a background thread (queue) or by the event loop itself (sync)
+write_coalescing = 'tick' # buffers sent to a socket during a tick of the event loop are sent together (tick) or right away (off)
+tcp_nodelay = 'on' # whether the tcp connections disable the Nagle algorithm
+tcp_cork = 'off' # whether the tcp connections are corked while a tick of the event loop writes to them
+
+# data structures for handling client and chat room instances
+clients = {}
+buffers = {} # client socket -> FrameBuffer holding the bytes received from the client
+outbound = {} # client socket -> OutboundQueue holding the bytes not yet accepted by the socket
+# address returned by accept for each client connection, so that it never has to be queried
+# from a socket which may already have been reset by the client
+connection_addresses = {}
+# sockets written during the current tick of the event loop, kept as the keys of a dictionary
+# (an insertion ordered set). their queued buffers are sent by flush_writes before the event
+# loop waits for events again
+tick_writes = {}
+usernames = {} # username -> client socket index for constant time lookups
+addresses = {} # (IP, PORT) -> client socket index for constant time lookups
+sorted_usernames = [] # usernames of the username index in sorted order, for prefix searches
+# username -> sockets of the local clients subscribed to the presence of that user, kept as the
+# keys of a dictionary (an insertion ordered set)
+subscribers = {}
+# chat rooms map a room number to the members of the room. members are kept as the keys of a
+# dictionary, which behaves as an insertion ordered set (the first member of a room is its owner)
+private_chat_rooms = {}
+group_chat_rooms = {}
+total_private_rooms = 0
+total_global_rooms = 0
+
+# min-heap of (deadline, sequence, client socket) entries with exactly one entry per client. a
+# HELLO message only moves the deadline of the client forward, and the entry is rescheduled to
+# the new deadline when it reaches the top of the heap, so only expired entries are ever touched
+activity_deadlines = []
+deadline_sequence = itertools.count()
+
+# counters of the HELLO messages: received datagrams, duplicates coalesced within a batch, HELLO
+# messages of clients which were already terminated or past their deadline, unparsable datagrams
+# and datagrams dropped by the kernel before they could be read, along with the clients terminated
+# because their activity time has run out
+heartbeat_stats = {'received': 0, 'coalesced': 0, 'late': 0, 'malformed': 0, 'dropped': 0, 'expired': 0}
+hello_log = LogSampler(HELLO_LOG_RATE) # rate limit of the log records about the HELLO message of a client
+hello_batch_log = LogSampler(HELLO_LOG_RATE) # rate limit of the log records about a batch of HELLO messages
+
+# counters of the outbound queues: send system calls, writes which could not be completed right
+# away and had to be queued, messages dropped and clients disconnected because of the slow
+# consumer policy
+outbound_stats = {'send_calls': 0, 'queued_writes': 0, 'dropped_messages': 0, 'evicted_clients': 0}
+
+# counters of the connections: accepted connections, successful and failed registrations
+connection_stats = {'accepted': 0, 'registered': 0, 'failed': 0}
+
+# opcode -> Histogram of the time taken to handle the commands of that opcode, and opcode -> number
+# of commands whose handler has raised an exception. the opcode of unknown commands is None
+command_latency = {}
+command_errors = {}
+stats_requests = {} # stats socket -> bytes of the HTTP request received so far
+start_time = time.time()
+
+# durable store of the group messages and of the messages waiting for offline users, None when
+# the server runs without persistence
+store = None
+
+# in the multi-process mode, every worker process is a node of a cluster and the coordinator
+# process relays link messages between the nodes. in a federation, independent servers are the
+# nodes and they are linked to each other directly. the clients registered on the other nodes are
+# represented by RemoteClient objects, which the message handlers use like client sockets, and
+# group rooms are numbered <number>@<node> so that the node owning a room can be found
+node_id = None # id of this node, None when the server runs alone
+relay = False # True in the coordinator, which forwards the link messages to their destination
+links = {} # link socket -> id of the node at the other end of the link
+node_links = {} # node id -> link socket
+default_link = None # link of a worker to the coordinator, used to reach every other node
+remote_clients = {} # username -> RemoteClient of the clients registered on other nodes
+directory = {} # username -> (node id, presence payload) of every client known by the coordinator
+peer_nodes = {} # (host, port) of a peer node this node links to -> link socket, or retry time if not linked
+
+# a server started with a handover socket listens on it for the new process of a reload, which
+# is handed the listening sockets, the client sockets and a snapshot of the state of the server
+handover_socket = None
+
+
+def setup_logging(log_file='server.log', append=False):
+    """
+    this function configures the root logger so that every record is written both to the
+    server log file and to stderr, without blocking the event loop in the queue log mode.
+    """
+    configure_logging(log_file, log_mode, append)
 
-# AF_INET corresponds to address family IPv4
-# SOCK_STREAM corresponds to TCP
-# SOCK_DGRAM corresponds to UDP
-tcp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
-udp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
 
-# reconnect to server if address is in use
-tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+def create_server_sockets(udp_rcvbuf=None, reuse_port=False, tcp_port=TCP_PORT, udp_port=UDP_PORT):
+    """
+    this function creates the TCP and UDP sockets of the server, binds them to the server
+    address and starts listening for TCP connections. the receive buffer of the UDP socket is
+    set to udp_rcvbuf bytes if given, so that bursts of HELLO messages are not dropped by the
+    kernel. with reuse_port, several worker processes bind the same ports and the kernel spreads
+    the connections and datagrams over them. both sockets are returned.
+    """
+    # AF_INET corresponds to address family IPv4
+    # SOCK_STREAM corresponds to TCP
+    # SOCK_DGRAM corresponds to UDP
+    tcp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+    udp_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
 
-# bind the IP and PORT to the sockets
-tcp_socket.bind((IP, TCP_PORT))
-udp_socket.bind((IP, UDP_PORT))
+    # reconnect to server if address is in use
+    tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-# the queue will take at most MAX_CONNECTIONS
-tcp_socket.listen(MAX_CONNECTIONS)
+    if reuse_port:
+        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
-logger.info(f'TCP server is running at {IP}:{TCP_PORT} and it is listening for connections!')
-logger.info(f'UDP server is running at {IP}:{UDP_PORT} and it is listening for connections!')
+    if udp_rcvbuf:
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, udp_rcvbuf)
+    if SO_RXQ_OVFL:
+        udp_socket.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
 
-# data structures for handling client and socket instances
-sockets = [tcp_socket, udp_socket]
-clients = {}
-private_chat_rooms = {}
-group_chat_rooms = {}
+    # bind the IP and PORT to the sockets
+    tcp_socket.bind((IP, tcp_port))
+    udp_socket.bind((IP, udp_port))
+
+    # the queue will take at most MAX_CONNECTIONS
+    tcp_socket.listen(MAX_CONNECTIONS)
+
+    # the event loop must never block on accept or recvfrom
+    tcp_socket.setblocking(False)
+    udp_socket.setblocking(False)
+
+    logger.info(f'TCP server is running at {IP}:{tcp_port} and it is listening for connections!')
+    logger.info(f'UDP server is running at {IP}:{udp_port} and it is listening for connections!')
+
+    return tcp_socket, udp_socket
+
+
+class Session:
+    """
+    this class holds the attributes of a registered client, local or remote. the username is
+    kept both decoded and as the version 1 username frame which precedes the messages the client
+    causes, so that neither is ever encoded again. sessions have slots instead of a dictionary
+    of attributes since the server holds one per connected user.
+    """
+    __slots__ = ('username', 'prefix', 'server_port', 'version', 'compression', 'address', 'deadline', 'in_session',
+                 'room_node', 'chat_rooms', 'room', 'subscriptions')
+
+    def __init__(self, username, server_port, version, address=None, deadline=None, in_session=False, compression=''):
+        data = username.encode('utf-8')
+        self.username = username
+        self.prefix = legacy_header(data) + data # version 1 username frame
+        self.server_port = server_port # port of the tcp server of the client, for private chats
+        self.version = version # protocol version used with the client
+        self.compression = compression # compression method used with the client, empty if none
+        self.address = address # (IP, PORT) of the client
+        self.deadline = deadline # monotonic time after which the client is terminated, None for remote clients
+        self.in_session = in_session # whether the client is in a chat room, of any node
+        self.room_node = None # node owning the room of the client when it is not this node
+        self.chat_rooms = None # chat rooms (private/group) holding the room of the client on this node
+        self.room = None # number of the room of the client on this node
+        self.subscriptions = None # usernames whose presence the client is subscribed to, None if there are none
+
+
+def build_client(opcode, fields):
+    """
+    this function gets the opcode and the fields of the first message of a client, which must be
+    a register message, and returns the Session of the client, or False if the message is not a
+    valid register message. the protocol version used with the client is the highest version
+    supported by both sides, and the compression method is the preferred method of the server
+    among those offered by a version 2 client.
+    """
+    if opcode != OP_REGISTER or len(fields) < 2:
+        return False
+
+    username = fields[0]
+    server_port = int(fields[1])
+    version = min(int(fields[2]), PROTOCOL_VERSION) if len(fields) > 2 else 1
+    compression = negotiate_compression(fields[3]) if version >= 2 and len(fields) > 3 else ''
+
+    return Session(username, server_port, version, deadline=time.monotonic() + ACTIVITY_LIMIT, compression=compression)
 
 
 def recieve_message(client_socket):
     """
-    this function gets a notified client (a client socket which has something to be read)
-    as input. First, it extracts the header section of the message and then use it as buffer
-    size to extract the rest of the message (data). the function then returns a dictionary
-    which contains some message attributes.
+    this function gets a notified client (a client socket which has something to be read) as
+    input and appends everything which can be read from the socket to the frame buffer of the
+    client. the complete messages are then taken from the buffer one by one, so that messages
+    split over several reads or received together are handled correctly. the function returns
+    False if the client has closed the connection.
     """
     try:
-        message_header = client_socket.recv(HEADER_LENGTH)
+        data = client_socket.recv(RECV_SIZE)
+    except (BlockingIOError, InterruptedError): # nothing to be read after all
+        return True
+    except OSError:
+        return False
 
-        if not len(message_header):
-            return False
+    if not len(data):
+        return False
 
-        message_length = int(message_header.decode('utf-8'))
-        data = client_socket.recv(message_length).decode('utf-8')
-        server_port = -1
-        if '&&REGISTER&&' in data:
-            server_port = int(data.split('|')[2].strip())
-            data = data.split('|')[1].strip()
-            message_header = f"{len(data) :< {HEADER_LENGTH}}".encode('utf-8')
+    buffers[client_socket].feed(data)
+    return True
 
-        return {'header': message_header, 'data': data.encode('utf-8'), 'server_port': server_port, 'activity': ACTIVITY_LIMIT, 'start_time': time.time(), 'in_session': False}
 
-    except Exception:
-        return False
+def encode_response(version, sender_socket, opcode, fields, compression=''):
+    """
+    this function encodes a message in the given protocol version and returns it as a list of
+    buffers. version 1 messages are made of the username frame of the sender followed by the
+    text of the message, version 2 messages are a single frame holding the username of the sender
+    and the fields, compressed with the given compression method if it is worth it.
+    """
+    sender = clients[sender_socket]
+
+    if version >= 2:
+        return frame_buffers(opcode, sender.username, *fields, compression=compression)
+    return [sender.prefix] + legacy_buffers(legacy_text(opcode, fields))
+
+
+def encode_stored(version, sender_username, opcode, fields, compression=''):
+    """
+    this function is the counterpart of encode_response for a message read from the store, whose
+    sender may not be registered anymore.
+    """
+    if version >= 2:
+        return frame_buffers(opcode, sender_username, *fields, compression=compression)
+    return legacy_buffers(sender_username) + legacy_buffers(legacy_text(opcode, fields))
+
+
+class OutboundQueue:
+    """
+    this class holds the buffers waiting to be sent to a client whose socket can not accept
+    them yet. buffers are queued by reference, and a partially sent buffer is replaced by a
+    memoryview of its remaining bytes, so queued data is never copied.
+    """
+
+    def __init__(self):
+        self.buffers = collections.deque()
+        self.size = 0 # number of queued bytes
+
+    def push(self, buffers):
+        for buffer in buffers:
+            if len(buffer):
+                self.buffers.append(buffer)
+                self.size += len(buffer)
+
+    def flush(self, client_socket):
+        """
+        this function sends as many queued buffers as the non-blocking socket of the client
+        accepts, using scatter-gather calls. it returns True once the queue is empty.
+        """
+        while self.buffers:
+            outbound_stats['send_calls'] += 1
+            try:
+                sent = client_socket.sendmsg(list(itertools.islice(self.buffers, IOV_MAX)))
+            except (BlockingIOError, InterruptedError):
+                return False
+
+            self.size -= sent
+            while sent:
+                buffer = self.buffers[0]
+                if len(buffer) <= sent:
+                    sent -= len(buffer)
+                    self.buffers.popleft()
+                else:
+                    self.buffers[0] = memoryview(buffer)[sent:]
+                    sent = 0
+
+        return True
+
+
+def send_buffers(client_socket, buffers, bounded=True):
+    """
+    this function sends a list of buffers to a client without ever blocking. the buffers are
+    queued, and when nothing was queued for the client they are sent at the end of the tick of
+    the event loop by flush_writes, along with every other buffer sent to the client during the
+    tick, with a single scatter-gather call (or right away when write coalescing is off).
+    whatever the socket does not accept stays queued and is sent by flush_outbound once the
+    socket is writable. a client whose queue would exceed the high watermark is a slow consumer:
+    depending on the slow consumer policy, the message is dropped or the client is disconnected.
+    the queues of the links between nodes are not bounded.
+    """
+    if not isinstance(client_socket, socket.socket):
+        client_socket.sendmsg(buffers)
+        return
+
+    queue = outbound.get(client_socket)
+    if queue is None: # the client is being disconnected
+        return
+
+    if bounded and queue.size + sum(len(buffer) for buffer in buffers) > outbound_high_watermark:
+        handle_slow_consumer(client_socket)
+        return
+
+    was_empty = not queue.size
+    queue.push(buffers)
+
+    if not was_empty: # the socket is already written during this tick, or watched for write events
+        return
+
+    if client_socket not in tick_writes:
+        tick_writes[client_socket] = None
+        if tcp_cork == 'on':
+            set_cork(client_socket, True)
+
+    if write_coalescing == 'off':
+        send_queued(client_socket)
+
+
+def send_queued(client_socket):
+    """
+    this function sends the buffers queued for a client which is not watched for write events.
+    """
+    flush_outbound(client_socket)
+    queue = outbound.get(client_socket)
+    if queue is not None and queue.size:
+        outbound_stats['queued_writes'] += 1
+
+
+def flush_writes():
+    """
+    this function is called once per tick of the event loop, before it waits for events. the
+    buffers queued for every socket written during the tick are sent, and the sockets corked
+    during the tick are uncorked so that their last partial segment is sent right away.
+    """
+    while tick_writes:
+        client_socket = next(iter(tick_writes))
+        del tick_writes[client_socket]
+
+        if write_coalescing != 'off':
+            send_queued(client_socket)
+        if tcp_cork == 'on' and client_socket in outbound:
+            set_cork(client_socket, False)
+
+
+def set_cork(client_socket, corked):
+    """
+    this function corks or uncorks a tcp socket: while a socket is corked, the kernel only sends
+    full segments.
+    """
+    if client_socket.family == socket.AF_UNIX:
+        return
+    try:
+        client_socket.setsockopt(socket.IPPROTO_TCP, TCP_CORK, 1 if corked else 0)
+    except OSError: # the connection has been reset
+        pass
+
+
+def set_tcp_options(tcp_socket):
+    """
+    this function applies the tcp settings of the command line to a new connection.
+    """
+    tcp_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if tcp_nodelay == 'on' else 0)
+
+
+def flush_outbound(client_socket):
+    """
+    this function is called by the event loop whenever a client socket with queued buffers is
+    writable, and by send_buffers when new buffers are queued. the socket is watched for write
+    events only as long as some buffers remain queued.
+    """
+    queue = outbound.get(client_socket)
+    if queue is None:
+        return
+
+    try:
+        drained = queue.flush(client_socket)
+    except OSError: # the client has closed the connection or reset it
+        evict_client(client_socket)
+        return
+
+    events = selectors.EVENT_READ if drained else selectors.EVENT_READ | selectors.EVENT_WRITE
+    key = selector.get_key(client_socket)
+    if key.events != events:
+        selector.modify(client_socket, events, key.data)
+
+
+def handle_slow_consumer(client_socket):
+    """
+    this function applies the slow consumer policy to a client whose outbound queue is full.
+    """
+    client_address = clients[client_socket].address if client_socket in clients else None
+
+    if slow_consumer_policy == 'drop':
+        outbound_stats['dropped_messages'] += 1
+        logger.warning(f'dropping a message for slow consumer {client_address}')
+    else:
+        outbound_stats['evicted_clients'] += 1
+        logger.warning(f'disconnecting slow consumer {client_address}')
+        evict_client(client_socket)
+
+
+def evict_client(client_socket):
+    """
+    this function discards the outbound queue of a client and shuts its socket down. nothing
+    else is sent to the client, and the event loop terminates the client as soon as it reads
+    the end of the connection, so the client is never terminated in the middle of a broadcast.
+    """
+    outbound.pop(client_socket, None)
+    try:
+        client_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def send_response(client_socket, sender_socket, opcode, *fields):
+    """
+    this function sends a message to a client in the protocol version and with the compression
+    method of that client.
+    """
+    session = clients[client_socket]
+    send_buffers(client_socket, encode_response(session.version, sender_socket, opcode, fields, session.compression))
+
+
+def broadcast(client_sockets, sender_socket, opcode, *fields):
+    """
+    this function sends the same message to several clients. the message is encoded (and
+    compressed) only once for each protocol version and compression method, and the same buffers
+    are sent to every client using them, so the cost of a broadcast does not grow with copies of
+    the message.
+    """
+    encoded_messages = {}
+
+    for client_socket in client_sockets:
+        session = clients[client_socket]
+        encoding = (session.version, session.compression)
+        if encoding not in encoded_messages:
+            try:
+                encoded_messages[encoding] = encode_response(session.version, sender_socket, opcode, fields, session.compression)
+            except ProtocolError as error: # the message can not be sent with this protocol version
+                logger.warning(f'skipping the version {session.version} members of a broadcast: {error}')
+                encoded_messages[encoding] = None
+
+        if encoded_messages[encoding] is not None:
+            send_buffers(client_socket, encoded_messages[encoding])
 
 
 def search_peer(peer_username):
     """
-    this function gets a client's username as string and searches the clients dictionary
+    this function gets a client's username as string and looks it up in the username index
     in order to find a match for that given username. If a match is found, the function
     returns the address (IP, PORT) of that client, else it returns None.
     """
-    address = None
-    for client in clients:
-        if clients[client]['data'].decode('utf-8') == peer_username:
-            address = client.getpeername()
+    client_socket = usernames.get(peer_username)
+    if client_socket is None:
+        return None
 
-    return address
+    return clients[client_socket].address
 
 
 def get_peer_socket(peer_ip_addr, peer_port):
     """
-    this function gets the IP and PORT as input, and uses them to query the clients dictionary.
+    this function gets the IP and PORT as input, and uses them to query the address index.
     If a match is found, the function returns the socket instance for that match, else it returns
     None.
     """
-    for client in clients:
-        address = client.getpeername()
-        if address == (peer_ip_addr, peer_port):
-            return client
-
-    return None
+    return addresses.get((peer_ip_addr, peer_port))
 
 
 def get_socket(username):
     """
-    this function gets the username of a client as a string and uses it to query the clients dictionary.
+    this function gets the username of a client as a string and uses it to query the username index.
     If a match is found, it returns the client's socket instance, else it returns None.
     """
-    ip, port = search_peer(username)
-    user_socket = get_peer_socket(ip, port)
-    return user_socket
+    return usernames.get(username)
+
+
+def add_client(client_socket, client_data, client_address):
+    """
+    this function adds a newly registered client to the clients dictionary and to the username
+    and address indexes. the address of the client is kept in its session so that it never has
+    to be queried from the socket again.
+    """
+    client_data.address = client_address
+    clients[client_socket] = client_data
+    index_username(client_data.username, client_socket)
+    addresses[client_address] = client_socket
+    heapq.heappush(activity_deadlines, (client_data.deadline, next(deadline_sequence), client_socket))
+    publish_presence(client_socket)
+
+
+def remove_client(client_socket):
+    """
+    this function removes a client from the clients dictionary and from the username and address
+    indexes, and ends its presence subscription. the username entry is kept if it already belongs
+    to a newer connection of the user.
+    """
+    client_data = clients.pop(client_socket, None)
+    if client_data is None:
+        return
+
+    unsubscribe(client_socket, client_data)
+    username = client_data.username
+    if usernames.get(username) is client_socket:
+        unindex_username(username)
+    if addresses.get(client_data.address) is client_socket:
+        addresses.pop(client_data.address)
+
+    if links and not isinstance(client_socket, RemoteClient):
+        broadcast_link(LINK_ABSENCE, [username, node_id])
+
+
+def index_username(username, client_socket):
+    """
+    this function adds a client to the username index and, if the user was not registered yet,
+    to the sorted usernames, and notifies the subscribers of the user that it is online.
+    """
+    registered = username in usernames
+    usernames[username] = client_socket
+    if not registered:
+        bisect.insort(sorted_usernames, username)
+        notify_presence(username, 'online')
+
+
+def unindex_username(username):
+    """
+    this function removes a user from the username index and from the sorted usernames, and
+    notifies the subscribers of the user that it is offline.
+    """
+    usernames.pop(username)
+    del sorted_usernames[bisect.bisect_left(sorted_usernames, username)]
+    notify_presence(username, 'offline')
+
+
+def prefix_search(prefix, limit):
+    """
+    this function returns up to limit usernames starting with the given prefix, in sorted order.
+    the sorted usernames are bisected, so a search only reads the usernames it returns.
+    """
+    start = bisect.bisect_left(sorted_usernames, prefix)
+    matches = sorted_usernames[start:start + limit]
+    for index, username in enumerate(matches):
+        if not username.startswith(prefix):
+            return matches[:index]
+    return matches
+
+
+def notify_presence(username, state):
+    """
+    this function sends a PRESENCE message (online or offline, username) to the clients
+    subscribed to the presence of a user whose state has changed.
+    """
+    for subscriber_socket in subscribers.get(username, ()):
+        send_response(subscriber_socket, subscriber_socket, OP_PRESENCE, state, username)
+
+
+def unsubscribe(client_socket, client_data):
+    """
+    this function ends the presence subscription of a client.
+    """
+    for username in client_data.subscriptions or ():
+        watchers = subscribers[username]
+        watchers.pop(client_socket, None)
+        if not watchers:
+            del subscribers[username]
+    client_data.subscriptions = None
+
+
+def process_text_message(notified_socket, fields):
+    """
+    this function gets a notified socket and the fields of a message as input. First, it looks up the room
+    of the notified socket in its session. If the notified socket is in a group chat room,
+    the message is forwarded to all members of that specific room.
+    """
+    chat_rooms, chat_room = room_of(notified_socket)
+    if chat_rooms is not group_chat_rooms:
+        return
+
+    if store is not None:
+        store.append_message(chat_room, clients[notified_socket].username, fields)
+    broadcast(group_chat_rooms[chat_room], notified_socket, OP_MESSAGE, *fields)
+
+
+def queue_for_offline_user(username, sender_socket, opcode, *fields):
+    """
+    this function stores a message for a user who is not registered, so that it is delivered
+    when the user registers again. it returns False if the message can not be stored because
+    the server runs without a store or the user has never registered.
+    """
+    if store is None or username not in store.users:
+        return False
+
+    store.queue_message(username, clients[sender_socket].username, opcode, fields)
+    return True
+
+
+def deliver_stored_messages(client_socket):
+    """
+    this function sends the messages which have been stored for a user while the user was
+    offline, and records the user as known by the store.
+    """
+    session = clients[client_socket]
+    store.add_user(session.username)
+
+    messages = store.take_pending(session.username)
+    for sender_username, opcode, fields in messages:
+        send_buffers(client_socket, encode_stored(session.version, sender_username, opcode, fields, session.compression))
 
+    if messages:
+        logger.info(f'delivered {len(messages)} stored messages to {session.username}')
 
-def process_text_message(notified_socket, message):
+
+def send_history(client_socket, fields):
     """
-    this function gets a notified socket and a message as input. First, it checks all available
-    global chat rooms to check if the notified socket is in one of them. If it exists, the message
-    is forwarded to all members of that specific room.
+    this function sends a page of the history of the group room a client is in. the fields of
+    the command are the number of messages of the page and the cursor returned with the previous
+    page, both optional. the page is streamed as HISTORY messages holding the room and the
+    timestamp, sender and text of up to HISTORY_CHUNK_SIZE characters of messages each (a single
+    message for version 1 clients, since the text is the only field which may hold '|'
+    characters), followed by a HISTORYEND message holding the room, the cursor of the previous
+    page (empty if there is none) and the number of messages of the page. the messages of the
+    page are sent with a single scatter-gather call.
     """
-    for chat_room in group_chat_rooms:
-        if notified_socket in group_chat_rooms[chat_room]:
-            user = clients[notified_socket]
-            for client_socket in group_chat_rooms[chat_room]:
-                client_socket.send(user['header'] + user['data'] + message['header'] + message['data'])
+    chat_rooms, chat_room = room_of(client_socket)
+    if chat_rooms is not group_chat_rooms:
+        send_response(client_socket, client_socket, OP_TEXT, 'you must be in a group chat room to see its history.')
+        return
+
+    if store is None:
+        send_response(client_socket, client_socket, OP_TEXT, 'the chat history is not kept by this server.')
+        return
+
+    count = min(int(fields[0]), HISTORY_MAX_PAGE_SIZE) if fields and fields[0].isdigit() else HISTORY_PAGE_SIZE
+    before = int(fields[1]) if len(fields) > 1 and fields[1].isdigit() else None
+    messages, cursor = store.history(chat_room, count, before)
+
+    version = clients[client_socket].version
+    compression = clients[client_socket].compression
+    page_buffers = []
+    chunk = []
+    size = 0
+    for timestamp, sender_username, message_fields in messages:
+        text = '|'.join(message_fields)
+        chunk += [f'{timestamp:.3f}', sender_username, text]
+        size += len(sender_username) + len(text)
+
+        if version < 2 or size >= HISTORY_CHUNK_SIZE:
+            page_buffers += encode_response(version, client_socket, OP_HISTORY, [chat_room] + chunk, compression)
+            chunk = []
+            size = 0
+
+    if chunk:
+        page_buffers += encode_response(version, client_socket, OP_HISTORY, [chat_room] + chunk, compression)
+    page_buffers += encode_response(version, client_socket, OP_HISTORYEND, [chat_room, '' if cursor is None else str(cursor), str(len(messages))])
+    send_buffers(client_socket, page_buffers)
 
 
 def is_busy(peer_socket):
     """
-    this function gets a client socket as input and checks both group and private chat rooms.
-    If the given client socket exists in any of them, the function returns True, else it returns
-    False.
+    this function gets a client socket as input and checks its session. If the given client
+    socket is in any group or private chat room, the function returns True, else it returns
+    False. a client in a room of another node is in session without being in a room of this node.
+    """
+    session = clients[peer_socket]
+    return session.chat_rooms is not None or session.in_session
+
+
+def set_in_session(client_socket, in_session):
+    """
+    this function marks a client as being in a chat room of this node or not. the node of a
+    remote client is informed so that it routes the room commands of the client to this node,
+    and the new state of a local client is published to the other nodes.
+    """
+    clients[client_socket].in_session = in_session
+
+    if isinstance(client_socket, RemoteClient):
+        route(client_socket.node, LINK_SESSION, [client_socket.username, node_id if in_session else ''])
+    else:
+        clients[client_socket].room_node = None
+        publish_presence(client_socket)
+
+
+def room_name(number):
+    """
+    this function returns the name of the group room with the given number, which holds the id
+    of this node when the server is part of a cluster.
+    """
+    return f'{number}@{node_id}' if node_id else str(number)
+
+
+def remote_room_node(client_socket, opcode, fields):
+    """
+    this function returns the node which owns the room a command of a local client is about, if
+    that room is owned by another node, else None. the command must then be handled by that node.
+    """
+    if node_id is None or isinstance(client_socket, RemoteClient):
+        return None
+
+    if opcode in (OP_EXIT, OP_EXITGROUP, OP_MESSAGE, OP_HISTORY):
+        return clients[client_socket].room_node
+
+    if opcode in (OP_OKGROUP, OP_REJECTGROUP) and fields:
+        number, separator, owner = fields[-1].partition('@')
+        if separator and owner != node_id:
+            return owner
+
+    return None
+
+
+def room_of(client_socket):
+    """
+    this function returns the chat rooms (private/group) and the number of the room of this node
+    a client is in, or (None, None) if the client is in no room of this node.
     """
-    for chat_room in group_chat_rooms:
-        if peer_socket in group_chat_rooms[chat_room]:
-            return True
+    session = clients.get(client_socket)
+    if session is None:
+        return None, None
+    return session.chat_rooms, session.room
 
-    for chat_room in private_chat_rooms:
-        if peer_socket in private_chat_rooms[chat_room]:
-            return True
 
-    return False
+def join_room(chat_rooms, chat_room, peer_socket):
+    """
+    this function gets a chat room (private/global), a room number and a peer socket as input.
+    it adds the peer socket to the members of the room and records the room in its session.
+    """
+    chat_rooms.setdefault(chat_room, {})[peer_socket] = None
+    session = clients[peer_socket]
+    session.chat_rooms = chat_rooms
+    session.room = chat_room
 
 
 def remove_participant(chat_rooms, peer_socket):
     """
-    this function gets a chat room (private/global) and a peer socket as input. Then it
-    checks all available chat rooms for the existance of the given peer socket. If it exists,
+    this function gets a chat room (private/global) and a peer socket as input. Then it looks
+    up the room of the given peer socket in its session. If it is one of the given chat rooms,
     the function removes that socket from the room.
     """
-    room = None
-    for chat_room in chat_rooms:
-        if peer_socket in chat_rooms[chat_room]:
-            chat_rooms[chat_room].remove(peer_socket)
-            room = chat_room
+    rooms, room = room_of(peer_socket)
+    if rooms is not chat_rooms:
+        return None, None
 
-    if room is None:
-        return room, None
+    session = clients[peer_socket]
+    session.chat_rooms = session.room = None
+    chat_rooms[room].pop(peer_socket)
     return room, chat_rooms[room]
 
 
 def end_session(peer_socket):
     """
-    this function receives a peer socket as input and removes it from all rooms (private/group),
-    if available using the remove_participant function.
+    this function receives a peer socket as input and removes it from its room (private/group),
+    if available using the remove_participant function. empty rooms are closed.
     """
-    room, participant_sockets = remove_participant(private_chat_rooms, peer_socket)
+    chat_rooms, room = room_of(peer_socket)
+    if chat_rooms is None:
+        return None
 
-    if participant_sockets is None:
-        room, participant_sockets = remove_participant(group_chat_rooms, peer_socket)
-        if len(participant_sockets) == 0:
-            group_chat_rooms.pop(room)
+    room, participant_sockets = remove_participant(chat_rooms, peer_socket)
 
-    else:
-        if len(participant_sockets) == 0:
-            private_chat_rooms.pop(room)
+    if len(participant_sockets) == 0:
+        chat_rooms.pop(room)
 
     return participant_sockets
 
 
-def register_new_users():
+def accept_connection(tcp_socket):
     """
-    this function is executed by a specific thread. the purpose of this function is to keep
-    checking the tcp socket of the server if it has anything to be read. If so, the program
-    is sure that a new user has registered in the chatting application, hence the message
-    is read from the socket and necessary actions are taken.
+    this function is called by the event loop whenever the tcp socket of the server is
+    readable, which means that a new client is connecting. the client socket is registered
+    in the selector so that its registration message is read as soon as it arrives.
     """
-    while True:
-        # select.select will make use of OS and it will wait until a file descriptor is ready for IO
-        read_sockets, useless, exceptional_sockets = select.select(sockets, [], sockets, 0)
+    try:
+        client_socket, client_address = tcp_socket.accept()
+    except (BlockingIOError, InterruptedError, ConnectionAbortedError): # taken by another worker or reset by the client
+        return
+    connection_stats['accepted'] += 1
+    connection_addresses[client_socket] = client_address
+    client_socket.setblocking(False)
+    set_tcp_options(client_socket)
+    buffers[client_socket] = FrameBuffer()
+    outbound[client_socket] = OutboundQueue()
+    selector.register(client_socket, selectors.EVENT_READ, register_new_user)
+
+
+def handle_registration(client_socket, client_address):
+    """
+    this function takes the first message of a new client from its frame buffer and registers
+    the client. it returns None if the message has not been completely received yet, True if the
+    client has been registered and False if the registration has failed. once registered, the
+    frame buffer of the client switches to the negotiated protocol version, which is confirmed
+    to version 2 clients by a REGISTERED message along with the negotiated compression method,
+    and the messages stored while the client was
+    offline are delivered.
+    """
+    try:
+        frame = buffers[client_socket].next_frame()
+        if frame is None:
+            return None
+        client_data = build_client(*parse_command(*frame))
+    except (ProtocolError, ValueError, IndexError):
+        client_data = False
+
+    if not client_data:
+        connection_stats['failed'] += 1
+        logger.warning(f'registering the new user with address {client_address} failed')
+        return False
+
+    connection_stats['registered'] += 1
+    add_client(client_socket, client_data, client_address)
+    buffers[client_socket].version = client_data.version
+    logger.info(f"accepted/registered new connection from {client_address}:{client_address[1]} username: {client_data.username} protocol version: {client_data.version} compression: {client_data.compression or 'none'}")
+
+    if client_data.version >= 2:
+        send_buffers(client_socket, encode_response(1, client_socket, OP_REGISTERED,
+                                                     [str(client_data.version)] + ([client_data.compression] if client_data.compression else [])))
+
+    if store is not None:
+        deliver_stored_messages(client_socket)
+
+    return True
+
+
+def register_new_user(client_socket):
+    """
+    this function is called by the event loop when a freshly accepted client socket has
+    something to be read. the program is sure that a new user is registering in the chatting
+    application, hence the message is read from the socket and necessary actions are taken.
+    the messages received right after the registration message are dispatched as well. a
+    connection failing before the client is registered is terminated, so that its socket is
+    released.
+    """
+    client_address = connection_addresses[client_socket]
+    try:
+        registered = recieve_message(client_socket) and handle_registration(client_socket, client_address)
+    except OSError as error:
+        logger.warning(f'registering the new user with address {client_address} failed: {error}')
+        registered = False
+
+    if registered is None:
+        return
+
+    if not registered:
+        terminate_client(client_socket)
+        return
+
+    selector.modify(client_socket, selector.get_key(client_socket).events, process_message)
+    dispatch_frames(client_socket)
+
 
-        if tcp_socket not in read_sockets:
+def leave_room(client_socket):
+    """
+    this function gets the socket of a client being terminated and removes the client from its
+    room, if any. the other member of a private room is informed and released from the room, the
+    remaining members of a group room are informed that the client has left.
+    """
+    chat_rooms, room = room_of(client_socket)
+    if chat_rooms is None or client_socket not in clients:
+        return
+
+    participant_sockets = end_session(client_socket)
+    username = clients[client_socket].username
+
+    if chat_rooms is private_chat_rooms:
+        for remaining_socket in list(participant_sockets):
+            send_response(remaining_socket, client_socket, OP_CLIENTEXIT, f'{username} left the chat room. the chat room has been closed')
+            set_in_session(remaining_socket, False)
+            end_session(remaining_socket)
+    else:
+        broadcast(participant_sockets, client_socket, OP_TEXT, f'{username} left the chat room.')
+
+
+def terminate_client(client_socket):
+    """
+    this function gets a client socket as input, removes it from its room, the clients dictionary
+    and the selector and closes the socket. the buffers sent to the client during the current
+    tick are sent before the socket is closed. the socket is unregistered and closed even if
+    the client can not be removed cleanly, so that a broken connection never stays in the
+    selector.
+    """
+    try:
+        try:
+            leave_room(client_socket)
+        except OSError:
+            logger.exception('informing the room members of a terminated client failed')
+
+        remove_client(client_socket)
+        if client_socket in tick_writes:
+            del tick_writes[client_socket]
+            flush_outbound(client_socket)
+    finally:
+        buffers.pop(client_socket, None)
+        outbound.pop(client_socket, None)
+        connection_addresses.pop(client_socket, None)
+        if isinstance(client_socket, socket.socket) and client_socket in selector.get_map():
+            selector.unregister(client_socket)
+        client_socket.close()
+
+
+def reset_activity(udp_socket):
+    """
+    this function is called by the event loop whenever the udp socket of the server is readable.
+    the program is sure that it has received HELLO messages from clients, hence every pending
+    datagram is read (up to HELLO_BATCH_SIZE), the HELLO messages of each client are coalesced
+    and the activity deadlines are reset with a single bulk update.
+    """
+    hello_usernames = set()
+
+    for _ in range(HELLO_BATCH_SIZE):
+        try:
+            datagram, ancdata, flags, address = udp_socket.recvmsg(HELLO_SIZE, HELLO_ANCILLARY_SIZE)
+        except BlockingIOError: # the receive buffer has been drained
+            break
+
+        heartbeat_stats['received'] += 1
+        record_kernel_drops(ancdata)
+
+        try:
+            opcode, fields = parse_datagram(datagram)
+        except ValueError:
+            opcode, fields = None, []
+
+        if opcode != OP_HELLO or not fields:
+            heartbeat_stats['malformed'] += 1
             continue
 
-        client_socket, client_address = tcp_socket.accept()
+        if fields[-1] in hello_usernames:
+            heartbeat_stats['coalesced'] += 1
+        hello_usernames.add(fields[-1])
+
+    apply_hellos(hello_usernames)
 
-        client_data = recieve_message(client_socket)
 
-        if not client_data:
-            logger.warning(f'registering the new user with address {client_address} failed')
+def record_kernel_drops(ancdata):
+    """
+    this function gets the ancillary data of a received datagram and updates the number of HELLO
+    datagrams dropped by the kernel, which is reported by SO_RXQ_OVFL on linux.
+    """
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and len(data) >= 4:
+            dropped = int.from_bytes(data[:4], sys.byteorder)
+            if dropped > heartbeat_stats['dropped']:
+                logger.warning(f'{dropped - heartbeat_stats["dropped"]} HELLO messages have been dropped by the kernel. consider increasing --udp-rcvbuf')
+                heartbeat_stats['dropped'] = dropped
+
+
+def apply_hellos(hello_usernames):
+    """
+    this function gets the usernames of the clients which have sent a HELLO message and resets
+    their activity deadlines at once. the HELLO messages of clients registered on another worker
+    are forwarded to that worker.
+    """
+    now = time.monotonic()
+    deadline = now + ACTIVITY_LIMIT
+    forwarded = {} # node id -> usernames of the clients of that node
+
+    for client_username in hello_usernames:
+        client_socket = get_socket(client_username)
+        if client_socket is None: # the client has already been terminated
+            heartbeat_stats['late'] += 1
             continue
 
-        sockets.append(client_socket)
-        clients[client_socket] = client_data
-        logger.info(f"accepted/registered new connection from {client_address}:{client_address[1]} username: {client_data['data'].decode('utf-8')}")
+        if isinstance(client_socket, RemoteClient): # the client is registered on another worker
+            forwarded.setdefault(client_socket.node, []).append(client_username)
+            continue
+
+        client_data = clients[client_socket]
+        if client_data.deadline <= now: # the client is about to be terminated
+            heartbeat_stats['late'] += 1
+
+        client_data.deadline = deadline
+        if hello_log.allow():
+            logger.debug(f'resetting activity time from {client_data.address}:{client_data.address[1]} username: {client_username}{hello_log.suppressed()}')
+
+    for node, node_usernames in forwarded.items():
+        route(node, LINK_HEARTBEAT, node_usernames)
+
+    if hello_usernames and hello_batch_log.allow():
+        logger.info(f'resetting activity time of {len(hello_usernames)} clients{hello_batch_log.suppressed()}')
 
 
 def update_activity():
     """
-    this function is executed by a specific thread. the purpose of this function is to keep
-    listening the udp socket of the server. if it has anything to be read, the program is sure
-    that it has received a HELLO message from a client, hence it will reset the activity time
-    for that specific client. if the udp socket has received nothing, then the program will decrease
-    the activity times of each client by a specific number of seconds.
+    this function is called by the event loop whenever the earliest activity deadline may have
+    passed. it pops the expired entries from the top of the deadline heap, reschedules the entries
+    of the clients which have sent a HELLO message since they were pushed and terminates the clients
+    whose activity time has run out. it returns the number of seconds until the next deadline.
     """
-    while True:
-        # select.select will make use of OS and it will wait until a file descriptor is ready for IO
-        read_sockets, useless, exceptional_sockets = select.select(sockets, [], sockets, 0)
+    now = time.monotonic()
 
-        if udp_socket not in read_sockets:
-            for client_socket in clients.copy():
+    while activity_deadlines and activity_deadlines[0][0] <= now:
+        deadline, sequence, client_socket = heapq.heappop(activity_deadlines)
+        client_data = clients.get(client_socket)
 
-                try:
-                    client_address = client_socket.getpeername()
-                    waited_duration = time.time() - clients[client_socket]['start_time']
-                    clients[client_socket]['activity'] -= waited_duration
-                    clients[client_socket]['start_time'] = time.time()
+        if client_data is None: # the client has already been removed
+            continue
 
-                    if clients[client_socket]['activity'] <= 0:
-                        logger.info(f'terminating {client_address}:{client_address[1]} username: {clients[client_socket]["data"].decode("utf-8")}')
-                        clients.pop(client_socket)
-                        sockets.remove(client_socket)
+        if client_data.deadline > now:
+            heapq.heappush(activity_deadlines, (client_data.deadline, next(deadline_sequence), client_socket))
+            continue
 
-                except KeyError:
-                    continue
+        client_address = client_data.address
+        logger.info(f'terminating {client_address}:{client_address[1]} username: {client_data.username}')
+        heartbeat_stats['expired'] += 1
+        terminate_client(client_socket)
 
-        else:
-            message = udp_socket.recvfrom(256)
-            decoded_message = message[0].decode('utf-8')
-            client_username = (decoded_message.split('|')[-1]).strip()
-            client_socket = get_socket(client_username)
-            client_address = client_socket.getpeername()
-            clients[client_socket]['activity'] = ACTIVITY_LIMIT
-            logger.info(f'resetting activity time from {client_address}:{client_address[1]} username: {clients[client_socket]["data"].decode("utf-8")}')
+    if not activity_deadlines: # a client registering from now on expires in ACTIVITY_LIMIT seconds at the earliest
+        return ACTIVITY_LIMIT
+    return activity_deadlines[0][0] - now
 
 
-def process_message():
+def process_message(notified_socket):
     """
-    this function is executed by a specific thread. the purpose of this function is to receive
-    client messages sent to the server and take specific actions. for instance, if the server
-    receives a SEARCH message, it performs some specific actions and returns a response to the
-    client making the SEARCH. please refer to the project report for a complete detail on such
-    messages.
+    this function is called by the event loop whenever a registered client socket has something
+    to be read. the received bytes are appended to the frame buffer of the client and every
+    complete message is dispatched.
     """
-    total_private_rooms = 0
-    total_global_rooms = 0
+    if not recieve_message(notified_socket):
+        # the client has closed the connection
+        if notified_socket in clients:
+            client_address = clients[notified_socket].address
+            logger.info(f'connection closed by {client_address}:{client_address[1]} username: {clients[notified_socket].username}')
+        terminate_client(notified_socket)
+        return
 
-    while True:
+    dispatch_frames(notified_socket)
 
-        # select.select will make use of OS and it will wait until a file descriptor is ready for IO
-        read_sockets, useless, exceptional_sockets = select.select(sockets, [], sockets, 0)
 
-        for notified_socket in read_sockets:
+def dispatch_frames(client_socket):
+    """
+    this function takes every complete message from the frame buffer of a client and hands it
+    over to dispatch_message. a client sending bytes which can not be parsed is terminated. the
+    time taken by each command is recorded in the latency histogram of its opcode. the messages
+    following a command which has terminated the client (a LOGOUT) are discarded.
+    """
+    buffer = buffers[client_socket]
 
-            if notified_socket == tcp_socket or notified_socket == udp_socket:
-                continue
-            
-            try:
-                in_session = clients[notified_socket]['in_session']
-            except KeyError:
-                continue
-
-            message = recieve_message(notified_socket)
-
-            if not message:
-                # remove the socket here
-                continue
-            
-            decoded_message = message['data'].decode('utf-8')
-
-            if decoded_message == '&&LOGOUT&&' and not in_session:
-                # we do not remove the client socket immediately in here as it will be removed
-                # by udp socket anyways
-                message['data'] = '&&LOGOUTSUCCESS&&'.encode('utf-8')
-                message['header'] = f"{len(message['data']) :< {HEADER_LENGTH}}".encode('utf-8')
-                notified_socket.send(clients[notified_socket]['header'] + clients[notified_socket]['data'] + message['header'] + message['data'])
-            
-            elif '&&SEARCH&&' in decoded_message and not in_session:
-                searched_peer = (decoded_message.split('|')[-2]).strip()
-                sender_username = (decoded_message.split('|')[-1]).strip()
-            
-                response = search_peer(searched_peer)
-            
-                if response == None: # if search result is None
-                    response = '&&NOTFOUND&&|user not found'
-                elif searched_peer == sender_username: # if user have searched him/herself
-                    response = '&&INVALIDSEARCH&&|you can\'t search yourself. search for other users'
-                else: # a match has been found for the search
-                    response = f'&&FOUND&&|{searched_peer} found. its address is ' + str(response)
-
-                # send search results back to the user making the search
-                sender_socket = get_socket(sender_username)
-                message['data'] = response.encode('utf-8')
-                message['header'] = f"{len(message['data']) :< {HEADER_LENGTH}}".encode('utf-8')
-                sender_socket.send(clients[notified_socket]['header'] + clients[notified_socket]['data'] + message['header'] + message['data'])
-
-            elif '&&CHATREQUEST&&' in decoded_message and not in_session:
-                searched_peer = (decoded_message.split('|')[-2]).strip()
-                sender_username = (decoded_message.split('|')[-1]).strip()
-
-                client_socket = get_socket(searched_peer)
-                sender_socket = get_socket(sender_username)
-
-                if client_socket is None:
-                    continue
-
-                if is_busy(client_socket): # check if the searched peer is busy
-                    message['data'] = f'&&BUSY&&|the user is busy. try again later.'.encode('utf-8')
-                    message['header'] = f"{len(message['data']) :< {HEADER_LENGTH}}".encode('utf-8')
-                    sender_socket.send(clients[notified_socket]['header'] + clients[notified_socket]['data'] + message['header'] + message['data'])
-
-                else: # if not busy, send a message and inform them about the chat request
-                    message['data'] = f'{sender_username} would like to chat with you? (OK/REJECT)'.encode('utf-8')
-                    message['header'] = f"{len(message['data']) :< {HEADER_LENGTH}}".encode('utf-8')
-                    client_socket.send(clients[notified_socket]['header'] + clients[notified_socket]['data'] + message['header'] + message['data'])
-            
-            elif '&&REJECT&&' in decoded_message and not in_session:
-                sender_username = (decoded_message.split('|')[-1]).strip()
-                peer_username =  (decoded_message.split('|')[-2]).strip()
-
-                sender_socket = get_socket(sender_username)
-                peer_socket = get_socket(peer_username)
-
-                # send message to both sender and receiver about the rejection of chat request
-                message['data'] = f'you have rejected the chat request!'.encode('utf-8')
-                message['header'] = f"{len(message['data']) :< {HEADER_LENGTH}}".encode('utf-8')
-                peer_socket.send(clients[notified_socket]['header'] + clients[notified_socket]['data'] + message['header'] + message['data'])
-
-                message['data'] = f'{peer_username} rejected the chat request!'.encode('utf-8')
-                message['header'] = f"{len(message['data']) :< {HEADER_LENGTH}}".encode('utf-8')
-                sender_socket.send(clients[notified_socket]['header'] + clients[notified_socket]['data'] + message['header'] + message['data'])
-
-            elif '&&OK&&' in decoded_message and not in_session:
-                peer_server_port = (decoded_message.split('|')[-1]).strip()
-                sender_username = (decoded_message.split('|')[-2]).strip()
-                peer_username =  (decoded_message.split('|')[-3]).strip()
-
-                peer1_socket = get_socket(sender_username)
-                peer2_socket = get_socket(peer_username)
-
-                sender_server_port = clients[peer1_socket]['server_port']
-
-                # update attributes of users and create a private room
-                total_private_rooms += 1
-                private_chat_rooms[str(total_private_rooms)] = [peer1_socket, peer2_socket]
-                clients[peer1_socket]['in_session'] = True
-                clients[peer2_socket]['in_session'] = True
-
-                # send a message to both sender and receiver about the start of the chat session
-                message['data'] = f'&&CLIENTOK&&|{peer_username} accepted the chat request. you can send your message now!|{peer_server_port}'.encode('utf-8')
-                message['header'] = f"{len(message['data']) :< {HEADER_LENGTH}}".encode('utf-8')
-                peer1_socket.send(clients[notified_socket]['header'] + clients[notified_socket]['data'] + message['header'] + message['data'])
-
-                message['data'] = f'&&CLIENTOK&&|you have entered into a private chat with {sender_username}. you can send your message now!|{sender_server_port}'.encode('utf-8')
-                message['header'] = f"{len(message['data']) :< {HEADER_LENGTH}}".encode('utf-8')
-                peer2_socket.send(clients[notified_socket]['header'] + clients[notified_socket]['data'] + message['header'] + message['data'])
-
-            elif '&&EXIT&&' in decoded_message and in_session:
-                peer_username = (decoded_message.split('|')[-1]).strip()
-                peer_socket = get_socket(peer_username)
-
-                participant_sockets = end_session(peer_socket)
-                # send a message to both sender and receiver about the end of the chat session
-                message['data'] = f'&&CLIENTEXIT&&|you left the chat room.'.encode('utf-8')
-                message['header'] = f"{len(message['data']) :< {HEADER_LENGTH}}".encode('utf-8')
-                peer_socket.send(clients[notified_socket]['header'] + clients[notified_socket]['data'] + message['header'] + message['data'])
-
-                message['data'] = f'&&CLIENTEXIT&&|{peer_username} left the chat room. the chat room has been closed'.encode('utf-8')
-                message['header'] = f"{len(message['data']) :< {HEADER_LENGTH}}".encode('utf-8')
-                participant_sockets[0].send(clients[notified_socket]['header'] + clients[notified_socket]['data'] + message['header'] + message['data'])
-
-                # update user attributes
-                clients[peer_socket]['in_session'] = False
-                clients[participant_sockets[0]]['in_session'] = False
-
-                res = end_session(participant_sockets[0])
-
-            elif '&&GROUPCHAT&&' in decoded_message and not in_session:
-                tokens = decoded_message.split('|')
-                peers = tokens[2:-1]
-                sender_username = tokens[1]
-                total_global_rooms += 1
-
-                # add the group admin to the group chat and let him/her know
-                message['data'] = f'you have added yourself to group chat {total_global_rooms}. a request has been sent to your added friends. type EXIT GROUP to leave.'.encode('utf-8')
-                message['header'] = f"{len(message['data']) :< {HEADER_LENGTH}}".encode('utf-8')
-
-                admin_socket = get_socket(sender_username)
-                group_chat_rooms[str(total_global_rooms)] = [admin_socket]
-                clients[admin_socket]['in_session'] = True
-                admin_socket.send(clients[notified_socket]['header'] + clients[notified_socket]['data'] + message['header'] + message['data'])
-
-                # send an exclusive message to each invited client and ask for their response
-                message['data'] = f'{sender_username} would like to add you to group chat room {total_global_rooms}? (OK/REJECT GROUP <room_number>)'.encode('utf-8')
-                message['header'] = f"{len(message['data']) :< {HEADER_LENGTH}}".encode('utf-8')
-
-                for peer in peers:
-                    peer_socket = get_socket(peer)
-
-                    if peer_socket is None:
-                        continue
-                    
-                    elif is_busy(peer_socket):
-                        message['data'] = f'&&BUSY&&|{peer} is busy. try again later.'.encode('utf-8')
-                        message['header'] = f"{len(message['data']) :< {HEADER_LENGTH}}".encode('utf-8')
-                        admin_socket.send(clients[notified_socket]['header'] + clients[notified_socket]['data'] + message['header'] + message['data'])
-
-                    else:
-                        peer_socket.send(clients[notified_socket]['header'] + clients[notified_socket]['data'] + message['header'] + message['data'])
-
-            elif '&&REJECTGROUP&&' in decoded_message and not in_session:
-                group_number = (decoded_message.split('|')[-1]).strip()
-                peer_username =  (decoded_message.split('|')[-2]).strip()
-                peer_socket = get_socket(peer_username)
-
-                # send a message to the rejector and group admin about the invitation rejection
-                message['data'] = f'you have rejected the group chat request!'.encode('utf-8')
-                message['header'] = f"{len(message['data']) :< {HEADER_LENGTH}}".encode('utf-8')
-                peer_socket.send(clients[notified_socket]['header'] + clients[notified_socket]['data'] + message['header'] + message['data'])
+    while client_socket in buffers:
+        try:
+            frame = buffer.next_frame()
+        except ProtocolError as error:
+            logger.warning(f'terminating {connection_addresses.get(client_socket)} after a protocol error: {error}')
+            terminate_client(client_socket)
+            return
+
+        if frame is None:
+            return
+
+        start = time.perf_counter()
+        opcode = None
+        try:
+            opcode, fields = parse_command(*frame)
+            dispatch_message(client_socket, opcode, fields)
+        except Exception:
+            command_errors[opcode] = command_errors.get(opcode, 0) + 1
+            logger.exception(f'an error occured while handling a message from {connection_addresses.get(client_socket)}')
+
+        histogram = command_latency.get(opcode)
+        if histogram is None:
+            histogram = command_latency[opcode] = Histogram()
+        histogram.observe(time.perf_counter() - start)
+
+
+# command registry: opcode -> (handler, session state the client must be in, None for any state).
+# handlers are called with the socket of the client and the fields of the command
+commands = {}
+
+
+def register_command(opcode, handler, in_session=None, marker=None):
+    """
+    this function registers the handler of the commands with the given opcode. the handler is
+    only called for clients in a chat room if in_session is True, for clients in no chat room if
+    it is False, and for every client if it is None. a marker makes the opcode known to version 1
+    clients. a handler registered for an opcode replaces the previous one, so commands can be
+    added or overridden by modules importing the server.
+    """
+    commands[opcode] = (handler, in_session)
+    if marker is not None:
+        add_marker(opcode, marker)
+
+
+def handle_logout(notified_socket, fields):
+    """
+    this function handles a LOGOUT command: the logout is acknowledged and the client is
+    terminated, so that the connection does not outlive the session whose activity deadline
+    would have expired it.
+    """
+    send_response(notified_socket, notified_socket, OP_LOGOUTSUCCESS)
+    terminate_client(notified_socket)
+
+
+def handle_search(notified_socket, fields):
+    """
+    this function handles a SEARCH command (searched username, username of the client): the
+    address of the searched user is sent back to the client.
+    """
+    searched_peer = fields[-2]
+    sender_username = fields[-1]
+
+    response = search_peer(searched_peer)
+
+    # send search results back to the user making the search
+    sender_socket = get_socket(sender_username)
+
+    if response == None: # if search result is None
+        send_response(sender_socket, notified_socket, OP_NOTFOUND, 'user not found')
+    elif searched_peer == sender_username: # if user have searched him/herself
+        send_response(sender_socket, notified_socket, OP_INVALIDSEARCH, 'you can\'t search yourself. search for other users')
+    else: # a match has been found for the search
+        send_response(sender_socket, notified_socket, OP_FOUND, f'{searched_peer} found. its address is ' + str(response))
 
-                message['data'] = f'{peer_username} rejected the group chat request!'.encode('utf-8')
-                message['header'] = f"{len(message['data']) :< {HEADER_LENGTH}}".encode('utf-8')
-                group_chat_rooms[group_number][0].send(clients[notified_socket]['header'] + clients[notified_socket]['data'] + message['header'] + message['data'])
-
-            elif '&&OKGROUP&&' in decoded_message and not in_session:
-                group_number = (decoded_message.split('|')[-1]).strip()
-                peer_username =  (decoded_message.split('|')[-2]).strip()
 
-                peer_socket = get_socket(peer_username)
+def handle_prefix_search(notified_socket, fields):
+    """
+    this function handles a PREFIXSEARCH command (prefix, maximum number of results, optional):
+    the usernames starting with the prefix are sent back to the client in sorted order, as a
+    PREFIXRESULT message holding the prefix followed by the usernames.
+    """
+    prefix = fields[0] if fields else ''
+    limit = min(int(fields[1]), PREFIX_SEARCH_MAX_LIMIT) if len(fields) > 1 and fields[1].isdigit() else PREFIX_SEARCH_LIMIT
+
+    send_response(notified_socket, notified_socket, OP_PREFIXRESULT, prefix, *prefix_search(prefix, limit))
+
 
-                # update attributes of the acceptor
-                group_chat_rooms[group_number].append(peer_socket)
-                clients[peer_socket]['in_session'] = True
+def handle_subscribe(notified_socket, fields):
+    """
+    this function handles a SUBSCRIBE command (usernames...): the client is sent a PRESENCE
+    message whenever one of the users comes online or goes offline, so that it does not have to
+    poll them with SEARCH commands. the usernames replace those of the previous subscription of
+    the client, hence a SUBSCRIBE without usernames ends it. the current state of the users is
+    sent right away, as a PRESENCE message holding those who are online and one holding those
+    who are offline.
+    """
+    session = clients[notified_socket]
+    unsubscribe(notified_socket, session)
 
-                # send a message to all members of a group chat in the room
-                message['data'] = f'{peer_username} joined the group chat'.encode('utf-8')
-                message['header'] = f"{len(message['data']) :< {HEADER_LENGTH}}".encode('utf-8')
+    watched = [username for username in dict.fromkeys(fields) if username][:SUBSCRIPTION_LIMIT]
+    if not watched:
+        return
 
-                for client_socket in group_chat_rooms[group_number]:
-                    client_socket.send(clients[notified_socket]['header'] + clients[notified_socket]['data'] + message['header'] + message['data'])
+    session.subscriptions = watched
+    for username in watched:
+        subscribers.setdefault(username, {})[notified_socket] = None
 
-            elif '&&EXITGROUP&&' in decoded_message and in_session:
-                peer_username = (decoded_message.split('|')[-1]).strip()
-                peer_socket = get_socket(peer_username)
+    online = [username for username in watched if username in usernames]
+    offline = [username for username in watched if username not in usernames]
+    if online:
+        send_response(notified_socket, notified_socket, OP_PRESENCE, 'online', *online)
+    if offline:
+        send_response(notified_socket, notified_socket, OP_PRESENCE, 'offline', *offline)
 
-                participant_sockets = end_session(peer_socket)
 
-                # send a message to both leaver and all other members about the leaving of the client
-                message['data'] = f'you left the chat room.'.encode('utf-8')
-                message['header'] = f"{len(message['data']) :< {HEADER_LENGTH}}".encode('utf-8')
-                peer_socket.send(clients[notified_socket]['header'] + clients[notified_socket]['data'] + message['header'] + message['data'])
+def handle_chat_request(notified_socket, fields):
+    """
+    this function handles a CHAT REQUEST command (requested username, username of the client):
+    the requested user is asked whether to accept the private chat, or the request is stored if
+    the user is offline.
+    """
+    searched_peer = fields[-2]
+    sender_username = fields[-1]
 
-                message['data'] = f'{peer_username} left the chat room.'.encode('utf-8')
-                message['header'] = f"{len(message['data']) :< {HEADER_LENGTH}}".encode('utf-8')
-                clients[peer_socket]['in_session'] = False
+    client_socket = get_socket(searched_peer)
+    sender_socket = get_socket(sender_username)
 
-                for client_socket in participant_sockets:
-                    client_socket.send(clients[notified_socket]['header'] + clients[notified_socket]['data'] + message['header'] + message['data'])
+    if client_socket is None:
+        text = f'{sender_username} would like to chat with you? (OK/REJECT)'
+        if queue_for_offline_user(searched_peer, notified_socket, OP_TEXT, text):
+            send_response(sender_socket, notified_socket, OP_TEXT, f'{searched_peer} is offline. the chat request will be delivered when {searched_peer} is back.')
+        return
 
-            elif '&&MESSAGE&&' in decoded_message and in_session:
-                # send group message to all clients in a specific group chat room
-                process_text_message(notified_socket, message)
+    if is_busy(client_socket): # check if the searched peer is busy
+        send_response(sender_socket, notified_socket, OP_BUSY, 'the user is busy. try again later.')
 
+    else: # if not busy, send a message and inform them about the chat request
+        send_response(client_socket, notified_socket, OP_TEXT, f'{sender_username} would like to chat with you? (OK/REJECT)')
 
-register_user_thread = threading.Thread(target=register_new_users)
-register_user_thread.start()
-logger.info('successfully started register user thread')
 
-update_activity_thread = threading.Thread(target=update_activity)
-update_activity_thread.start()
-logger.info('successfully started update activity thread')
+def handle_reject(notified_socket, fields):
+    """
+    this function handles a REJECT command (username of the client, username of the requester)
+    by informing both users of the rejection of the chat request.
+    """
+    sender_username = fields[-1]
+    peer_username = fields[-2]
+
+    sender_socket = get_socket(sender_username)
+    peer_socket = get_socket(peer_username)
+
+    # send message to both sender and receiver about the rejection of chat request
+    send_response(peer_socket, notified_socket, OP_TEXT, 'you have rejected the chat request!')
+    send_response(sender_socket, notified_socket, OP_TEXT, f'{peer_username} rejected the chat request!')
+
+
+def handle_ok(notified_socket, fields):
+    """
+    this function handles an OK command (username of the client, username of the requester,
+    port of the client): a private room is created for both users, who are sent the port of the
+    tcp server of each other, and the compression method of each other if they speak version 2.
+    """
+    global total_private_rooms
+
+    peer_server_port = fields[-1]
+    sender_username = fields[-2]
+    peer_username = fields[-3]
+
+    peer1_socket = get_socket(sender_username)
+    peer2_socket = get_socket(peer_username)
+
+    sender_server_port = clients[peer1_socket].server_port
+
+    # update attributes of users and create a private room
+    total_private_rooms += 1
+    join_room(private_chat_rooms, str(total_private_rooms), peer1_socket)
+    join_room(private_chat_rooms, str(total_private_rooms), peer2_socket)
+    set_in_session(peer1_socket, True)
+    set_in_session(peer2_socket, True)
+
+    # send a message to both sender and receiver about the start of the chat session. version 1
+    # clients read the port from the last field, so the compression method is not sent to them
+    peer1_fields = [str(peer_server_port)] + ([clients[peer2_socket].compression] if clients[peer1_socket].version >= 2 else [])
+    peer2_fields = [str(sender_server_port)] + ([clients[peer1_socket].compression] if clients[peer2_socket].version >= 2 else [])
+    send_response(peer1_socket, notified_socket, OP_CLIENTOK, f'{peer_username} accepted the chat request. you can send your message now!', *peer1_fields)
+    send_response(peer2_socket, notified_socket, OP_CLIENTOK, f'you have entered into a private chat with {sender_username}. you can send your message now!', *peer2_fields)
+
+
+def handle_exit(notified_socket, fields):
+    """
+    this function handles an EXIT command (username of the client) by closing the private room
+    of the client.
+    """
+    peer_username = fields[-1]
+    peer_socket = get_socket(peer_username)
+
+    participant_sockets = end_session(peer_socket)
+    remaining_socket = next(iter(participant_sockets))
+
+    # send a message to both sender and receiver about the end of the chat session
+    send_response(peer_socket, notified_socket, OP_CLIENTEXIT, 'you left the chat room.')
+    send_response(remaining_socket, notified_socket, OP_CLIENTEXIT, f'{peer_username} left the chat room. the chat room has been closed')
+
+    # update user attributes
+    set_in_session(peer_socket, False)
+    set_in_session(remaining_socket, False)
+
+    end_session(remaining_socket)
+
+
+def handle_group_chat(notified_socket, fields):
+    """
+    this function handles a GROUP CHAT command (username of the client, invited usernames...):
+    a group room is created with the client as its admin, and the invited users are asked
+    whether to join it.
+    """
+    global total_global_rooms
+
+    sender_username = fields[0]
+    peers = [peer for peer in fields[1:] if peer]
+    total_global_rooms += 1
+    group_number = room_name(total_global_rooms)
+
+    # add the group admin to the group chat and let him/her know
+    admin_socket = get_socket(sender_username)
+    join_room(group_chat_rooms, group_number, admin_socket)
+    set_in_session(admin_socket, True)
+    send_response(admin_socket, notified_socket, OP_TEXT, f'you have added yourself to group chat {group_number}. a request has been sent to your added friends. type EXIT GROUP to leave.')
+
+    # send an exclusive message to each invited client and ask for their response
+    for peer in peers:
+        peer_socket = get_socket(peer)
+
+        if peer_socket is None:
+            queue_for_offline_user(peer, notified_socket, OP_TEXT, f'{sender_username} would like to add you to group chat room {group_number}? (OK/REJECT GROUP <room_number>)')
+            continue
+
+        elif is_busy(peer_socket):
+            send_response(admin_socket, notified_socket, OP_BUSY, f'{peer} is busy. try again later.')
+
+        else:
+            send_response(peer_socket, notified_socket, OP_TEXT, f'{sender_username} would like to add you to group chat room {group_number}? (OK/REJECT GROUP <room_number>)')
+
+
+def handle_reject_group(notified_socket, fields):
+    """
+    this function handles a REJECT GROUP command (username of the client, room number) by
+    informing the client and the admin of the room of the rejection.
+    """
+    group_number = fields[-1]
+    peer_username = fields[-2]
+    peer_socket = get_socket(peer_username)
+
+    # send a message to the rejector and group admin about the invitation rejection
+    send_response(peer_socket, notified_socket, OP_TEXT, 'you have rejected the group chat request!')
+    admin_socket = next(iter(group_chat_rooms[group_number]))
+    send_response(admin_socket, notified_socket, OP_TEXT, f'{peer_username} rejected the group chat request!')
+
+
+def handle_ok_group(notified_socket, fields):
+    """
+    this function handles an OK GROUP command (username of the client, room number) by adding
+    the client to the group room.
+    """
+    group_number = fields[-1]
+    peer_username = fields[-2]
+
+    peer_socket = get_socket(peer_username)
+
+    # update attributes of the acceptor
+    if group_number not in group_chat_rooms: # the group chat room has already been closed
+        return
+
+    join_room(group_chat_rooms, group_number, peer_socket)
+    set_in_session(peer_socket, True)
+
+    # send a message to all members of a group chat in the room
+    broadcast(group_chat_rooms[group_number], notified_socket, OP_TEXT, f'{peer_username} joined the group chat')
+
+
+def handle_exit_group(notified_socket, fields):
+    """
+    this function handles an EXIT GROUP command (username of the client) by removing the client
+    from its group room.
+    """
+    peer_username = fields[-1]
+    peer_socket = get_socket(peer_username)
+
+    participant_sockets = end_session(peer_socket)
+    set_in_session(peer_socket, False)
+
+    # send a message to both leaver and all other members about the leaving of the client
+    send_response(peer_socket, notified_socket, OP_TEXT, 'you left the chat room.')
+
+    broadcast(participant_sockets, notified_socket, OP_TEXT, f'{peer_username} left the chat room.')
+
+
+def dispatch_message(notified_socket, opcode, fields):
+    """
+    the purpose of this function is to take specific actions for client messages sent to the
+    server. for instance, if the server receives a SEARCH message, it performs some specific
+    actions and returns a response to the client making the SEARCH. the opcode and the fields
+    of the message are the same whatever the protocol version of the client, and the handler of
+    the opcode is looked up in the command registry. please refer to the project report for a
+    complete detail on such messages.
+    """
+    session = clients.get(notified_socket)
+    if session is None:
+        return
+
+    room_node = remote_room_node(notified_socket, opcode, fields)
+    if room_node is not None: # the room of the command is owned by another node
+        route(room_node, LINK_COMMAND, [session.username, str(opcode)] + list(fields))
+        return
+
+    command = commands.get(opcode)
+    if command is None: # unknown opcode
+        return
+
+    handler, in_session = command
+    if in_session is None or in_session == session.in_session:
+        handler(notified_socket, fields)
+
+
+register_command(OP_LOGOUT, handle_logout, in_session=False)
+register_command(OP_SEARCH, handle_search, in_session=False)
+register_command(OP_CHATREQUEST, handle_chat_request, in_session=False)
+register_command(OP_REJECT, handle_reject, in_session=False)
+register_command(OP_OK, handle_ok, in_session=False)
+register_command(OP_EXIT, handle_exit, in_session=True)
+register_command(OP_GROUPCHAT, handle_group_chat, in_session=False)
+register_command(OP_REJECTGROUP, handle_reject_group, in_session=False)
+register_command(OP_OKGROUP, handle_ok_group, in_session=False)
+register_command(OP_EXITGROUP, handle_exit_group, in_session=True)
+register_command(OP_MESSAGE, process_text_message, in_session=True)
+register_command(OP_HISTORY, send_history)
+register_command(OP_PREFIXSEARCH, handle_prefix_search)
+register_command(OP_SUBSCRIBE, handle_subscribe)
+
+
+class Histogram:
+    """
+    this class counts observed durations in the buckets bounded by LATENCY_BUCKETS. each bucket
+    only counts its own observations and the cumulative counts are computed when the histogram
+    is rendered, so an observation is a bisection and two additions.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1) # the last bucket counts the longer durations
+        self.sum = 0.0
+
+    def observe(self, duration):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+        self.sum += duration
+
+
+def command_name(opcode):
+    """
+    this function returns the name of the command with the given opcode, as used in the metrics.
+    """
+    return MARKERS[opcode].strip('&') if opcode in MARKERS else 'UNKNOWN'
+
+
+def outbound_depth():
+    """
+    this function returns the number of bytes waiting to be sent to the clients, the number of
+    clients with waiting bytes and the largest number of bytes waiting for a single client.
+    """
+    depths = [queue.size for client_socket, queue in outbound.items() if client_socket not in links]
+    depths += [connection.queued_bytes + connection.writer.transport.get_write_buffer_size()
+               for connection in buffers if isinstance(connection, StreamConnection)]
+    depths = [depth for depth in depths if depth]
+    return sum(depths), len(depths), max(depths, default=0)
+
+
+def render_metrics():
+    """
+    this function returns every metric of the server in the Prometheus text format. counters
+    are read as they are and gauges are computed from the data structures of the server, so
+    nothing is maintained on the hot path apart from the counters and the histograms.
+    """
+    lines = []
+
+    def metric(name, kind, description, samples):
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+
+    metric('chat_start_time_seconds', 'gauge', 'time the server was started at, in seconds since the epoch', [('', start_time)])
+    metric('chat_connections_accepted_total', 'counter', 'client connections accepted', [('', connection_stats['accepted'])])
+    metric('chat_registrations_total', 'counter', 'client registrations by result',
+           [('result="success"', connection_stats['registered']), ('result="failure"', connection_stats['failed'])])
+
+    local_users = len(clients) - len(remote_clients)
+    metric('chat_users', 'gauge', 'registered users by location', [('location="local"', local_users), ('location="remote"', len(remote_clients))])
+    metric('chat_rooms', 'gauge', 'open chat rooms by kind', [('kind="private"', len(private_chat_rooms)), ('kind="group"', len(group_chat_rooms))])
+    metric('chat_links', 'gauge', 'links to other nodes', [('', len(links))])
+    metric('chat_presence_subscriptions', 'gauge', 'subscriptions of clients to the presence of users',
+           [('', sum(len(watchers) for watchers in subscribers.values()))])
+
+    queued_bytes, queued_clients, max_queued_bytes = outbound_depth()
+    metric('chat_outbound_queued_bytes', 'gauge', 'bytes waiting to be sent to the clients', [('', queued_bytes)])
+    metric('chat_outbound_queued_clients', 'gauge', 'clients with bytes waiting to be sent', [('', queued_clients)])
+    metric('chat_outbound_max_queued_bytes', 'gauge', 'largest number of bytes waiting for a single client', [('', max_queued_bytes)])
+    metric('chat_outbound_send_calls_total', 'counter', 'send system calls on the client and link sockets', [('', outbound_stats['send_calls'])])
+    metric('chat_outbound_queued_writes_total', 'counter', 'writes which could not be completed right away', [('', outbound_stats['queued_writes'])])
+    metric('chat_outbound_dropped_messages_total', 'counter', 'messages dropped for slow consumers', [('', outbound_stats['dropped_messages'])])
+    metric('chat_outbound_evicted_clients_total', 'counter', 'slow consumers disconnected', [('', outbound_stats['evicted_clients'])])
+
+    for key, description in [('received', 'HELLO datagrams received'), ('coalesced', 'HELLO messages coalesced within a batch'),
+                             ('late', 'HELLO messages of terminated or expiring clients'), ('malformed', 'unparsable HELLO datagrams'),
+                             ('dropped', 'HELLO datagrams dropped by the kernel'), ('expired', 'clients terminated for inactivity')]:
+        metric(f'chat_heartbeat_{key}_total', 'counter', description, [('', heartbeat_stats[key])])
+
+    metric('chat_command_errors_total', 'counter', 'commands whose handler has failed',
+           [(f'command="{command_name(opcode)}"', count) for opcode, count in command_errors.items()])
+
+    lines.append('# HELP chat_command_duration_seconds time taken to handle the commands')
+    lines.append('# TYPE chat_command_duration_seconds histogram')
+    for opcode, histogram in list(command_latency.items()):
+        labels = f'command="{command_name(opcode)}"'
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram.counts):
+            cumulative += count
+            lines.append(f'chat_command_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'chat_command_duration_seconds_sum{{{labels}}} {histogram.sum}')
+        lines.append(f'chat_command_duration_seconds_count{{{labels}}} {cumulative}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def stats_response(request):
+    """
+    this function returns the HTTP response to a request of the stats port. every path is
+    answered with the metrics of the server.
+    """
+    if not request.startswith(b'GET '):
+        return b'HTTP/1.0 405 Method Not Allowed\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+    body = render_metrics().encode('utf-8')
+    header = f'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+    return header.encode('utf-8') + body
+
+
+def create_stats_socket(stats_port):
+    """
+    this function creates the TCP socket of the stats port and starts listening for requests.
+    """
+    stats_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+    stats_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    stats_socket.bind((IP, stats_port))
+    stats_socket.listen(MAX_CONNECTIONS)
+    stats_socket.setblocking(False)
+    logger.info(f'metrics are served at http://{IP}:{stats_port}/metrics')
+    return stats_socket
+
+
+def accept_stats(stats_socket):
+    """
+    this function is called by the event loop whenever a request of the metrics is connecting to
+    the stats port.
+    """
+    try:
+        connection, _ = stats_socket.accept()
+    except (BlockingIOError, InterruptedError, ConnectionAbortedError):
+        return
+    connection.setblocking(False)
+    stats_requests[connection] = b''
+    selector.register(connection, selectors.EVENT_READ, serve_stats)
+
+
+def serve_stats(connection):
+    """
+    this function is called by the event loop whenever a stats connection has something to be
+    read. once the whole request has been received, the metrics are sent and the connection is
+    closed. the response is small, so it is sent with a blocking call bounded by STATS_TIMEOUT.
+    """
+    try:
+        data = connection.recv(RECV_SIZE)
+    except (BlockingIOError, InterruptedError):
+        return
+    except OSError:
+        data = b''
+
+    request = stats_requests[connection] + data
+    if data and b'\r\n\r\n' not in request and len(request) < RECV_SIZE:
+        stats_requests[connection] = request
+        return
+
+    stats_requests.pop(connection)
+    selector.unregister(connection)
+    if data:
+        connection.settimeout(STATS_TIMEOUT)
+        try:
+            connection.sendall(stats_response(request))
+        except OSError:
+            pass
+    connection.close()
+
+
+async def handle_stats(reader, writer):
+    """
+    this coroutine is the asyncio counterpart of serve_stats.
+    """
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), STATS_TIMEOUT)
+        writer.write(stats_response(request))
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, OSError):
+        pass
+    writer.close()
+
+
+def run_event_loop(tcp_socket, udp_socket):
+    """
+    this function registers the TCP and UDP sockets of the server in the selector and runs the
+    event loop of the server. the loop sleeps in the OS until one of the sockets is ready for IO
+    or until the next activity deadline is due. write events flush the outbound queue of a client
+    and read events are dispatched to the callback of the socket.
+    """
+    selector.register(tcp_socket, selectors.EVENT_READ, accept_connection)
+    selector.register(udp_socket, selectors.EVENT_READ, reset_activity)
+    logger.info('successfully started the event loop')
+
+    timeout = ACTIVITY_LIMIT
+
+    while True:
+        handle_events(timeout)
+        if store is not None: # group commit of the records appended while handling the events
+            store.commit()
+        timeout = min(update_activity(), connect_peer_nodes())
+
+
+def handle_events(timeout):
+    """
+    this function sends the buffers written since the previous call, then waits at most timeout
+    seconds (forever if None) for sockets to be ready and handles their events once. the writes
+    caused by the events are sent at the next call, once the whole tick has been handled.
+    """
+    flush_writes()
+
+    for key, mask in selector.select(timeout):
+        try:
+            if mask & selectors.EVENT_WRITE:
+                flush_outbound(key.fileobj)
+            if mask & selectors.EVENT_READ:
+                key.data(key.fileobj)
+        except Exception:
+            logger.exception(f'an error occured while handling an event of {key.fileobj}')
+
+
+class RemoteClient:
+    """
+    this class stands for a client registered on another node of the cluster. its sendmsg method
+    routes the encoded message to the node of the client, which writes it to the client socket,
+    so the message handlers treat local and remote clients alike.
+    """
+
+    def __init__(self, username, node):
+        self.username = username
+        self.node = node
+
+    def sendmsg(self, buffers):
+        data = b''.join(buffers)
+        route(self.node, LINK_DELIVER, [self.username], data)
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def send_link_frame(link_socket, opcode, fields, data=None):
+    """
+    this function sends a link message to the node at the other end of a link.
+    """
+    send_buffers(link_socket, link_frame_buffers(opcode, fields, data), bounded=False)
+
+
+def route(node, opcode, fields, data=None):
+    """
+    this function sends a link message to the given node, through the coordinator if this node
+    has no link to it. the id of the node is the first field of the message.
+    """
+    link_socket = node_links.get(node, default_link)
+    if link_socket is None:
+        logger.warning(f'no link to node {node}, dropping a link message')
+        return
+
+    send_link_frame(link_socket, opcode, [node] + fields, data)
+
+
+def broadcast_link(opcode, fields):
+    """
+    this function sends a link message to every node this node is linked to.
+    """
+    for link_socket in list(links):
+        send_link_frame(link_socket, opcode, fields)
+
+
+def presence_fields(client_socket):
+    """
+    this function returns the fields of the PRESENCE link message of a local client, which hold
+    its address, its server port, its protocol version, whether it is in a chat room and its
+    compression method.
+    """
+    client_data = clients[client_socket]
+    ip, port = client_data.address[:2]
+    return [client_data.username, node_id, ip, str(port), str(client_data.server_port),
+            str(client_data.version), '1' if client_data.in_session else '0', client_data.compression]
+
+
+def publish_presence(client_socket):
+    """
+    this function informs the other nodes that a local client is registered or that its state
+    has changed.
+    """
+    if not links or isinstance(client_socket, RemoteClient):
+        return
+
+    broadcast_link(LINK_PRESENCE, presence_fields(client_socket))
+
+
+def apply_presence(fields):
+    """
+    this function gets the fields of a PRESENCE link message and adds or updates the
+    RemoteClient of the client, along with its entries in the username and address indexes. a
+    local client keeps its username if a remote client registers with the same username.
+    """
+    username, node, ip, port, server_port, version, busy = fields[:7]
+    compression = fields[7] if len(fields) > 7 else '' # nodes older than compression do not send it
+
+    remote_client = remote_clients.get(username)
+    if remote_client is not None and remote_client.node != node: # the user has moved to another node
+        apply_absence(username, remote_client.node)
+        remote_client = None
+    if remote_client is None:
+        remote_client = remote_clients[username] = RemoteClient(username, node)
+
+    address = (ip, int(port))
+    session = clients.get(remote_client)
+    if session is None:
+        session = clients[remote_client] = Session(username, int(server_port), int(version), address)
+    session.server_port = int(server_port)
+    session.version = int(version)
+    session.compression = compression
+    session.address = address
+    session.in_session = busy == '1'
+    if not isinstance(usernames.get(username), socket.socket):
+        index_username(username, remote_client)
+    addresses.setdefault(address, remote_client)
+
+
+def apply_absence(username, node):
+    """
+    this function gets the username of a client which is no longer registered on the given node
+    and removes its RemoteClient from its room and from the indexes.
+    """
+    remote_client = remote_clients.get(username)
+    if remote_client is None or remote_client.node != node:
+        return
+
+    remote_clients.pop(username)
+    leave_room(remote_client)
+    remove_client(remote_client)
+
+
+def open_link(link_socket, node=None):
+    """
+    this function registers a connected link socket in the selector. the id of the node at the
+    other end is known right away for a link to the coordinator, else it is learned from the
+    HELLO link message of the node.
+    """
+    link_socket.setblocking(False)
+    if link_socket.family != socket.AF_UNIX:
+        set_tcp_options(link_socket)
+    buffers[link_socket] = FrameBuffer(2)
+    outbound[link_socket] = OutboundQueue()
+    selector.register(link_socket, selectors.EVENT_READ, process_link)
+    if node is not None:
+        links[link_socket] = node
+        node_links[node] = link_socket
+
+
+def accept_link(listening_socket):
+    """
+    this function is called by the event loop whenever another node connects to the link socket
+    of this node. both ends of a link start with a HELLO link message.
+    """
+    try:
+        link_socket, _ = listening_socket.accept()
+    except (BlockingIOError, InterruptedError, ConnectionAbortedError):
+        return
+    open_link(link_socket)
+    send_link_frame(link_socket, LINK_HELLO, [node_id])
+
+
+def connect_peer_nodes():
+    """
+    this function is called by the event loop to link this node to the configured peer nodes it
+    is not linked to. the connection is not waited for: the HELLO link message is queued and sent
+    once the socket is connected, and a failed connection is closed like any other link and
+    retried LINK_RETRY_INTERVAL seconds later. it returns the number of seconds until the next
+    attempt.
+    """
+    now = time.monotonic()
+    timeout = ACTIVITY_LIMIT
+
+    for address, state in peer_nodes.items():
+        if isinstance(state, socket.socket):
+            continue
+        if state > now:
+            timeout = min(timeout, state - now)
+            continue
+
+        link_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+        link_socket.setblocking(False)
+        link_socket.connect_ex(address)
+        peer_nodes[address] = link_socket
+        open_link(link_socket)
+        send_link_frame(link_socket, LINK_HELLO, [node_id])
+
+    return timeout
+
+
+def process_link(link_socket):
+    """
+    this function is called by the event loop whenever a link socket has something to be read.
+    every complete link message is handled, and the link is closed if the node at the other end
+    has closed it or sent bytes which can not be parsed.
+    """
+    if not recieve_message(link_socket):
+        close_link(link_socket)
+        return
+
+    buffer = buffers[link_socket]
+
+    while True:
+        try:
+            frame = buffer.next_frame()
+        except ProtocolError as error:
+            logger.error(f'closing the link to node {links.get(link_socket)} after a protocol error: {error}')
+            close_link(link_socket)
+            return
+
+        if frame is None:
+            return
+
+        try:
+            handle_link_frame(link_socket, *frame)
+        except Exception:
+            logger.exception(f'an error occured while handling a link message from node {links.get(link_socket)}')
+
+
+def handle_link_frame(link_socket, opcode, payload):
+    """
+    this function takes the actions requested by a link message. the coordinator forwards routed
+    messages to their destination node and keeps the directory of the registered clients, while
+    the workers apply the messages to their local clients and RemoteClient objects.
+    """
+    if opcode in ROUTED_LINK_OPCODES:
+        node = payload.split(FIELD_SEPARATOR.encode('utf-8'), 1)[0].decode('utf-8')
+        if node != node_id:
+            if node in node_links:
+                send_buffers(node_links[node], [FRAME_HEADER.pack(len(payload), opcode), payload], bounded=False)
+            return
+
+    if opcode == LINK_DELIVER:
+        node, username, data = split_link_payload(payload, 2)
+        client_socket = usernames.get(username)
+        if client_socket is not None and not isinstance(client_socket, RemoteClient):
+            send_buffers(client_socket, [data])
+        return
+
+    fields = split_fields(payload)
+
+    if opcode == LINK_HELLO:
+        links[link_socket] = fields[0]
+        node_links[fields[0]] = link_socket
+        logger.info(f'node {fields[0]} has joined the cluster')
+
+        # bring the new node up to date
+        for node, presence in directory.values():
+            send_buffers(link_socket, [FRAME_HEADER.pack(len(presence), LINK_PRESENCE), presence], bounded=False)
+        if not relay:
+            for client_socket in list(clients):
+                if not isinstance(client_socket, RemoteClient):
+                    send_link_frame(link_socket, LINK_PRESENCE, presence_fields(client_socket))
+
+    elif opcode == LINK_PRESENCE:
+        if relay:
+            directory[fields[0]] = (fields[1], payload)
+            relay_link_frame(link_socket, opcode, payload)
+        else:
+            apply_presence(fields)
+
+    elif opcode == LINK_ABSENCE:
+        if relay:
+            if directory.get(fields[0], (None,))[0] == fields[1]:
+                directory.pop(fields[0])
+            relay_link_frame(link_socket, opcode, payload)
+        else:
+            apply_absence(*fields[:2])
+
+    elif opcode == LINK_COMMAND:
+        node, username, command, *command_fields = fields
+        remote_client = remote_clients.get(username)
+        if remote_client is not None:
+            dispatch_message(remote_client, int(command), command_fields)
+
+    elif opcode == LINK_SESSION:
+        node, username, room_node = fields
+        client_socket = usernames.get(username)
+        if client_socket is not None and not isinstance(client_socket, RemoteClient):
+            clients[client_socket].in_session = bool(room_node)
+            clients[client_socket].room_node = room_node or None
+            publish_presence(client_socket)
+
+    elif opcode == LINK_HEARTBEAT:
+        apply_hellos(set(fields[1:]))
+
+
+def relay_link_frame(source_socket, opcode, payload):
+    """
+    this function forwards a link message received by the coordinator to every other node.
+    """
+    for link_socket in list(links):
+        if link_socket is not source_socket:
+            send_buffers(link_socket, [FRAME_HEADER.pack(len(payload), opcode), payload], bounded=False)
+
+
+def close_link(link_socket):
+    """
+    this function closes a link. unless another link to the same node remains, the clients of
+    the node at the other end are no longer reachable: the coordinator announces their absence to
+    the other nodes and the other nodes remove them. a worker which has lost the coordinator can
+    not serve its clients anymore and exits, while a federated node links to its configured peer
+    nodes again later.
+    """
+    node = links.pop(link_socket, None)
+    buffers.pop(link_socket, None)
+    outbound.pop(link_socket, None)
+    selector.unregister(link_socket)
+    link_socket.close()
+
+    for address, state in peer_nodes.items():
+        if state is link_socket:
+            peer_nodes[address] = time.monotonic() + LINK_RETRY_INTERVAL
+            if node is None:
+                logger.debug(f'linking to node {address[0]}:{address[1]} failed')
+
+    if link_socket is default_link:
+        logger.error('the link to the coordinator has been closed, exiting')
+        raise SystemExit(1)
+
+    if node is None or node_links.get(node) is not link_socket:
+        return
+
+    node_links.pop(node)
+    for other_socket, other_node in links.items(): # both nodes may have linked to each other
+        if other_node == node:
+            node_links[node] = other_socket
+            return
+
+    logger.warning(f'node {node} has left the cluster')
+    for username, (owner, presence) in list(directory.items()):
+        if owner == node:
+            directory.pop(username)
+            broadcast_link(LINK_ABSENCE, [username, node])
+    for remote_client in list(remote_clients.values()):
+        if remote_client.node == node:
+            apply_absence(remote_client.username, node)
+
+
+def run_worker(index, coordinator_path, args):
+    """
+    this function is the entry point of a worker process of the multi-process mode. the worker
+    binds the server ports along with the other workers, connects to the coordinator and serves
+    its share of the clients with the selectors event loop.
+    """
+    global node_id, default_link
+
+    apply_settings(args)
+    node_id = f'w{index}'
+    setup_logging(f'server-{node_id}.log')
+
+    tcp_socket, udp_socket = create_server_sockets(args.udp_rcvbuf, True, args.tcp_port, args.udp_port)
+    if args.store_dir:
+        open_store(args.store_dir)
+    if args.stats_port:
+        selector.register(create_stats_socket(args.stats_port + index), selectors.EVENT_READ, accept_stats)
+
+    default_link = socket.socket(family=socket.AF_UNIX, type=socket.SOCK_STREAM)
+    default_link.connect(coordinator_path)
+    open_link(default_link, 'coordinator')
+    send_link_frame(default_link, LINK_HELLO, [node_id])
+
+    try:
+        run_event_loop(tcp_socket, udp_socket)
+    except KeyboardInterrupt:
+        pass
+
+
+def run_coordinator(args):
+    """
+    this function starts args.workers worker processes and runs the coordinator, which relays
+    the link messages between them and keeps the directory of the clients registered on every
+    worker, until it is interrupted or terminated. the workers are then stopped and the unix
+    socket is removed.
+    """
+    global node_id, relay
+
+    node_id = 'coordinator'
+    relay = True
+
+    # the unix socket is created before the workers are started, so they can connect right away
+    coordinator_path = os.path.join(tempfile.mkdtemp(prefix='chat-server-'), 'coordinator.sock')
+    listening_socket = socket.socket(family=socket.AF_UNIX, type=socket.SOCK_STREAM)
+    listening_socket.bind(coordinator_path)
+    listening_socket.listen(args.workers)
+    listening_socket.setblocking(False)
+    selector.register(listening_socket, selectors.EVENT_READ, accept_link)
+
+    # spawned workers start from a fresh interpreter instead of a copy of the coordinator
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_worker, args=(index, coordinator_path, args), daemon=True) for index in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    logger.info(f'started {args.workers} worker processes')
+
+    # SIGTERM (sent by service managers and benchmark.py) exits through the cleanup below
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    try:
+        while True:
+            handle_events(None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        listening_socket.close()
+        os.unlink(coordinator_path)
+        os.rmdir(os.path.dirname(coordinator_path))
+
+
+def start_federation(args):
+    """
+    this function makes this server a node of a federation. the node listens for the links of
+    the other nodes on args.link_port and links itself to the nodes given by args.peer_nodes.
+    """
+    global node_id
+
+    node_id = args.node_id or str(args.tcp_port)
+
+    if args.link_port:
+        listening_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
+        listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listening_socket.bind((IP, args.link_port))
+        listening_socket.listen(MAX_CONNECTIONS)
+        listening_socket.setblocking(False)
+        selector.register(listening_socket, selectors.EVENT_READ, accept_link)
+        logger.info(f'node {node_id} is listening for links at {IP}:{args.link_port}')
+
+    for peer_node in args.peer_nodes:
+        host, _, port = peer_node.rpartition(':')
+        peer_nodes[(host or IP, int(port))] = 0 # linked to by the first iteration of the event loop
+
+
+class StreamConnection:
+    """
+    this class adapts an asyncio stream to the part of the socket interface used by the message
+    handlers (sendmsg, getpeername and close), so that the same handlers serve both server modes.
+    outgoing data is put in a per-connection write queue which is written and drained by a
+    dedicated task, hence a slow client never stalls the handlers of the other clients. the
+    bytes held by the queue and by the transport are bounded by the high watermark, above which
+    the slow consumer policy applies.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info('peername')
+        self.write_queue = asyncio.Queue()
+        self.queued_bytes = 0
+        self.writer_task = asyncio.get_running_loop().create_task(self.write_loop())
+
+    def sendmsg(self, buffers):
+        size = sum(len(buffer) for buffer in buffers)
+
+        if self.writer.transport.is_closing():
+            return size
+
+        if self.queued_bytes + self.writer.transport.get_write_buffer_size() + size > outbound_high_watermark:
+            if slow_consumer_policy == 'drop':
+                outbound_stats['dropped_messages'] += 1
+                logger.warning(f'dropping a message for slow consumer {self.address}')
+            else:
+                outbound_stats['evicted_clients'] += 1
+                logger.warning(f'disconnecting slow consumer {self.address}')
+                self.writer.transport.abort() # the reader sees the end of the stream and terminates the client
+            return size
+
+        self.queued_bytes += size
+        self.write_queue.put_nowait(buffers)
+        return size
+
+    def getpeername(self):
+        return self.address
+
+    def close(self):
+        self.write_queue.put_nowait(None)
+
+    async def write_loop(self):
+        """
+        this coroutine writes every queued message to the stream. all messages queued while
+        the previous drain was pending are written together before draining again.
+        """
+        while True:
+            buffers = await self.write_queue.get()
+
+            while buffers is not None:
+                self.queued_bytes -= sum(len(buffer) for buffer in buffers)
+                self.writer.writelines(buffers)
+                if self.write_queue.empty():
+                    break
+                buffers = self.write_queue.get_nowait()
+
+            if buffers is None:
+                break
+
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                break
+
+        self.writer.close()
+
+
+async def read_stream(connection):
+    """
+    this coroutine is the asyncio counterpart of recieve_message. it appends everything which
+    can be read from the stream of a connection to the frame buffer of the client and returns
+    False if the stream is closed or broken.
+    """
+    try:
+        data = await connection.reader.read(RECV_SIZE)
+    except OSError:
+        return False
+
+    if not len(data):
+        return False
+
+    buffers[connection].feed(data)
+    return True
+
+
+async def handle_connection(reader, writer):
+    """
+    this coroutine is started by asyncio for each client connection. it registers the client
+    with its first message and then dispatches every following message of the client until
+    the connection is closed.
+    """
+    connection = StreamConnection(reader, writer)
+    set_tcp_options(writer.get_extra_info('socket'))
+    buffers[connection] = FrameBuffer()
+    connection_addresses[connection] = connection.address
+    connection_stats['accepted'] += 1
+
+    registered = None
+    while registered is None:
+        registered = await read_stream(connection) and handle_registration(connection, connection.address)
+
+    if registered:
+        dispatch_frames(connection)
+
+        while connection in buffers and await read_stream(connection):
+            dispatch_frames(connection)
+
+    terminate_client(connection)
+
+
+async def run_asyncio_server(tcp_socket, udp_socket, stats_socket=None):
+    """
+    this coroutine serves the TCP and UDP sockets of the server with asyncio. each client
+    connection is handled by its own handle_connection task, HELLO messages are drained in
+    batches by reset_activity and the expired clients are terminated when their activity deadline is due.
+    the metrics are served on the stats socket, if any.
+    """
+    loop = asyncio.get_running_loop()
+    if store is not None: # group commit of the records appended within an iteration of the loop
+        store.on_dirty = lambda: loop.call_soon(store.commit)
+    server = await asyncio.start_server(handle_connection, sock=tcp_socket)
+    loop.add_reader(udp_socket, reset_activity, udp_socket)
+    if stats_socket is not None:
+        await asyncio.start_server(handle_stats, sock=stats_socket)
+    logger.info('successfully started the asyncio server')
+
+    async with server:
+        timeout = ACTIVITY_LIMIT
+        while True:
+            await asyncio.sleep(timeout)
+            timeout = update_activity()
+
+
+def open_handover_socket(path):
+    """
+    this function listens on the unix socket at the given path for the new server process of a
+    reload. the socket file of the server which has handed over to this one is replaced.
+    """
+    global handover_socket
+
+    if os.path.exists(path):
+        os.unlink(path)
+    handover_socket = socket.socket(family=socket.AF_UNIX, type=socket.SOCK_STREAM)
+    handover_socket.bind(path)
+    handover_socket.listen(1)
+    handover_socket.setblocking(False)
+    selector.register(handover_socket, selectors.EVENT_READ, hand_over)
+    logger.info(f'a new server process can take over through {path}')
+
+
+def snapshot_state():
+    """
+    this function returns the snapshot of the state of the server handed over to a new process,
+    along with the sockets whose file descriptors go with it. sockets are referred to by their
+    position in that list: the listening sockets come first, then the client connections. the
+    bytes received but not parsed yet and the bytes not sent yet are part of the snapshot, as
+    well as the remaining activity time of the clients.
+    """
+    listener_names = {accept_connection: 'tcp', reset_activity: 'udp', accept_stats: 'stats'}
+    sockets = []
+    listeners = {}
+    for key in selector.get_map().values():
+        if key.data in listener_names:
+            listeners[listener_names[key.data]] = len(sockets)
+            sockets.append(key.fileobj)
+
+    now = time.monotonic()
+    positions = {}
+    connections = []
+    for client_socket, buffer in buffers.items():
+        if not isinstance(client_socket, socket.socket) or client_socket in links:
+            continue
+
+        queue = outbound.get(client_socket)
+        connection = {'socket': len(sockets), 'version': buffer.version, 'address': list(connection_addresses[client_socket]),
+                      'received': base64.b64encode(buffer.pending()).decode('ascii'),
+                      'unsent': base64.b64encode(b''.join(queue.buffers) if queue else b'').decode('ascii'),
+                      'session': None}
+
+        session = clients.get(client_socket)
+        if session is not None:
+            connection['session'] = {'username': session.username, 'server_port': session.server_port,
+                                     'version': session.version, 'compression': session.compression,
+                                     'remaining': session.deadline - now,
+                                     'in_session': session.in_session, 'subscriptions': session.subscriptions}
+
+        positions[client_socket] = len(sockets)
+        sockets.append(client_socket)
+        connections.append(connection)
+
+    snapshot = {'listeners': listeners, 'connections': connections,
+                'private_chat_rooms': {room: [positions[member] for member in members] for room, members in private_chat_rooms.items()},
+                'group_chat_rooms': {room: [positions[member] for member in members] for room, members in group_chat_rooms.items()},
+                'total_private_rooms': total_private_rooms, 'total_global_rooms': total_global_rooms,
+                'connection_stats': connection_stats, 'outbound_stats': outbound_stats, 'heartbeat_stats': heartbeat_stats,
+                'start_time': start_time}
+    return snapshot, sockets
+
+
+def hand_over(listening_socket):
+    """
+    this function is called by the event loop when a new server process connects to the
+    handover socket. the writes of the current tick are sent and the message store is closed,
+    then the snapshot of the state is sent, followed by the file descriptors of its sockets.
+    nothing is read from the clients anymore: the bytes they send meanwhile wait in the kernel
+    for the new process. once the new process acknowledges the handover, this process exits
+    without shutting any connection down. if it does not, this process resumes serving.
+    """
+    global store
+
+    try:
+        link_socket, _ = listening_socket.accept()
+    except (BlockingIOError, InterruptedError):
+        return
+
+    logger.info('a new server process is taking over')
+    link_socket.settimeout(HANDOVER_TIMEOUT)
+    flush_writes()
+
+    store_dir = None
+    if store is not None:
+        store_dir = store.directory
+        atexit.unregister(store.close)
+        store.close()
+        store = None
+
+    snapshot, sockets = snapshot_state()
+    try:
+        data = json.dumps(snapshot).encode('utf-8')
+        link_socket.sendall(len(data).to_bytes(8, 'big') + data)
+        for start in range(0, len(sockets), HANDOVER_BATCH_SIZE):
+            socket.send_fds(link_socket, [b'F'], [sock.fileno() for sock in sockets[start:start + HANDOVER_BATCH_SIZE]])
+        acknowledged = link_socket.recv(1) == HANDOVER_ACK
+    except OSError as error:
+        logger.error(f'handing over to the new server process failed: {error}')
+        acknowledged = False
+    link_socket.close()
+
+    if acknowledged:
+        logger.info(f'handed {len(snapshot["connections"])} connections over to the new server process, exiting')
+        raise SystemExit(0)
+
+    logger.error('the new server process has not taken over, resuming')
+    if store_dir is not None:
+        open_store(store_dir)
+
+
+def receive_exactly(link_socket, size):
+    """
+    this function reads exactly size bytes from a blocking socket.
+    """
+    data = bytearray()
+    while len(data) < size:
+        chunk = link_socket.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('the server handing over has closed the connection')
+        data += chunk
+    return bytes(data)
+
+
+def take_over(path):
+    """
+    this function connects to the handover socket of a running server and receives the snapshot
+    of its state and the file descriptors of its sockets. it returns the connection to the
+    running server, which is waiting for the acknowledgement of the handover, the snapshot and
+    the sockets, or None if no server is listening on the handover socket.
+    """
+    link_socket = socket.socket(family=socket.AF_UNIX, type=socket.SOCK_STREAM)
+    try:
+        link_socket.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError): # no server is running, or a stale socket file was left
+        link_socket.close()
+        return None
+
+    link_socket.settimeout(HANDOVER_TIMEOUT)
+    size = int.from_bytes(receive_exactly(link_socket, 8), 'big')
+    snapshot = json.loads(receive_exactly(link_socket, size))
+
+    # the file descriptors are attached to the single byte of each batch, so that the snapshot is
+    # never read along with them
+    count = len(snapshot['listeners']) + len(snapshot['connections'])
+    sockets = []
+    while len(sockets) < count:
+        data, fds, flags, address = socket.recv_fds(link_socket, 1, HANDOVER_BATCH_SIZE)
+        if not data:
+            raise ConnectionError('the server handing over has closed the connection')
+        sockets += [socket.socket(fileno=fd) for fd in fds]
+
+    return link_socket, snapshot, sockets
+
+
+def restore_state(snapshot, sockets):
+    """
+    this function rebuilds the state of the server from the snapshot and the sockets handed over
+    by the previous server process: the client connections are registered in the selector with
+    their frame buffers and outbound queues, the sessions in the indexes, then the rooms and the
+    presence subscriptions are restored.
+    """
+    global total_private_rooms, total_global_rooms, start_time
+
+    now = time.monotonic()
+    for connection in snapshot['connections']:
+        client_socket = sockets[connection['socket']]
+        client_socket.setblocking(False)
+        connection_addresses[client_socket] = tuple(connection['address'])
+        buffers[client_socket] = FrameBuffer(connection['version'])
+        buffers[client_socket].feed(base64.b64decode(connection['received']))
+        queue = outbound[client_socket] = OutboundQueue()
+        queue.push([base64.b64decode(connection['unsent'])])
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if queue.size else selectors.EVENT_READ
+
+        state = connection['session']
+        if state is None: # the client has not registered yet
+            selector.register(client_socket, events, register_new_user)
+            continue
+
+        session = Session(state['username'], state['server_port'], state['version'], deadline=now + state['remaining'],
+                          in_session=state['in_session'], compression=state['compression'])
+        add_client(client_socket, session, connection_addresses[client_socket])
+        selector.register(client_socket, events, process_message)
+
+    for chat_rooms, name in [(private_chat_rooms, 'private_chat_rooms'), (group_chat_rooms, 'group_chat_rooms')]:
+        for chat_room, members in snapshot[name].items():
+            for member in members:
+                join_room(chat_rooms, chat_room, sockets[member])
+
+    # subscriptions are restored last, so that the restored sessions are not notified as online
+    for connection in snapshot['connections']:
+        state = connection['session']
+        if state is not None and state['subscriptions']:
+            client_socket = sockets[connection['socket']]
+            clients[client_socket].subscriptions = state['subscriptions']
+            for username in state['subscriptions']:
+                subscribers.setdefault(username, {})[client_socket] = None
+
+    total_private_rooms = max(total_private_rooms, snapshot['total_private_rooms'])
+    total_global_rooms = max(total_global_rooms, snapshot['total_global_rooms'])
+    connection_stats.update(snapshot['connection_stats'])
+    outbound_stats.update(snapshot['outbound_stats'])
+    heartbeat_stats.update(snapshot['heartbeat_stats'])
+    start_time = snapshot['start_time']
+
+    logger.info(f'took over {len(clients)} clients and {len(snapshot["connections"]) - len(clients)} unregistered connections '
+                f'from the previous server process')
+
+
+def open_store(store_dir):
+    """
+    this function opens the message store in the given directory, in a subdirectory named after
+    the node when the server is part of a cluster. group rooms are numbered after the rooms of
+    this node found in the store, so that the messages of a new room are never mixed with those
+    of an older room.
+    """
+    global store, total_global_rooms
+
+    store = MessageStore(os.path.join(store_dir, node_id) if node_id else store_dir)
+    atexit.register(store.close)
+
+    for room in store.rooms:
+        number, separator, owner = room.partition('@')
+        if number.isdigit() and owner == (node_id or ''):
+            total_global_rooms = max(total_global_rooms, int(number))
+
+    logger.info(f'opened the message store at {store.directory}: {len(store.users)} users, {len(store.rooms)} rooms, {len(store.pending)} users with stored messages')
+
+
+def apply_settings(args):
+    """
+    this function applies the settings given on the command line.
+    """
+    global outbound_high_watermark, slow_consumer_policy, log_mode, write_coalescing, tcp_nodelay, tcp_cork
+
+    outbound_high_watermark = args.outbound_high_watermark
+    slow_consumer_policy = args.slow_consumer_policy
+    log_mode = args.log_mode
+    write_coalescing = args.write_coalescing
+    tcp_nodelay = args.tcp_nodelay
+    tcp_cork = args.tcp_cork
+
+
+def main():
+    """
+    this function is the entry point of the server. it configures logging, creates the server
+    sockets and hands them over to the event loop of the selected server mode. with several
+    workers, the sockets are created by the worker processes instead.
+    """
+    parser = argparse.ArgumentParser(description='server of the chatting application')
+    parser.add_argument('--mode', choices=['selectors', 'asyncio'], default='selectors',
+                        help='serve the clients with a selectors event loop or with asyncio streams')
+    parser.add_argument('--udp-rcvbuf', type=int, default=None, metavar='BYTES',
+                        help='size of the receive buffer of the UDP socket receiving the HELLO messages')
+    parser.add_argument('--outbound-high-watermark', type=int, default=outbound_high_watermark, metavar='BYTES',
+                        help='maximum number of bytes queued for a client before the slow consumer policy applies')
+    parser.add_argument('--slow-consumer-policy', choices=['disconnect', 'drop'], default=slow_consumer_policy,
+                        help='disconnect slow consumers or drop the messages which do not fit in their queue')
+    parser.add_argument('--write-coalescing', choices=['tick', 'off'], default=write_coalescing,
+                        help='send the messages written to a client during a tick of the event loop with a single '
+                             'system call, or each message right away (selectors mode)')
+    parser.add_argument('--tcp-nodelay', choices=['on', 'off'], default=tcp_nodelay,
+                        help='disable the Nagle algorithm on the tcp connections')
+    parser.add_argument('--tcp-cork', choices=['on', 'off'], default=tcp_cork,
+                        help='cork the tcp connections while a tick of the event loop writes to them (selectors mode, linux only)')
+    parser.add_argument('--log-mode', choices=['queue', 'sync'], default=log_mode,
+                        help='write the logs from a background thread or from the event loop itself')
+    parser.add_argument('--store-dir', default=None, metavar='PATH',
+                        help='store the group messages and the messages of offline users in this directory')
+    parser.add_argument('--tcp-port', type=int, default=TCP_PORT, help='port receiving the client connections')
+    parser.add_argument('--udp-port', type=int, default=UDP_PORT, help='port receiving the HELLO messages')
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help='number of worker processes sharing the server ports (selectors mode only)')
+    parser.add_argument('--stats-port', type=int, default=None, metavar='PORT',
+                        help='serve the metrics of the server over HTTP on this port (worker i uses PORT + i)')
+    parser.add_argument('--node-id', default=None, help='id of this node in a federation (defaults to the TCP port)')
+    parser.add_argument('--link-port', type=int, default=None, metavar='PORT',
+                        help='port receiving the links of the other nodes of a federation')
+    parser.add_argument('--peer-node', dest='peer_nodes', action='append', default=[], metavar='[HOST:]PORT',
+                        help='link port of another node of the federation (may be repeated)')
+    parser.add_argument('--handover-socket', default=None, metavar='PATH',
+                        help='take the sockets and the clients over from the server listening on this unix socket, '
+                             'if any, then listen on it for the next server process (selectors mode, single process)')
+    args = parser.parse_args()
+
+    federated = args.link_port or args.peer_nodes
+    if (args.workers > 1 or federated) and args.mode != 'selectors':
+        parser.error('--workers, --link-port and --peer-node require the selectors mode')
+    if args.workers > 1 and federated:
+        parser.error('a federation node runs in a single process')
+    if args.tcp_cork == 'on' and TCP_CORK is None:
+        parser.error('--tcp-cork is only supported on linux')
+    if args.handover_socket and (args.mode != 'selectors' or args.workers > 1 or federated):
+        parser.error('--handover-socket requires the selectors mode, a single worker and no federation')
+
+    apply_settings(args)
+    setup_logging(append=bool(args.handover_socket)) # the server which hands over writes to the same log
+
+    handover = None
+    if args.handover_socket:
+        try:
+            handover = take_over(args.handover_socket)
+        except (OSError, ValueError) as error:
+            logger.error(f'taking over from the running server failed: {error}')
+            raise SystemExit(1)
+
+    if args.workers > 1:
+        run_coordinator(args)
+        return
+
+    if handover is not None: # the listening sockets of the previous server process are kept
+        link_socket, snapshot, sockets = handover
+        listeners = {name: sockets[position] for name, position in snapshot['listeners'].items()}
+        for listener in listeners.values():
+            listener.setblocking(False)
+        tcp_socket, udp_socket = listeners['tcp'], listeners['udp']
+        stats_socket = listeners.get('stats') or (create_stats_socket(args.stats_port) if args.stats_port else None)
+    else:
+        tcp_socket, udp_socket = create_server_sockets(args.udp_rcvbuf, tcp_port=args.tcp_port, udp_port=args.udp_port)
+        stats_socket = create_stats_socket(args.stats_port) if args.stats_port else None
+    if federated:
+        start_federation(args)
+    if args.store_dir:
+        open_store(args.store_dir)
+
+    if handover is not None:
+        restore_state(snapshot, sockets)
+        link_socket.sendall(HANDOVER_ACK)
+        link_socket.close()
+    if args.handover_socket:
+        open_handover_socket(args.handover_socket)
+
+    if args.mode == 'asyncio':
+        asyncio.run(run_asyncio_server(tcp_socket, udp_socket, stats_socket))
+    else:
+        if stats_socket is not None:
+            selector.register(stats_socket, selectors.EVENT_READ, accept_stats)
+        run_event_loop(tcp_socket, udp_socket)
+
 
-process_message_thread = threading.Thread(target=process_message)
-process_message_thread.start()
-logger.info('successfully started process message thread')
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+"""
+durable, append-only message store of the server.
+
+records are appended to a log split into segment files named after the offset of their first
+byte, so that a record is found from its offset by a bisection over the segments. each record
+is made of a header packed with RECORD_HEADER (the length of the payload, the kind of the record
+and its timestamp), followed by the payload, which holds the fields of the record encoded with
+utf-8 and separated by FIELD_SEPARATOR. segments are read through memory maps.
+
+appended records are kept in memory and written to the active segment with a single write per
+commit (group commit), which the server performs once per iteration of its event loop. the
+segment is synced to disk at most every SYNC_INTERVAL seconds.
+
+the messages waiting for each offline user and the known users are indexed in memory, and these
+indexes are rebuilt by reading the log when the store is opened. the messages of each group room
+are indexed on disk, in a file of the ROOM_INDEX_DIRECTORY holding the offsets of the messages of
+the room packed with ROOM_INDEX_ENTRY, so that a page of the history of a room is found without
+scanning the log. the indexes of the rooms read recently are kept in memory in an LRU cache of
+HOT_ROOMS rooms. room index files are written after the log, hence they may only lack their last
+offsets, which are indexed again when the store is opened.
+"""
+import array # offsets of the messages of a room
+import bisect # segment holding an offset, page of a room history
+import collections # LRU cache of the room indexes
+import mmap # memory mapped segments
+import os # files of the segments
+import struct # packing and unpacking of the record header
+import sys # byte order of the room indexes
+import time # timestamps of the records and sync interval
+from protocol import FIELD_SEPARATOR # separator of the fields of a record
+
+RECORD_HEADER = struct.Struct('!IBd') # payload length, record kind and timestamp
+SEGMENT_SIZE = 64 << 20 # size above which a new segment is started
+SYNC_INTERVAL = 1 # maximum number of seconds between two syncs of the active segment
+SEGMENT_SUFFIX = '.log'
+ROOM_INDEX_ENTRY = struct.Struct('!Q') # offset of a message in a room index file
+ROOM_INDEX_DIRECTORY = 'rooms' # subdirectory of the room index files
+ROOM_INDEX_SUFFIX = '.idx'
+HOT_ROOMS = 256 # number of room indexes kept in memory
+
+# kinds of the records
+RECORD_USER = 1 # username: a user has registered for the first time
+RECORD_MESSAGE = 2 # room, sender, fields...: a message sent to a group chat room
+RECORD_PENDING = 3 # recipient, sender, opcode, fields...: a message waiting for an offline user
+RECORD_DELIVERED = 4 # recipient: the messages waiting for the user have been delivered
+
+
+class StoreError(Exception):
+    """
+    raised when the log of the store can not be read.
+    """
+
+
+class MessageStore:
+    """
+    this class is the append-only log of the server along with its indexes. offsets are positions
+    in the whole log, and the offset of a record is returned when it is appended.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments = [] # offsets of the first byte of each segment, in increasing order
+        self.maps = {} # segment offset -> memory map of the segment
+        self.buffer = bytearray() # records appended since the last commit
+        self.committed = 0 # offset of the end of the records written to the active segment
+        self.active = None # file object of the active segment
+        self.last_sync = time.monotonic()
+        self.on_dirty = None # called when a record is appended to an empty buffer
+
+        self.rooms = {} # room -> number of messages of the room
+        self.pending = {} # username -> offsets of the messages waiting for the user
+        self.users = set() # usernames of the users who have ever registered
+
+        self.hot_rooms = collections.OrderedDict() # room -> offsets of its messages, least recently read first
+        self.unindexed = {} # room -> offsets not written to the room index file yet
+        self.indexed = {} # room -> last offset of the room index file, only used while loading
+
+        os.makedirs(os.path.join(directory, ROOM_INDEX_DIRECTORY), exist_ok=True)
+        self.load()
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f'{segment:020d}{SEGMENT_SUFFIX}')
+
+    def room_index_path(self, room):
+        return os.path.join(self.directory, ROOM_INDEX_DIRECTORY, f'{room}{ROOM_INDEX_SUFFIX}')
+
+    def load(self):
+        """
+        this function finds the segments of the log and rebuilds the indexes by reading every
+        record. a record which has only been partially written when the server stopped is cut
+        off the end of the log, and so are the offsets of the room indexes pointing beyond it.
+        """
+        self.load_room_indexes()
+
+        self.segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                               if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+        if not self.segments:
+            self.segments = [0]
+
+        for segment in self.segments:
+            size = os.path.getsize(self.segment_path(segment)) if os.path.exists(self.segment_path(segment)) else 0
+            position = 0
+            while position + RECORD_HEADER.size <= size:
+                length, kind, timestamp = RECORD_HEADER.unpack(self.read_bytes(segment, position, RECORD_HEADER.size))
+                if position + RECORD_HEADER.size + length > size:
+                    break
+                fields = self.read_bytes(segment, position + RECORD_HEADER.size, length).decode('utf-8').split(FIELD_SEPARATOR)
+                self.index(segment + position, kind, fields)
+                position += RECORD_HEADER.size + length
+
+            if position < size:
+                if segment != self.segments[-1]:
+                    raise StoreError(f'segment {self.segment_path(segment)} is corrupted at byte {position}')
+                self.unmap(segment)
+                os.truncate(self.segment_path(segment), position)
+
+        self.committed = self.segments[-1] + position if self.segments else 0
+        self.active = open(self.segment_path(self.segments[-1]), 'ab', buffering=0)
+
+        for room, last_offset in self.indexed.items():
+            if last_offset >= self.committed: # the end of the log has been lost
+                offsets = self.read_room_index(room)
+                os.truncate(self.room_index_path(room), bisect.bisect_left(offsets, self.committed) * ROOM_INDEX_ENTRY.size)
+        self.indexed.clear()
+        self.write_room_indexes()
+
+    def load_room_indexes(self):
+        """
+        this function finds the last offset of each room index file, after which the messages
+        of the room are indexed again while the log is read.
+        """
+        for name in os.listdir(os.path.join(self.directory, ROOM_INDEX_DIRECTORY)):
+            if not name.endswith(ROOM_INDEX_SUFFIX):
+                continue
+
+            room = name[:-len(ROOM_INDEX_SUFFIX)]
+            path = self.room_index_path(room)
+            size = os.path.getsize(path)
+            if size % ROOM_INDEX_ENTRY.size: # an entry has only been partially written
+                size -= size % ROOM_INDEX_ENTRY.size
+                os.truncate(path, size)
+
+            if size:
+                with open(path, 'rb') as index_file:
+                    index_file.seek(size - ROOM_INDEX_ENTRY.size)
+                    self.indexed[room], = ROOM_INDEX_ENTRY.unpack(index_file.read(ROOM_INDEX_ENTRY.size))
+
+    def read_room_index(self, room):
+        """
+        this function reads the room index file of a room and returns its offsets.
+        """
+        offsets = array.array('Q')
+        try:
+            with open(self.room_index_path(room), 'rb') as index_file:
+                offsets.frombytes(index_file.read())
+        except FileNotFoundError:
+            pass
+
+        if sys.byteorder == 'little':
+            offsets.byteswap()
+        return offsets
+
+    def room_offsets(self, room):
+        """
+        this function returns the offsets of the messages of a room in increasing order, from the
+        LRU cache of the room indexes or else from the room index file.
+        """
+        offsets = self.hot_rooms.get(room)
+        if offsets is not None:
+            self.hot_rooms.move_to_end(room)
+            return offsets
+
+        offsets = self.read_room_index(room)
+        offsets.extend(self.unindexed.get(room, ()))
+
+        self.hot_rooms[room] = offsets
+        if len(self.hot_rooms) > HOT_ROOMS:
+            self.hot_rooms.popitem(last=False)
+        return offsets
+
+    def index(self, offset, kind, fields):
+        """
+        this function adds a record to the indexes of the store.
+        """
+        if kind == RECORD_USER:
+            self.users.add(fields[0])
+        elif kind == RECORD_MESSAGE:
+            room = fields[0]
+            self.rooms[room] = self.rooms.get(room, 0) + 1
+            if offset > self.indexed.get(room, -1): # the offset is not in the room index file yet
+                self.unindexed.setdefault(room, array.array('Q')).append(offset)
+                if room in self.hot_rooms:
+                    self.hot_rooms[room].append(offset)
+        elif kind == RECORD_PENDING:
+            self.pending.setdefault(fields[0], []).append(offset)
+        elif kind == RECORD_DELIVERED:
+            self.pending.pop(fields[0], None)
+
+    def append(self, kind, fields):
+        """
+        this function appends a record to the log and to the indexes and returns its offset. the
+        record is written to the disk by the next commit.
+        """
+        payload = FIELD_SEPARATOR.join(fields).encode('utf-8')
+        offset = self.committed + len(self.buffer)
+
+        was_empty = not self.buffer
+        self.buffer += RECORD_HEADER.pack(len(payload), kind, time.time())
+        self.buffer += payload
+        self.index(offset, kind, fields)
+
+        if was_empty and self.on_dirty is not None:
+            self.on_dirty()
+        return offset
+
+    def commit(self):
+        """
+        this function writes every record appended since the last commit to the active segment
+        with a single write, starting a new segment first if the active one is full. the offsets
+        of the new messages are then appended to the room index files.
+        """
+        if not self.buffer:
+            return
+
+        position = self.committed - self.segments[-1]
+        if position and position + len(self.buffer) > SEGMENT_SIZE:
+            self.active.close()
+            self.segments.append(self.committed)
+            self.active = open(self.segment_path(self.committed), 'ab', buffering=0)
+
+        view = memoryview(self.buffer)
+        while view:
+            view = view[self.active.write(view):]
+        view.release()
+
+        self.committed += len(self.buffer)
+        self.buffer.clear()
+        self.write_room_indexes()
+
+        if time.monotonic() - self.last_sync >= SYNC_INTERVAL:
+            self.sync()
+
+    def write_room_indexes(self):
+        """
+        this function appends the offsets of the messages which have been written to the log to
+        the room index files.
+        """
+        for room, offsets in self.unindexed.items():
+            if sys.byteorder == 'little':
+                offsets.byteswap()
+            with open(self.room_index_path(room), 'ab') as index_file:
+                index_file.write(offsets)
+        self.unindexed.clear()
+
+    def sync(self):
+        os.fsync(self.active.fileno())
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        self.commit()
+        self.sync()
+        self.active.close()
+        for segment in list(self.maps):
+            self.unmap(segment)
+
+    def unmap(self, segment):
+        segment_map = self.maps.pop(segment, None)
+        if segment_map is not None:
+            segment_map.close()
+
+    def read_bytes(self, segment, position, length):
+        """
+        this function reads bytes of a segment through its memory map, which is mapped again when
+        the bytes lie beyond its end because the segment has grown since it was mapped.
+        """
+        segment_map = self.maps.get(segment)
+        if segment_map is None or position + length > len(segment_map):
+            self.unmap(segment)
+            with open(self.segment_path(segment), 'rb') as segment_file:
+                segment_map = self.maps[segment] = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return segment_map[position:position + length]
+
+    def read(self, offset):
+        """
+        this function returns the timestamp and the fields of the record at the given offset.
+        """
+        if offset >= self.committed: # the record has not been committed yet
+            position = offset - self.committed
+            header = self.buffer[position:position + RECORD_HEADER.size]
+            length, kind, timestamp = RECORD_HEADER.unpack(header)
+            payload = bytes(self.buffer[position + RECORD_HEADER.size:position + RECORD_HEADER.size + length])
+        else:
+            segment = self.segments[bisect.bisect_right(self.segments, offset) - 1]
+            length, kind, timestamp = RECORD_HEADER.unpack(self.read_bytes(segment, offset - segment, RECORD_HEADER.size))
+            payload = self.read_bytes(segment, offset - segment + RECORD_HEADER.size, length)
+
+        return timestamp, payload.decode('utf-8').split(FIELD_SEPARATOR)
+
+    def add_user(self, username):
+        """
+        this function records a registered user, once.
+        """
+        if username not in self.users:
+            self.append(RECORD_USER, [username])
+
+    def append_message(self, room, sender, fields):
+        return self.append(RECORD_MESSAGE, [room, sender] + list(fields))
+
+    def queue_message(self, recipient, sender, opcode, fields):
+        return self.append(RECORD_PENDING, [recipient, sender, str(opcode)] + list(fields))
+
+    def history(self, room, count, before=None):
+        """
+        this function returns a page of the history of a room, made of its count last messages
+        sent before the message at the offset before (or of its count last messages), as
+        (timestamp, sender, fields) tuples from the oldest to the newest. the offset of the oldest
+        message of the page is returned along with the page as the cursor of the previous page,
+        or None if the page starts with the first message of the room.
+        """
+        if room not in self.rooms:
+            return [], None
+
+        offsets = self.room_offsets(room)
+        end = bisect.bisect_left(offsets, before) if before is not None else len(offsets)
+        start = max(end - count, 0)
+
+        messages = []
+        for offset in offsets[start:end]:
+            timestamp, (_, sender, *fields) = self.read(offset)
+            messages.append((timestamp, sender, fields))
+
+        return messages, (offsets[start] if start else None)
+
+    def take_pending(self, recipient):
+        """
+        this function returns the messages waiting for a user as (sender, opcode, fields) tuples
+        in the order they were queued, and records that they have been delivered.
+        """
+        offsets = self.pending.get(recipient)
+        if not offsets:
+            return []
+
+        messages = []
+        for offset in offsets:
+            timestamp, (_, sender, opcode, *fields) = self.read(offset)
+            messages.append((sender, int(opcode), fields))
+
+        self.append(RECORD_DELIVERED, [recipient])
+        return messages